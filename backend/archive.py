@@ -0,0 +1,199 @@
+"""
+Hot/cold storage for expenses.
+
+Approved and rejected expenses dated more than ARCHIVE_AFTER_DAYS ago are
+moved from `expenses` to `expenses_archive` (same columns, same ids),
+together with their workflow steps. The hot table and its indexes then hold
+pending and recent work only, which is all the approval queues, /assigned
+and recent listings ever read.
+
+    python archive.py                       # decided and older than ARCHIVE_AFTER_DAYS
+    python archive.py --older-than-days 730 --chunk-size 500 --max-chunks 20
+
+Ids stay unique across both tables: `expenses` is AUTOINCREMENT on SQLite,
+so an archived id is never handed out again (create_tables rebuilds a table
+that predates that, seeding its sequence past both tables' ids), and other
+databases never reuse sequence values.
+
+Expenses move ARCHIVE_CHUNK_SIZE at a time, each chunk copied and deleted
+in one transaction, so an interrupted run loses nothing and the next run
+carries on with what is left. Candidates are locked (FOR UPDATE SKIP LOCKED
+where the database has it), so an expense edited mid-run is either moved
+with the edit or left for the next run.
+
+Reads stay transparent. Listings, search, export, /mine and single-expense
+lookups first ask whether the archive could hold a match: one probe on its
+date index, skipped entirely for pending-only queries. Only then do they
+read it, merging its keyset-ordered page with the hot one. Archived
+expenses are read-only; updating or deleting one answers 409.
+
+Receipts stay in the receipts table. Where the database enforces the
+receipts foreign key (anything but SQLite here), expenses with receipts are
+kept hot, since deleting them would cascade to their receipts.
+"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import DateTime, delete, exists, insert, literal, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from cache import EXPENSES_TAG, expense_tag, owner_tag, response_cache
+from database import AsyncSessionLocal
+from duplicates import forget
+from models import ApprovalStep, ApprovalStepArchive, Expense, ExpenseArchive, ExpenseStatus, Receipt
+
+logger = logging.getLogger(__name__)
+
+DECIDED = (ExpenseStatus.APPROVED, ExpenseStatus.REJECTED)
+
+# Copied column for column; the archive adds archived_at. Steps get new ids,
+# since SQLite may hand a deleted step's id to the next hot one.
+EXPENSE_COLUMNS = ["id", "amount", "currency", "date", "description", "status", "owner_id", "created_at", "updated_at"]
+STEP_COLUMNS = ["expense_id", "rule_id", "approver_id", "sequence", "is_override", "status", "comments", "decided_at", "created_at"]
+
+class ArchiveResult(NamedTuple):
+    archived: int
+    chunks: int
+
+def archive_probe(filters=None):
+    """
+    A query returning a row when the archive may hold matches for `filters`
+    (ExpenseFilters, or None for "anything at all"), or None when it cannot.
+    Only the date bounds are checked, so the probe stays on the date index.
+    """
+    if filters is not None and filters.status == ExpenseStatus.PENDING:
+        return None
+    query = select(ExpenseArchive.id)
+    if filters is not None:
+        if filters.date_from is not None:
+            query = query.where(ExpenseArchive.date >= filters.date_from)
+        if filters.date_to is not None:
+            query = query.where(ExpenseArchive.date < filters.date_to)
+    return query.limit(1)
+
+async def reaches_archive(db: AsyncSession, filters=None) -> bool:
+    probe = archive_probe(filters)
+    return probe is not None and (await db.execute(probe)).first() is not None
+
+async def reject_if_archived(db: AsyncSession, expense_id: int):
+    """409 for writes to an archived expense, which would otherwise look missing"""
+    if await db.get(ExpenseArchive, expense_id) is not None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Expense is archived and can no longer be changed"
+        )
+
+async def archive_chunk(db: AsyncSession, cutoff: datetime, chunk_size: int) -> List[tuple]:
+    """Move up to `chunk_size` decided expenses dated before `cutoff`; returns their (id, owner_id)"""
+    candidates = select(Expense.id, Expense.owner_id).where(Expense.status.in_(DECIDED), Expense.date < cutoff)
+    if db.bind.dialect.name != "sqlite":
+        candidates = candidates.where(~exists().where(Receipt.expense_id == Expense.id))
+    # No ORDER BY: any chunk will do, and the scan stops after chunk_size matches
+    rows = (await db.execute(candidates.limit(chunk_size).with_for_update(skip_locked=True))).all()
+    if not rows:
+        return []
+    ids = [row.id for row in rows]
+
+    await db.execute(
+        insert(ExpenseArchive).from_select(
+            EXPENSE_COLUMNS + ["archived_at"],
+            select(*[getattr(Expense, name) for name in EXPENSE_COLUMNS], literal(datetime.utcnow(), DateTime))
+            .where(Expense.id.in_(ids))
+        )
+    )
+    await db.execute(
+        insert(ApprovalStepArchive).from_select(
+            STEP_COLUMNS,
+            select(*[getattr(ApprovalStep, name) for name in STEP_COLUMNS]).where(ApprovalStep.expense_id.in_(ids))
+        )
+    )
+    await db.execute(delete(ApprovalStep).where(ApprovalStep.expense_id.in_(ids)))
+    await db.execute(delete(Expense).where(Expense.id.in_(ids)))
+    # Too old to be duplicated; their suspects stay readable
+    await forget(db, ids, suspects=False)
+    return rows
+
+async def check_ids_not_reused(db: AsyncSession):
+    """
+    Archived ids must never be handed out again. SQLite only guarantees that
+    for AUTOINCREMENT tables, which `expenses` is unless the database predates it.
+    """
+    if db.bind.dialect.name != "sqlite":
+        return
+    schema = (await db.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'expenses'")
+    )).scalar_one()
+    if "AUTOINCREMENT" not in schema.upper():
+        raise RuntimeError(
+            "expenses was created without AUTOINCREMENT, so SQLite may reuse archived ids; "
+            "run create_tables (or start the app) to rebuild it before archiving"
+        )
+
+async def archive_expenses(
+    older_than_days: int = config.ARCHIVE_AFTER_DAYS,
+    chunk_size: int = config.ARCHIVE_CHUNK_SIZE,
+    max_chunks: Optional[int] = None,
+) -> ArchiveResult:
+    """Archive decided expenses older than `older_than_days`, one transaction per chunk"""
+    async with AsyncSessionLocal() as db:
+        await check_ids_not_reused(db)
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archived = chunks = 0
+    while max_chunks is None or chunks < max_chunks:
+        async with AsyncSessionLocal() as db:
+            try:
+                rows = await archive_chunk(db, cutoff, chunk_size)
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+        if not rows:
+            break
+        chunks += 1
+        archived += len(rows)
+        # Cached pages were read from the hot table alone
+        await response_cache.invalidate(
+            {EXPENSES_TAG}
+            | {owner_tag(row.owner_id) for row in rows}
+            | {expense_tag(row.id) for row in rows}
+        )
+        logger.info("Archived %d expenses (%d so far)", len(rows), archived)
+    return ArchiveResult(archived, chunks)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--older-than-days", type=int, default=config.ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--chunk-size", type=int, default=config.ARCHIVE_CHUNK_SIZE)
+    parser.add_argument("--max-chunks", type=int, default=None, help="Stop after this many chunks; run again to continue")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s:     %(message)s")
+    logger.setLevel(logging.INFO)
+
+    from database import async_engine, create_tables, engine
+    from cache import redis_backend
+
+    async def run() -> ArchiveResult:
+        try:
+            if config.REDIS_URL:
+                # Invalidate the workers' shared cache as chunks move
+                response_cache.use_backend(redis_backend(config.REDIS_URL))
+            return await archive_expenses(args.older_than_days, args.chunk_size, args.max_chunks)
+        finally:
+            await async_engine.dispose()
+
+    # Creates the archive tables on databases that predate them
+    create_tables()
+    engine.dispose()
+    try:
+        result = asyncio.run(run())
+    except RuntimeError as e:
+        parser.error(str(e))
+    logger.info("Done: %d expenses archived in %d chunks", result.archived, result.chunks)
+
+if __name__ == "__main__":
+    main()
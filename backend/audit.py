@@ -0,0 +1,249 @@
+"""
+Append-only audit trail of expense changes (expense_events).
+
+Every expense write records who made which change, with the changed
+fields before and after and any approval comments. Handlers call
+audit_log.record() inside their transaction; what happens next depends on
+AUDIT_DURABLE:
+
+- off (default): the events are staged on the session and handed to an
+  in-process buffer when the transaction commits, or dropped if it rolls
+  back. A background writer inserts the buffer in batches of
+  AUDIT_BATCH_SIZE every AUDIT_FLUSH_INTERVAL_MS, so a request pays for a
+  list append. Events still buffered when a worker dies are lost. A failed
+  batch is retried on the next ticks; after AUDIT_MAX_ATTEMPTS failures it
+  is written row by row and only the rows the database refuses are logged
+  and dropped. At most AUDIT_MAX_BUFFERED events wait in memory; beyond
+  that the oldest are dropped, so an outage cannot exhaust the worker.
+- on: the events are inserted in the writing transaction itself and commit
+  or roll back with the change. One extra statement per request, nothing
+  left in memory.
+
+Rows are only ever inserted. expense_id and actor_id carry no foreign keys,
+so the trail outlives deleted expenses and users. The query API flushes
+this worker's buffer before reading, so callers see their own changes.
+"""
+import asyncio
+import enum
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Mapping, Optional
+
+from sqlalchemy import event, insert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import config
+from database import async_engine
+from metrics import Counter, registry
+from models import AuditAction, ExpenseEvent
+
+logger = logging.getLogger(__name__)
+
+# Expense columns captured in before/after values
+AUDITED_FIELDS = ("amount", "currency", "date", "description", "status", "owner_id")
+
+# Session.info key for events waiting on their transaction
+STAGED = "audit_events"
+
+WRITTEN = registry.register(Counter("audit_events_written_total", "Audit events inserted into expense_events"))
+FLUSH_FAILURES = registry.register(Counter("audit_flush_failures_total", "Audit batches that failed and were kept for retry"))
+DROPPED = registry.register(Counter(
+    "audit_events_dropped_total", "Audit events given up on: refused by the database or over the buffer cap", ("reason",)
+))
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+def snapshot(values: Mapping[str, Any]) -> Dict[str, Any]:
+    """JSON-ready audited fields from a row mapping (bulk inserts)"""
+    return {field: _plain(values[field]) for field in AUDITED_FIELDS if field in values}
+
+def expense_snapshot(expense) -> Dict[str, Any]:
+    """JSON-ready audited fields of an Expense"""
+    return {field: _plain(getattr(expense, field)) for field in AUDITED_FIELDS}
+
+def audit_entry(
+    action: AuditAction,
+    expense_id: int,
+    actor_id: Optional[int],
+    before: Optional[Dict[str, Any]] = None,
+    after: Optional[Dict[str, Any]] = None,
+    comments: Optional[str] = None,
+) -> dict:
+    """One expense_events row; updates keep only the fields that changed"""
+    if before is not None and after is not None and action == AuditAction.UPDATED:
+        changed = [field for field in after if before.get(field) != after[field]]
+        before = {field: before.get(field) for field in changed}
+        after = {field: after[field] for field in changed}
+    return {
+        "expense_id": expense_id,
+        "actor_id": actor_id,
+        "action": action,
+        "comments": comments,
+        "before_values": before,
+        "after_values": after,
+        "created_at": datetime.utcnow(),
+    }
+
+def _unreachable(error: Exception) -> bool:
+    """Whether `error` says the database is down or busy, as opposed to refusing the row"""
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    return isinstance(error, (OperationalError, InterfaceError, OSError))
+
+class AuditLog:
+    """Buffers committed audit events and inserts them in batches"""
+
+    def __init__(
+        self,
+        durable: bool = config.AUDIT_DURABLE,
+        batch_size: int = config.AUDIT_BATCH_SIZE,
+        flush_interval: float = config.AUDIT_FLUSH_INTERVAL_MS / 1000,
+        max_attempts: int = config.AUDIT_MAX_ATTEMPTS,
+        max_buffered: int = config.AUDIT_MAX_BUFFERED,
+    ):
+        self.durable = durable
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.max_buffered = max_buffered
+        self._buffer: List[dict] = []
+        # Failed attempts at the batch at the head of the buffer
+        self._attempts = 0
+        # Length of that batch while it is being written
+        self._writing = 0
+        self._lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def record(self, db: AsyncSession, entries: List[dict]):
+        """Record `entries` as part of `db`'s current transaction"""
+        if not entries:
+            return
+        if self.durable:
+            await db.execute(insert(ExpenseEvent), entries)
+            # Counted before the commit; a rollback still shows up here
+            WRITTEN.inc(amount=len(entries))
+        else:
+            # Begins the transaction if nothing has yet, so its commit or rollback is seen
+            await db.connection()
+            db.info.setdefault(STAGED, []).extend(entries)
+
+    def _committed(self, session: Session):
+        entries = session.info.pop(STAGED, None)
+        if entries:
+            self._buffer.extend(entries)
+            overflow = len(self._buffer) - self.max_buffered
+            if overflow > 0:
+                # Oldest first, sparing the batch being written
+                del self._buffer[self._writing:self._writing + overflow]
+                DROPPED.inc("overflow", amount=overflow)
+                logger.error("Audit buffer full: dropped the %d oldest events", overflow)
+            if len(self._buffer) >= self.batch_size:
+                self._wake.set()
+
+    def _rolled_back(self, session: Session):
+        session.info.pop(STAGED, None)
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    async def flush(self):
+        """Insert everything buffered so far, one batch at a time"""
+        async with self._lock:
+            while self._buffer:
+                # The batch stays at the head of the buffer until it is written;
+                # events committed meanwhile are appended behind it
+                batch = self._buffer[:self.batch_size]
+                self._writing = len(batch)
+                try:
+                    if self._attempts < self.max_attempts:
+                        try:
+                            async with async_engine.begin() as connection:
+                                await connection.execute(insert(ExpenseEvent), batch)
+                        except Exception:
+                            self._attempts += 1
+                            FLUSH_FAILURES.inc()
+                            logger.exception(
+                                "Failed to write %d audit events (attempt %d of %d)",
+                                len(batch), self._attempts, self.max_attempts,
+                            )
+                            return
+                        del self._buffer[:len(batch)]
+                        WRITTEN.inc(amount=len(batch))
+                    elif not await self._write_rows(batch):
+                        return
+                    self._attempts = 0
+                finally:
+                    self._writing = 0
+
+    async def _write_rows(self, batch: List[dict]) -> bool:
+        """
+        Insert the head `batch` one row per transaction, dropping the rows the
+        database refuses. Stops, returning False, at the first sign that the
+        database itself is unavailable.
+        """
+        for row in batch:
+            try:
+                async with async_engine.begin() as connection:
+                    await connection.execute(insert(ExpenseEvent), [row])
+            except Exception as e:
+                if _unreachable(e):
+                    logger.error("Database unavailable; %d audit events left for the next flush", self._writing)
+                    return False
+                self._drop(row)
+            else:
+                WRITTEN.inc()
+            del self._buffer[0]
+            self._writing -= 1
+        return True
+
+    def _drop(self, row: dict):
+        DROPPED.inc("rejected")
+        logger.exception("Dropped an audit event the database refuses: %r", row)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer and flush what is left"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+audit_log = AuditLog()
+
+@event.listens_for(Session, "after_commit")
+def _hand_over_committed(session: Session):
+    audit_log._committed(session)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_rolled_back(session: Session, previous_transaction):
+    audit_log._rolled_back(session)
+
+def _collect_audit_stats():
+    yield "audit_events_buffered", "gauge", "Committed audit events waiting for the writer", [({}, audit_log.buffered)]
+
+registry.add_collector(_collect_audit_stats)
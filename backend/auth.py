@@ -0,0 +1,203 @@
+"""
+Authentication: bearer JWTs, the principal cache and password hashing.
+
+POST /api/auth/login checks an email and password and returns an access
+token signed with JWT_SECRET, carrying the user id (sub), a random token id
+(jti) and the expiry. Every API router depends on get_current_principal,
+which reads the token from the Authorization header or, for EventSource and
+WebSocket clients that cannot set headers, from ?access_token=.
+
+Verifying the signature and loading the user's role happen once per token:
+the resulting Principal is cached for AUTH_CACHE_TTL seconds, never past
+the token's expiry. The cache key is the SHA-256 of the whole token rather
+than its jti, which is readable by anyone holding the token; a forged token
+reusing a real jti therefore misses the cache and fails verification.
+Steady-state requests cost one hash and a dictionary lookup, which rate
+limiting reuses (cached_principal) to find the user behind a token without
+verifying it.
+
+A role change calls invalidate_user(), which records when that user changed
+so principals cached before then are ignored. The record only has to
+outlive those principals, so it expires after AUTH_CACHE_TTL and the
+records stay as bounded as the cache. It is per process: the worker that
+handled the change applies it at once, while every other worker may keep
+serving the old role for up to AUTH_CACHE_TTL seconds, until its cached
+entry expires. Lower AUTH_CACHE_TTL to shorten that window.
+
+bcrypt runs in the thread pool for hashing and checking, so a login does
+not stall the event loop for the few hundred milliseconds a hash takes.
+"""
+import hashlib
+import logging
+import secrets
+import time
+from typing import NamedTuple, Optional
+
+import bcrypt
+from fastapi import Depends, HTTPException, WebSocketException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.requests import HTTPConnection
+from fastapi.security import HTTPBearer
+from jose import JWTError, jwt
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from cache import MISSING, TTLCache
+from database import get_async_db
+from metrics import registry
+from models import User, UserRole
+
+logger = logging.getLogger(__name__)
+
+if config.JWT_SECRET:
+    SECRET = config.JWT_SECRET
+else:
+    SECRET = secrets.token_urlsafe(32)
+    logger.warning("JWT_SECRET is not set: tokens are signed with a per-process key and die with it")
+
+class Principal(NamedTuple):
+    """The authenticated caller"""
+    user_id: int
+    role: UserRole
+
+    @property
+    def is_admin(self) -> bool:
+        return self.role == UserRole.ADMIN
+
+    @property
+    def can_approve(self) -> bool:
+        return self.role in (UserRole.MANAGER, UserRole.ADMIN)
+
+# Token digest -> (time.monotonic() when the user was loaded, Principal)
+_principals = TTLCache(maxsize=config.AUTH_CACHE_SIZE, ttl=config.AUTH_CACHE_TTL)
+# User id -> time.monotonic() of their last invalidate_user; principals loaded
+# before it are ignored, and by the time it expires they have expired too
+_invalidated = TTLCache(maxsize=config.AUTH_CACHE_SIZE, ttl=config.AUTH_CACHE_TTL)
+
+def invalidate_user(user_id: int):
+    """Drop cached principals of a user whose role or account changed"""
+    if len(_invalidated) >= _invalidated.maxsize:
+        # Making room would forget another user's change before their principals expire
+        _principals.clear()
+    _invalidated.set(user_id, time.monotonic())
+
+def _collect_auth_stats():
+    for name in ("hits", "misses"):
+        yield f"auth_principal_cache_{name}_total", "counter", f"Principal cache {name}", [({}, _principals.counters[name])]
+
+registry.add_collector(_collect_auth_stats)
+
+# Passwords
+
+def hash_password(password: str) -> str:
+    """bcrypt hash; blocks for BCRYPT_ROUNDS, so call it through run_in_threadpool"""
+    encoded = password.encode()
+    if len(encoded) > 72:
+        # bcrypt ignores everything past 72 bytes; refuse rather than truncate silently
+        raise ValueError("Password must be at most 72 bytes")
+    return bcrypt.hashpw(encoded, bcrypt.gensalt(config.BCRYPT_ROUNDS)).decode()
+
+def verify_password(password: str, password_hash: Optional[str]) -> bool:
+    encoded = password.encode()
+    if len(encoded) > 72 or not password_hash:
+        return False
+    return bcrypt.checkpw(encoded, password_hash.encode())
+
+_dummy_hash: Optional[str] = None
+
+async def check_credentials(db: AsyncSession, email: str, password: str) -> Optional[User]:
+    """The user with this email and password, or None"""
+    global _dummy_hash
+    user = (await db.execute(select(User).where(User.email == email))).scalar_one_or_none()
+    if user is None or not user.password_hash:
+        # Spend the same time as a real check so response times do not reveal which emails exist
+        if _dummy_hash is None:
+            _dummy_hash = await run_in_threadpool(hash_password, secrets.token_urlsafe(16))
+        await run_in_threadpool(verify_password, password, _dummy_hash)
+        return None
+    if not await run_in_threadpool(verify_password, password, user.password_hash):
+        return None
+    return user
+
+# Tokens
+
+def create_access_token(user_id: int, expires_minutes: int = config.JWT_EXPIRE_MINUTES) -> str:
+    now = int(time.time())
+    claims = {"sub": str(user_id), "jti": secrets.token_urlsafe(12), "iat": now, "exp": now + expires_minutes * 60}
+    return jwt.encode(claims, SECRET, algorithm=config.JWT_ALGORITHM)
+
+def _unauthorized(connection: HTTPConnection, detail: str):
+    if connection.scope["type"] == "websocket":
+        return WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=detail)
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"}
+    )
+
+async def _load_principal(db: AsyncSession, user_id: int) -> Optional[Principal]:
+    row = (await db.execute(select(User.id, User.role).where(User.id == user_id))).first()
+    return Principal(row.id, row.role) if row else None
+
+def cached_principal(token: str) -> Optional[Principal]:
+    """The principal of a token verified earlier and still cached, without verifying anything"""
+    entry = _principals.get(hashlib.sha256(token.encode()).digest())
+    if entry is not MISSING:
+        loaded_at, principal = entry
+        if loaded_at > _invalidated.get(principal.user_id, float("-inf")):
+            return principal
+    return None
+
+async def authenticate(connection: HTTPConnection, db: AsyncSession, token: str) -> Principal:
+    """Principal for a bearer token, verifying it only when it is not cached"""
+    principal = cached_principal(token)
+    if principal is not None:
+        return principal
+
+    try:
+        claims = jwt.decode(token, SECRET, algorithms=[config.JWT_ALGORITHM])
+        user_id = int(claims["sub"])
+        expires_at = float(claims["exp"])
+    except (JWTError, KeyError, TypeError, ValueError):
+        raise _unauthorized(connection, "Invalid or expired token")
+
+    # Taken before the lookup, so a role change racing it leaves a stale entry that is never used
+    loaded_at = time.monotonic()
+    principal = await _load_principal(db, user_id)
+    if principal is None:
+        raise _unauthorized(connection, "Unknown user")
+    # Counted from loaded_at, so the entry never outlives an invalidation that raced the lookup
+    ttl = min(config.AUTH_CACHE_TTL - (time.monotonic() - loaded_at), expires_at - time.time())
+    if ttl > 0:
+        _principals.set(hashlib.sha256(token.encode()).digest(), (loaded_at, principal), ttl)
+    return principal
+
+def request_token(connection: HTTPConnection) -> Optional[str]:
+    scheme, _, token = connection.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        return token
+    return connection.query_params.get("access_token")
+
+class BearerToken(HTTPBearer):
+    """The bearer token from the Authorization header or ?access_token=; documented in OpenAPI as HTTP bearer"""
+
+    async def __call__(self, connection: HTTPConnection) -> Optional[str]:
+        return request_token(connection)
+
+bearer_token = BearerToken(auto_error=False)
+
+async def get_current_principal(
+    connection: HTTPConnection,
+    token: Optional[str] = Depends(bearer_token),
+    db: AsyncSession = Depends(get_async_db)
+) -> Principal:
+    """Dependency for every authenticated route"""
+    if token:
+        return await authenticate(connection, db, token)
+    if config.AUTH_DEV_USER_ID:
+        # Development only: act as a fixed user when no token is sent
+        principal = await _load_principal(db, config.AUTH_DEV_USER_ID)
+        if principal is not None:
+            return principal
+    raise _unauthorized(connection, "Not authenticated")
@@ -0,0 +1,2 @@
+# Benchmark scripts for the backend. Run from the backend directory, e.g.
+#   python -m benchmarks.bench_export --rows 1000000
@@ -0,0 +1,512 @@
+"""
+API load test.
+
+Seeds a scratch SQLite database with synthetic users and expenses, then
+drives the real app and reports throughput, p50/p95/p99 latency, errors and
+peak RSS per scenario:
+
+  list_all    GET  /api/expenses/all, first page, varying status and sort
+  list_mine   GET  /api/expenses/mine
+  pending     GET  /api/approvals/pending
+  export      GET  /api/expenses/export for a one-month window
+  approve     POST /api/approvals/{id} on distinct pending expenses
+  create      POST /api/expenses
+
+Two transports: "asgi" calls the app in-process through httpx.ASGITransport
+(the app and the clients share one event loop and process), "uvicorn" starts
+`uvicorn main:app --workers N` and goes over loopback HTTP, with RSS summed
+over the server's process tree.
+
+Each dataset is seeded once into seed_<rows>.db under --data-dir and copied
+for every run, so runs start from identical data (the random generators are
+seeded too). Every (rows, transport) pair runs in its own process.
+
+Results are written to --output as JSON. Given --baseline, each scenario
+is compared with the baseline's: a throughput drop or p95 increase beyond
+--max-regression fails the run with exit status 1.
+
+    python -m benchmarks.bench_api --rows 10000 --mode asgi --mode uvicorn --output results.json
+    python -m benchmarks.bench_api --rows 1000000 --baseline results.json --max-regression 0.15
+    python -m benchmarks.bench_api --rows 10000000 --requests 5000 --clients 100 --no-cache
+
+Requires httpx (and uvicorn for --mode uvicorn). RSS sampling reads /proc,
+so peak RSS is only reported on Linux.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ["list_all", "list_mine", "pending", "export", "approve", "create"]
+READ_SCENARIOS = {"list_all", "list_mine", "pending", "export"}
+
+# Dataset shape
+START_DATE = datetime(2022, 1, 1)
+SPAN_DAYS = 3 * 365
+REPORTEES = 50  # Users managed by user 1, who the benchmark authenticates as
+MINE_ROWS = 1000  # Expenses owned by user 1
+SEED_CHUNK = 50_000
+STATUS_WEIGHTS = [("APPROVED", 70), ("REJECTED", 15), ("PENDING", 15)]  # ExpenseStatus names
+CURRENCIES = ["USD", "USD", "USD", "EUR", "GBP", "INR"]
+# The app under test verifies the clients' bearer token with this key
+JWT_SECRET = "bench-api"
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def sqlite_url(path: str) -> str:
+    return f"sqlite:///{os.path.abspath(path)}"
+
+def auth_headers() -> dict:
+    """Bearer token for user 1, the admin and approver all scenarios run as"""
+    from jose import jwt
+    token = jwt.encode({"sub": "1", "jti": "bench", "exp": int(time.time()) + 86400}, JWT_SECRET, algorithm="HS256")
+    return {"Authorization": f"Bearer {token}"}
+
+def app_environment(db_path: str, no_cache: bool) -> dict:
+    env = dict(os.environ, DATABASE_URL=sqlite_url(db_path), PYTHONPATH=BACKEND_DIR)
+    env.pop("ASYNC_DATABASE_URL", None)
+    # The load generator is a single client flooding the API, exactly what the limits refuse
+    env.update(RATE_LIMIT_ENABLED="0", JWT_SECRET=JWT_SECRET, JWT_ALGORITHM="HS256")
+    if no_cache:
+        env["RESPONSE_CACHE_TTL"] = "0"
+    return env
+
+# Seeding
+
+def seed(db_path: str, rows: int):
+    """Create the schema and insert `rows` expenses; runs in a child process pointed at db_path"""
+    from sqlalchemy import insert, text
+    from database import SessionLocal, create_tables, engine
+    from models import Expense, ExpenseStatus, User, UserRole
+    from summaries import rebuild_summaries
+
+    create_tables()
+    rng = random.Random(42)
+    users = max(100, min(20_000, rows // 500))
+    statuses = [ExpenseStatus[name] for name, weight in STATUS_WEIGHTS for _ in range(weight)]
+
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": 1, "name": "bench", "email": "bench@example.com", "role": UserRole.ADMIN}])
+        conn.execute(insert(User), [
+            {
+                "id": user_id,
+                "name": f"user{user_id}",
+                "email": f"user{user_id}@example.com",
+                "role": UserRole.EMPLOYEE,
+                # The first REPORTEES users report to user 1, the rest to one of their own managers
+                "manager_id": 1 if user_id <= REPORTEES + 1 else REPORTEES + 2,
+            }
+            for user_id in range(2, users + 1)
+        ])
+
+    mine_every = max(1, rows // MINE_ROWS)
+    step = timedelta(days=SPAN_DAYS) / max(rows, 1)
+    started = time.perf_counter()
+    for offset in range(0, rows, SEED_CHUNK):
+        count = min(SEED_CHUNK, rows - offset)
+        with engine.begin() as conn:
+            conn.execute(insert(Expense), [
+                {
+                    "amount": round(rng.uniform(1, 2000), 2),
+                    "currency": rng.choice(CURRENCIES),
+                    "date": START_DATE + step * (offset + i),
+                    "description": f"{rng.choice(['Hotel', 'Taxi', 'Dinner', 'Flight', 'Supplies'])} {offset + i}",
+                    "status": rng.choice(statuses),
+                    "owner_id": 1 if (offset + i) % mine_every == 0 else rng.randint(2, users),
+                    "created_at": START_DATE + step * (offset + i),
+                }
+                for i in range(count)
+            ])
+        print(f"  seeded {offset + count:,}/{rows:,} rows ({time.perf_counter() - started:.0f}s)", flush=True)
+
+    db = SessionLocal()
+    try:
+        rebuild_summaries(db)
+    finally:
+        db.close()
+    with engine.connect() as conn:
+        # Fold the WAL into the main file so copying the .db alone is enough
+        conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+    engine.dispose()
+
+def ensure_seed(data_dir: str, rows: int, reseed: bool) -> str:
+    path = os.path.join(data_dir, f"seed_{rows}.db")
+    if os.path.exists(path) and not reseed:
+        return path
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+    print(f"seeding {rows:,} rows into {path}", flush=True)
+    subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_api", "_seed", "--db", path, "--rows", str(rows)],
+        cwd=BACKEND_DIR, env=app_environment(path, no_cache=False), check=True,
+    )
+    return path
+
+def fresh_copy(seed_path: str, run_dir: str) -> str:
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    path = os.path.join(run_dir, "bench.db")
+    shutil.copyfile(seed_path, path)
+    return path
+
+# Memory
+
+def _rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def _process_tree(root: int) -> list:
+    """root and its descendants, from the parent pids in /proc/*/stat"""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as handle:
+                    # The command name may contain spaces; fields resume after its closing parenthesis
+                    parents[int(entry)] = int(handle.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+    tree, frontier = {root}, [root]
+    while frontier:
+        parent = frontier.pop()
+        children = [pid for pid, ppid in parents.items() if ppid == parent and pid not in tree]
+        tree.update(children)
+        frontier.extend(children)
+    return sorted(tree)
+
+class RssSampler:
+    """Peak resident memory of a process tree, sampled while a scenario runs"""
+
+    def __init__(self, root_pid: int, interval: float = 0.1):
+        self.root_pid = root_pid
+        self.interval = interval
+        self.available = os.path.isdir("/proc")
+        self._pids = []
+        self._peak = 0
+        self._task = None
+
+    def start(self):
+        if not self.available:
+            return
+        self._pids = _process_tree(self.root_pid)
+        self._peak = 0
+        self._task = asyncio.ensure_future(self._sample())
+
+    async def _sample(self):
+        while True:
+            self._peak = max(self._peak, sum(_rss_bytes(pid) for pid in self._pids))
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        if self._task is None:
+            return None
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._peak = max(self._peak, sum(_rss_bytes(pid) for pid in self._pids))
+        return round(self._peak / 2**20, 1)
+
+# Load generation
+
+def scenario_requests(name: str, count: int, rng: random.Random, pending_ids: list):
+    """(method, url, json body) for each request of a scenario"""
+    if name == "list_all":
+        return [
+            ("GET", f"/api/expenses/all?limit=100&sort={rng.choice(['-date', 'date', '-amount'])}"
+                    + rng.choice(["", "&status=Pending", "&status=Approved"]), None)
+            for _ in range(count)
+        ]
+    if name == "list_mine":
+        return [("GET", "/api/expenses/mine", None)] * count
+    if name == "pending":
+        return [("GET", "/api/approvals/pending?limit=100", None)] * count
+    if name == "export":
+        requests = []
+        for _ in range(count):
+            month = START_DATE + timedelta(days=rng.randrange(SPAN_DAYS - 31))
+            window = f"date_from={month:%Y-%m-%dT00:00:00}&date_to={month + timedelta(days=30):%Y-%m-%dT00:00:00}"
+            requests.append(("GET", f"/api/expenses/export?{window}", None))
+        return requests
+    if name == "approve":
+        return [("POST", f"/api/approvals/{expense_id}", {"status": "Approved"}) for expense_id in pending_ids[:count]]
+    if name == "create":
+        return [
+            ("POST", "/api/expenses/", {
+                "amount": round(rng.uniform(1, 2000), 2),
+                "currency": rng.choice(CURRENCIES),
+                "date": f"{START_DATE + timedelta(days=rng.randrange(SPAN_DAYS)):%Y-%m-%dT00:00:00}",
+                "description": f"Bench create {i}",
+            })
+            for i in range(count)
+        ]
+    raise ValueError(f"Unknown scenario {name}")
+
+async def collect_pending_ids(client, needed: int) -> list:
+    """Ids from the caller's pending queue, oldest first"""
+    ids, cursor = [], None
+    while len(ids) < needed:
+        url = "/api/approvals/pending?limit=1000" + (f"&cursor={cursor}" if cursor else "")
+        page = (await client.get(url)).json()
+        ids.extend(item["id"] for item in page["items"])
+        cursor = page.get("next_cursor")
+        if not cursor:
+            break
+    return ids[:needed]
+
+async def run_scenario(client, name: str, requests: list, clients: int, sampler: RssSampler) -> dict:
+    latencies, errors, size = [], 0, 0
+    queue = list(reversed(requests))
+
+    async def worker():
+        nonlocal errors, size
+        while queue:
+            method, url, body = queue.pop()
+            started = time.perf_counter()
+            try:
+                async with client.stream(method, url, json=body) as response:
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                if response.status_code >= 400:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    sampler.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(clients, len(requests)))))
+    elapsed = time.perf_counter() - started
+    peak_rss = await sampler.stop()
+
+    if not latencies:
+        return {"requests": 0, "errors": 0}
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "bytes": size,
+        "peak_rss_mb": peak_rss,
+    }
+
+async def drive(client, args, sampler: RssSampler) -> dict:
+    rng = random.Random(11)
+    scenarios = args.scenario or SCENARIOS
+    counts = {name: args.export_requests if name == "export" else args.requests for name in scenarios}
+
+    pending_ids = await collect_pending_ids(client, counts["approve"]) if "approve" in counts else []
+    for name in scenarios:
+        if name in READ_SCENARIOS and args.warmup:
+            await run_scenario(client, name, scenario_requests(name, args.warmup, rng, pending_ids), args.clients, sampler)
+
+    results = {}
+    for name in scenarios:
+        requests = scenario_requests(name, counts[name], rng, pending_ids)
+        results[name] = await run_scenario(client, name, requests, args.clients, sampler)
+        print_result(name, results[name])
+    return results
+
+def print_result(name: str, result: dict):
+    if not result.get("requests"):
+        print(f"    {name:<10} no requests (nothing to run)")
+        return
+    rss = f"{result['peak_rss_mb']:>7.0f} MB" if result.get("peak_rss_mb") else "      n/a"
+    print(f"    {name:<10} {result['requests']:>6} req  {result['throughput_rps']:>8,.0f} req/s  "
+          f"p50 {result['p50_ms']:>7.1f}ms  p95 {result['p95_ms']:>7.1f}ms  p99 {result['p99_ms']:>7.1f}ms  "
+          f"err {result['errors']:<4} rss {rss}", flush=True)
+
+# Transports
+
+async def run_asgi(args) -> dict:
+    """Body of the `_asgi` child: the app is imported against the copied database"""
+    import httpx
+    from main import app
+
+    # ASGITransport sends no lifespan events, so the app's startup and shutdown run here
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", headers=auth_headers(), timeout=None) as client:
+            return await drive(client, args, RssSampler(os.getpid()))
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def run_uvicorn(args, db_path: str, run_dir: str) -> dict:
+    import httpx
+
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+            "--host", "127.0.0.1", "--port", str(port), "--workers", str(args.workers),
+            "--log-level", "warning", "--no-access-log",
+        ],
+        cwd=run_dir, env=app_environment(db_path, args.no_cache),
+    )
+    try:
+        limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", headers=auth_headers(), limits=limits, timeout=None
+        ) as client:
+            deadline = time.monotonic() + 120
+            while True:
+                if server.poll() is not None:
+                    raise RuntimeError(f"uvicorn exited with status {server.returncode}")
+                try:
+                    if (await client.get("/health")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError("uvicorn did not become healthy within 120s")
+                await asyncio.sleep(0.5)
+            return await drive(client, args, RssSampler(server.pid))
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+def run_one(args, rows: int, mode: str, seed_path: str) -> dict:
+    run_dir = os.path.join(args.data_dir, f"run_{rows}_{mode}")
+    db_path = fresh_copy(seed_path, run_dir)
+    print(f"  {mode}", flush=True)
+    if mode == "uvicorn":
+        return asyncio.run(run_uvicorn(args, db_path, run_dir))
+
+    result_path = os.path.join(run_dir, "result.json")
+    command = [sys.executable, "-m", "benchmarks.bench_api", "_asgi", "--result", result_path] + forwarded_options(args)
+    # The child starts in the run directory so receipts and other relative paths land there
+    subprocess.run(command, cwd=run_dir, env=app_environment(db_path, args.no_cache), check=True)
+    with open(result_path) as handle:
+        return json.load(handle)
+
+def forwarded_options(args) -> list:
+    options = [
+        "--clients", str(args.clients), "--requests", str(args.requests),
+        "--export-requests", str(args.export_requests), "--warmup", str(args.warmup),
+    ]
+    for name in args.scenario or []:
+        options += ["--scenario", name]
+    return options
+
+# Reporting
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Scenarios whose throughput dropped or p95 rose by more than `threshold`"""
+    regressions = []
+    if baseline["meta"].get("no_cache") != results["meta"].get("no_cache"):
+        print("warning: the baseline was recorded with a different response cache setting")
+    print(f"\ncomparison with baseline {baseline['meta'].get('revision')} (threshold {threshold:.0%})")
+    for key, current in sorted(results["results"].items()):
+        previous = baseline["results"].get(key)
+        if not previous or not previous.get("requests") or not current.get("requests"):
+            continue
+        throughput = current["throughput_rps"] / previous["throughput_rps"] - 1
+        p95 = current["p95_ms"] / previous["p95_ms"] - 1 if previous["p95_ms"] else 0.0
+        failed = throughput < -threshold or p95 > threshold
+        if failed:
+            regressions.append(key)
+        print(f"  {key:<28} throughput {throughput:+7.1%}  p95 {p95:+7.1%}  {'REGRESSION' if failed else 'ok'}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "_seed", "_asgi"], help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, action="append", help="Dataset sizes, e.g. 10000, 1000000, 10000000 (repeatable)")
+    parser.add_argument("--mode", action="append", choices=["asgi", "uvicorn"], help="Transports to run (repeatable; default asgi)")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Scenarios to run (repeatable; default all)")
+    parser.add_argument("--clients", type=int, default=50, help="Concurrent clients")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per scenario")
+    parser.add_argument("--export-requests", type=int, default=10, help="Requests for the export scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="Untimed requests per read scenario")
+    parser.add_argument("--workers", type=int, default=4, help="uvicorn worker processes")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the response cache (RESPONSE_CACHE_TTL=0)")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "bench_api"), help="Seed and run databases")
+    parser.add_argument("--reseed", action="store_true", help="Rebuild seed databases even if present")
+    parser.add_argument("--output", default="bench_api_results.json", help="Where to write the JSON results")
+    parser.add_argument("--baseline", help="Earlier results to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10, help="Allowed throughput drop / p95 increase (fraction)")
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.command == "_seed":
+        seed(args.db, args.rows[0])
+        return
+    if args.command == "_asgi":
+        results = asyncio.run(run_asgi(args))
+        with open(args.result, "w") as handle:
+            json.dump(results, handle)
+        return
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "recorded_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "clients": args.clients,
+            "requests": args.requests,
+            "export_requests": args.export_requests,
+            "workers": args.workers,
+            "no_cache": args.no_cache,
+        },
+        "results": {},
+    }
+    for rows in args.rows or [10_000]:
+        seed_path = ensure_seed(args.data_dir, rows, args.reseed)
+        print(f"{rows:,} rows", flush=True)
+        for mode in args.mode or ["asgi"]:
+            for name, result in run_one(args, rows, mode, seed_path).items():
+                results["results"][f"{mode}/{rows}/{name}"] = result
+
+    with open(args.output, "w") as handle:
+        json.dump(results, handle, indent=2, sort_keys=True)
+    print(f"\nresults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print(f"{len(regressions)} scenario(s) regressed beyond {args.max_regression:.0%}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
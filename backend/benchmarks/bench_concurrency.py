@@ -0,0 +1,107 @@
+"""
+Concurrent request latency benchmark.
+
+Seeds a scratch database, then drives the ASGI app in-process through
+httpx.ASGITransport with many concurrent clients and reports throughput and
+p50/p99 latency per route. Because the clients share one event loop with the
+app, any blocking database call shows up directly as tail latency.
+
+    python -m benchmarks.bench_concurrency --clients 200 --requests 20000
+
+Requires httpx.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def seed(rows: int):
+    """Insert synthetic expenses for the mocked current user"""
+    from sqlalchemy import insert
+    from database import engine
+    from models import Expense, ExpenseStatus, User, UserRole
+    from datetime import datetime, timedelta
+
+    rng = random.Random(7)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": 1, "name": "bench", "email": "bench@example.com", "role": UserRole.ADMIN}])
+        conn.execute(insert(Expense), [
+            {
+                "amount": round(rng.uniform(1, 500), 2),
+                "currency": "USD",
+                "date": datetime(2024, 1, 1) + timedelta(minutes=i),
+                "description": f"Bench expense {i}",
+                "status": ExpenseStatus.PENDING,
+                "owner_id": 1,
+            }
+            for i in range(rows)
+        ])
+
+async def run(clients: int, total: int, rows: int):
+    import httpx
+    from auth import create_access_token
+    from database import async_engine
+    from main import app
+
+    rng = random.Random(11)
+    routes = [
+        ("get_expense", lambda: f"/api/expenses/{rng.randint(1, rows)}"),
+        ("list_all", lambda: "/api/expenses/all?limit=50"),
+    ]
+    latencies = {name: [] for name, _ in routes}
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(routes[i % len(routes)])
+
+    async def worker(client):
+        while not queue.empty():
+            name, make_url = queue.get_nowait()
+            started = time.perf_counter()
+            response = await client.get(make_url())
+            latencies[name].append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    transport = httpx.ASGITransport(app=app)
+    headers = {"Authorization": f"Bearer {create_access_token(1)}"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", headers=headers) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(clients)))
+        elapsed = time.perf_counter() - started
+    await async_engine.dispose()
+
+    print(f"{total:,} requests, {clients} clients: {total / elapsed:,.0f} req/s")
+    for name, samples in latencies.items():
+        print(f"  {name:<12} n={len(samples):<6} mean={statistics.mean(samples) * 1000:7.1f}ms  "
+              f"p50={percentile(samples, 50) * 1000:7.1f}ms  p99={percentile(samples, 99) * 1000:7.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args()
+
+    # One client flooding the API is exactly what the rate limits refuse
+    os.environ["RATE_LIMIT_ENABLED"] = "0"
+    # The app opens ./expense_management.db, so run from a scratch directory
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(tempfile.mkdtemp(prefix="bench_concurrency_"))
+    import models  # noqa: F401  (registers the tables on Base)
+    from database import create_tables
+    create_tables()
+    seed(args.rows)
+
+    asyncio.run(run(args.clients, args.requests, args.rows))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Export throughput benchmark.
+
+Seeds a scratch SQLite database with synthetic expenses and streams them
+through the same batch reader and renderers used by GET /api/expenses/export,
+reporting rows per second and peak RSS for each format.
+
+    python -m benchmarks.bench_export --rows 1000000 --rows 10000000
+"""
+import argparse
+import os
+import random
+import resource
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from currency import converter
+from database import Base
+from export import gzip_stream, iter_expense_batches, render_csv, render_ndjson
+from models import Expense, ExpenseStatus, User, UserRole
+from pagination import ExpenseFilters
+
+SEED_CHUNK = 50_000
+CURRENCIES = ["USD", "EUR", "GBP", "INR", "JPY"]
+STATUSES = list(ExpenseStatus)
+
+def make_filters(**overrides) -> ExpenseFilters:
+    """Build an ExpenseFilters outside of a request."""
+    params = dict(status=None, owner_id=None, currency=None, date_from=None,
+                  date_to=None, min_amount=None, max_amount=None)
+    params.update(overrides)
+    return ExpenseFilters(**params)
+
+def synthetic_rates():
+    """Monthly rates for every non-base currency used by the seeder"""
+    rng = random.Random(3)
+    return [
+        (currency, datetime(year, month, 1).date(), round(rng.uniform(0.005, 1.5), 4))
+        for currency in CURRENCIES if currency != converter.base_currency
+        for year in range(2019, 2040)
+        for month in range(1, 13)
+    ]
+
+def seed(engine, rows: int, users: int = 1000):
+    """Insert `rows` synthetic expenses using chunked executemany."""
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    rng = random.Random(42)
+    start = datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {"id": i, "name": f"user{i}", "email": f"user{i}@example.com", "role": UserRole.EMPLOYEE}
+            for i in range(1, users + 1)
+        ])
+    for offset in range(0, rows, SEED_CHUNK):
+        count = min(SEED_CHUNK, rows - offset)
+        with engine.begin() as conn:
+            conn.execute(insert(Expense), [
+                {
+                    "amount": round(rng.uniform(1, 5000), 2),
+                    "currency": rng.choice(CURRENCIES),
+                    "date": start + timedelta(minutes=offset + i),
+                    "description": f"Synthetic expense {offset + i}",
+                    "status": rng.choice(STATUSES),
+                    "owner_id": rng.randint(1, users),
+                    "created_at": start,
+                }
+                for i in range(count)
+            ])
+
+def run_export(session_factory, fmt: str, compress: bool):
+    """Drain one export stream and return (rows, bytes, seconds)."""
+    db = session_factory()
+    try:
+        rows = 0
+        size = 0
+        started = time.perf_counter()
+
+        def counted(batches):
+            nonlocal rows
+            for batch in batches:
+                rows += len(batch)
+                yield batch
+
+        batches = counted(iter_expense_batches(db, make_filters()))
+        chunks = render_csv(batches) if fmt == "csv" else render_ndjson(batches)
+        for chunk in gzip_stream(chunks) if compress else chunks:
+            size += len(chunk)
+        return rows, size, time.perf_counter() - started
+    finally:
+        db.close()
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, action="append", help="Row counts to benchmark (repeatable)")
+    parser.add_argument("--db", default=None, help="Scratch database path (default: temp file)")
+    parser.add_argument("--gzip", action="store_true", help="Also measure gzip-compressed output")
+    args = parser.parse_args()
+    converter.use_loader(synthetic_rates)
+
+    for rows in args.rows or [1_000_000]:
+        path = args.db or os.path.join(tempfile.gettempdir(), f"bench_export_{rows}.db")
+        engine = create_engine(f"sqlite:///{path}")
+        session_factory = sessionmaker(bind=engine)
+
+        seeded = time.perf_counter()
+        seed(engine, rows)
+        print(f"seeded {rows:,} rows in {time.perf_counter() - seeded:.1f}s ({path})")
+
+        for fmt in ("ndjson", "csv"):
+            for compress in ([False, True] if args.gzip else [False]):
+                count, size, elapsed = run_export(session_factory, fmt, compress)
+                label = f"{fmt}{'+gzip' if compress else ''}"
+                print(f"  {label:<12} {count:>12,} rows  {count / elapsed:>12,.0f} rows/s  "
+                      f"{size / 1e6:>9.1f} MB  peak RSS {peak_rss_mb():.0f} MB")
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Listing serialization benchmark.
+
+Seeds a scratch SQLite database and renders the same N expenses as a JSON
+list three ways, reporting rows per second end to end (query, build,
+encode) and for building and encoding alone, where building includes the
+base-currency conversion:
+
+  orm+stdlib   ORM objects validated through List[ExpenseResponse] one by one
+               (from_attributes) and encoded with the stdlib json module, as
+               FastAPI and JSONResponse do for a response_model route
+  orm+adapter  the same objects through a precompiled TypeAdapter's dump_json
+  rows+orjson  selected columns as row tuples, dicts built by
+               pagination.expense_items and encoded by responses.dumps
+
+    python -m benchmarks.bench_serialization --rows 10000 --rows 100000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import List
+
+from pydantic import TypeAdapter
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.bench_export import seed, synthetic_rates
+from currency import attach_base_amounts, converter
+from models import Expense
+from pagination import EXPENSE_FIELDS, expense_items
+from responses import dumps, orjson
+from schemas import ExpenseResponse
+
+ADAPTER = TypeAdapter(List[ExpenseResponse])
+
+def orm_stdlib(db, rows: int):
+    expenses = db.execute(select(Expense).limit(rows)).scalars().all()
+    started = time.perf_counter()
+    attach_base_amounts(expenses)
+    content = ADAPTER.dump_python(ADAPTER.validate_python(expenses, from_attributes=True), mode="json")
+    body = json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+    return body, time.perf_counter() - started
+
+def orm_adapter(db, rows: int):
+    expenses = db.execute(select(Expense).limit(rows)).scalars().all()
+    started = time.perf_counter()
+    attach_base_amounts(expenses)
+    body = ADAPTER.dump_json(ADAPTER.validate_python(expenses, from_attributes=True))
+    return body, time.perf_counter() - started
+
+def rows_orjson(db, rows: int):
+    result = db.execute(select(*EXPENSE_FIELDS.values()).limit(rows)).all()
+    started = time.perf_counter()
+    body = dumps(expense_items(result))
+    return body, time.perf_counter() - started
+
+MODES = {"orm+stdlib": orm_stdlib, "orm+adapter": orm_adapter, "rows+orjson": rows_orjson}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, action="append", help="Rows per response (repeatable)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per mode; the best is reported")
+    parser.add_argument("--db", default=None, help="Scratch database path (default: temp file)")
+    args = parser.parse_args()
+    converter.use_loader(synthetic_rates)
+    sizes = args.rows or [10_000]
+    print(f"encoder: {'orjson ' + orjson.__version__ if orjson else 'stdlib json'}")
+
+    path = args.db or os.path.join(tempfile.gettempdir(), "bench_serialization.db")
+    engine = create_engine(f"sqlite:///{path}")
+    session_factory = sessionmaker(bind=engine)
+    seed(engine, max(sizes))
+
+    for rows in sizes:
+        print(f"{rows:,} rows")
+        for label, render in MODES.items():
+            best_total = best_encode = float("inf")
+            for _ in range(args.repeat):
+                # A fresh session per run so no mode reuses another's identity map
+                db = session_factory()
+                try:
+                    started = time.perf_counter()
+                    body, encode = render(db, rows)
+                    best_total = min(best_total, time.perf_counter() - started)
+                    best_encode = min(best_encode, encode)
+                finally:
+                    db.close()
+            print(f"  {label:<12} {rows / best_total:>12,.0f} rows/s end to end  "
+                  f"{rows / best_encode:>12,.0f} rows/s building and encoding  {len(body) / 1e6:>6.1f} MB")
+    engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas import FlaggedExpense
+
+# Rows validated and inserted per transaction during bulk ingestion
+BULK_CHUNK_SIZE = 1000
+
+class BulkRowError(BaseModel):
+    index: int
+    error: str
+
+class BulkResult(BaseModel):
+    inserted: int
+    failed: int
+    errors: List[BulkRowError]
+    flagged: List[FlaggedExpense] = []  # Inserted rows that look like duplicates
+
+async def iter_chunks(items: AsyncIterator[Any], size: int = BULK_CHUNK_SIZE) -> AsyncIterator[List[Any]]:
+    """Group an async iterator into lists of at most `size` items."""
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+async def iter_json_array(items: List[Any]) -> AsyncIterator[Tuple[int, Any]]:
+    """Expose an already parsed JSON array with the same shape as iter_ndjson."""
+    for index, item in enumerate(items):
+        yield index, item
+
+async def iter_ndjson(stream: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Parse an NDJSON request body incrementally, yielding (index, value).
+    Lines that are not valid JSON are yielded as the raised exception so the
+    caller can report them per row without aborting the stream.
+    """
+    buffer = b""
+    index = 0
+    async for data in stream:
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            yield index, _parse_line(line)
+            index += 1
+    if buffer.strip():
+        yield index, _parse_line(buffer)
+
+def _parse_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return e
+
+AfterInsert = Callable[[AsyncSession, List[Dict[str, Any]]], Awaitable[None]]
+
+async def insert_chunk(
+    db: AsyncSession,
+    table,
+    rows: List[Tuple[int, Dict[str, Any]]],
+    after_insert: Optional[AfterInsert] = None,
+) -> List[BulkRowError]:
+    """
+    Insert a chunk of (index, values) pairs with a single executemany in one
+    transaction. If the chunk fails, retry row by row so only the offending
+    rows are reported instead of the whole chunk. `after_insert` runs inside
+    the same transaction with the inserted values, including their new ids.
+    """
+    if not rows:
+        return []
+    try:
+        values = [values for _, values in rows]
+        ids = (await db.execute(insert(table).returning(table.id, sort_by_parameter_order=True), values)).scalars().all()
+        if after_insert:
+            await after_insert(db, [{**row, "id": row_id} for row, row_id in zip(values, ids)])
+        await db.commit()
+        return []
+    except Exception:
+        await db.rollback()
+
+    errors = []
+    for index, values in rows:
+        try:
+            row_id = (await db.execute(insert(table).returning(table.id), values)).scalar_one()
+            if after_insert:
+                await after_insert(db, [{**values, "id": row_id}])
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            errors.append(BulkRowError(index=index, error=str(e.__cause__ or e)))
+    return errors
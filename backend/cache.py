@@ -0,0 +1,369 @@
+"""
+In-process caches and the response cache for read endpoints.
+
+TTLCache is a small thread-safe LRU used for lookups such as exchange rates.
+
+ResponseCache keeps serialized JSON bodies of read endpoints, keyed by route,
+user and query parameters (cache_key). Every entry is filed under tags
+naming what it was built from (an expense, an owner's expenses, an
+approver's queue), and writes invalidate tags after they commit. A tag is a
+version token stored next to the entries: an entry records the tokens of
+its tags when its load starts and only counts as a hit while they are
+unchanged, so invalidation is one write per tag and a load that raced a
+write can never be served. The same scheme works unchanged on a cache
+shared by several workers.
+
+Concurrent misses on one key are coalesced: the first request loads, the
+others wait for its result.
+
+Backends: MemoryCacheBackend (the default, per process) and
+SharedCacheBackend, which adapts a client with the redis.asyncio get/mget/
+set(px=, nx=) signatures. FakeSharedClient implements those signatures in
+memory for tests and local runs; install a backend with
+response_cache.use_backend(). The app installs redis_backend() at startup
+when REDIS_URL is set, which several workers need to see each other's
+invalidations.
+"""
+import asyncio
+import hashlib
+import json
+import secrets
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, NamedTuple, Optional, Sequence, Set
+
+from fastapi import Request, Response
+
+import config
+from conditional import etag_matches, not_modified, set_etag
+from metrics import registry
+from responses import dumps
+
+# Sentinel for cache misses, so None can be cached as a value
+MISSING = object()
+
+class TTLCache:
+    """Thread-safe in-process LRU cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.counters["expirations"] += 1
+                self.counters["misses"] += 1
+                return default
+            self._data.move_to_end(key)
+            self.counters["hits"] += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class CacheBackend(ABC):
+    """Interface for response cache storage: bytes values with a per-key TTL"""
+
+    @abstractmethod
+    async def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        """Values for `keys` in order, None where missing or expired"""
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float):
+        pass
+
+    @abstractmethod
+    async def add(self, key: str, value: bytes, ttl: float) -> bool:
+        """Set `key` only if it is absent; True when this call set it"""
+
+    def stats(self) -> dict:
+        return {}
+
+class MemoryCacheBackend(CacheBackend):
+    """Per-process LRU; entries and tag tokens share one size bound"""
+
+    def __init__(self, maxsize: int = config.RESPONSE_CACHE_SIZE):
+        self._cache = TTLCache(maxsize=maxsize)
+
+    async def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        return [self._cache.get(key, None) for key in keys]
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self._cache.set(key, value, ttl)
+
+    async def add(self, key: str, value: bytes, ttl: float) -> bool:
+        # Nothing awaits between the check and the write, so this is atomic on the event loop
+        if self._cache.get(key, None) is not None:
+            return False
+        self._cache.set(key, value, ttl)
+        return True
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "size": len(self._cache), **{
+            name: self._cache.counters[name] for name in ("evictions", "expirations")
+        }}
+
+class SharedCacheBackend(CacheBackend):
+    """Adapts a redis.asyncio-style client; keys are namespaced by `prefix`"""
+
+    def __init__(self, client, prefix: str = "expenses:cache:"):
+        self._client = client
+        self._prefix = prefix
+
+    async def get_many(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        return list(await self._client.mget([self._prefix + key for key in keys]))
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self._client.set(self._prefix + key, value, px=int(ttl * 1000))
+
+    async def add(self, key: str, value: bytes, ttl: float) -> bool:
+        return bool(await self._client.set(self._prefix + key, value, px=int(ttl * 1000), nx=True))
+
+    def stats(self) -> dict:
+        return {"backend": type(self._client).__name__}
+
+def redis_backend(url: str) -> SharedCacheBackend:
+    """SharedCacheBackend over redis.asyncio; the redis package is only needed when REDIS_URL is set"""
+    import redis.asyncio
+    return SharedCacheBackend(redis.asyncio.from_url(url))
+
+class FakeSharedClient:
+    """In-memory stand-in for a shared cache client (get, mget, set with px/nx)"""
+
+    def __init__(self):
+        self._data: Dict[str, tuple] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._data.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return entry[0]
+
+    async def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        return [await self.get(key) for key in keys]
+
+    async def set(self, key: str, value: bytes, px: Optional[int] = None, nx: bool = False) -> Optional[bool]:
+        if nx and await self.get(key) is not None:
+            return None
+        expires_at = time.monotonic() + px / 1000 if px is not None else float("inf")
+        self._data[key] = (value, expires_at)
+        return True
+
+class CachedResponse(NamedTuple):
+    body: bytes  # Serialized JSON
+    etag: str
+
+    def encode(self, versions: Sequence[bytes]) -> bytes:
+        return b" ".join(versions) + b"\n" + self.etag.encode() + b"\n" + self.body
+
+    @classmethod
+    def decode(cls, raw: bytes) -> tuple:
+        versions, etag, body = raw.split(b"\n", 2)
+        return versions.split(b" ") if versions else [], cls(body, etag.decode())
+
+    def to_response(self, request: Request) -> Response:
+        """The body as JSON, or 304 when the client already holds it"""
+        if etag_matches(request, self.etag):
+            return not_modified(self.etag)
+        response = Response(content=self.body, media_type="application/json")
+        set_etag(response, self.etag)
+        return response
+
+def json_response(content: Any) -> CachedResponse:
+    """Serialize `content` and tag it with a weak ETag over the body"""
+    body = dumps(content)
+    digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+    return CachedResponse(body, f'W/"{digest}"')
+
+# Bumped when a cached response shape changes, so a shared cache never serves old bodies
+KEY_VERSION = 1
+
+def cache_key(route: str, user_id: Optional[int], **params: Any) -> str:
+    """Stable key for one route, caller and set of query parameters"""
+    encoded = json.dumps(params, sort_keys=True, default=str, separators=(",", ":"))
+    digest = hashlib.blake2b(encoded.encode(), digest_size=16).hexdigest()
+    return f"v{KEY_VERSION}:{route}:{user_id}:{digest}"
+
+# Tags; a write invalidates every tag its change can show up under
+EXPENSES_TAG = "expenses"  # Listings not narrowed to one owner
+PENDING_TAG = "pending"  # Every approval queue
+
+def expense_tag(expense_id: int) -> str:
+    return f"expense:{expense_id}"
+
+def owner_tag(owner_id: int) -> str:
+    return f"owner:{owner_id}"
+
+def pending_tag(approver_id: int) -> str:
+    return f"pending:{approver_id}"
+
+class _Load:
+    def __init__(self, tags: Iterable[str]):
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.tags: Set[str] = set(tags)
+        self.invalidated = False
+
+class ResponseCache:
+    """Tag-invalidated cache of serialized responses with coalesced loads"""
+
+    def __init__(self, backend: CacheBackend, ttl: float = config.RESPONSE_CACHE_TTL):
+        self._backend = backend
+        self.ttl = ttl
+        self._loads: Dict[str, _Load] = {}
+        self.counters = {"hits": 0, "misses": 0, "stale": 0, "coalesced": 0, "invalidations": 0, "errors": 0}
+
+    def use_backend(self, backend: CacheBackend):
+        self._backend = backend
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    @property
+    def tag_ttl(self) -> float:
+        # Tokens outlive the entries recorded against them; a token that has
+        # expired anyway just reads as a mismatch
+        return self.ttl * 2
+
+    async def get_or_load(
+        self,
+        key: str,
+        tags: Sequence[str],
+        loader: Callable[[], Awaitable[CachedResponse]],
+    ) -> CachedResponse:
+        """The cached response for `key`, running `loader` (at most once per key at a time) on a miss"""
+        if not self.enabled:
+            self.counters["misses"] += 1
+            return await loader()
+
+        while True:
+            load = self._loads.get(key)
+            if load is not None:
+                self.counters["coalesced"] += 1
+                try:
+                    return await asyncio.shield(load.future)
+                except asyncio.CancelledError:
+                    if load.future.cancelled():
+                        # The loading request went away; load again
+                        continue
+                    raise
+
+            tag_keys = [f"tag:{tag}" for tag in tags]
+            try:
+                raw, *versions = await self._backend.get_many([key] + tag_keys)
+            except Exception:
+                # A cache outage degrades to uncached reads
+                self.counters["errors"] += 1
+                return await loader()
+
+            if raw is not None:
+                recorded, cached = CachedResponse.decode(raw)
+                if recorded == versions:
+                    self.counters["hits"] += 1
+                    return cached
+                self.counters["stale"] += 1
+            self.counters["misses"] += 1
+
+            # Another request may have started loading while the backend was read
+            if key not in self._loads:
+                return await self._load(key, tags, tag_keys, versions, loader)
+
+    async def _load(self, key, tags, tag_keys, versions, loader) -> CachedResponse:
+        load = _Load(tags)
+        self._loads[key] = load
+        try:
+            versions = list(versions)
+            for index, version in enumerate(versions):
+                if version is None:
+                    token = secrets.token_hex(8).encode()
+                    if await self._backend.add(tag_keys[index], token, self.tag_ttl):
+                        versions[index] = token
+                    else:
+                        versions[index] = (await self._backend.get_many([tag_keys[index]]))[0]
+            cached = await loader()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                load.future.cancel()
+            else:
+                load.future.set_exception(e)
+                # Mark the exception retrieved when nobody was waiting
+                load.future.exception()
+            raise
+        finally:
+            if self._loads.get(key) is load:
+                del self._loads[key]
+
+        load.future.set_result(cached)
+        if not load.invalidated and None not in versions:
+            try:
+                await self._backend.set(key, cached.encode(versions), self.ttl)
+            except Exception:
+                self.counters["errors"] += 1
+        return cached
+
+    async def invalidate(self, tags: Iterable[str]):
+        """Drop every entry filed under any of `tags`; call after the write commits"""
+        tags = set(tags)
+        if not tags or not self.enabled:
+            return
+        for key, load in list(self._loads.items()):
+            if load.tags & tags:
+                # Later requests must not join a load that may predate the write
+                load.invalidated = True
+                del self._loads[key]
+        self.counters["invalidations"] += len(tags)
+        try:
+            for tag in tags:
+                await self._backend.set(f"tag:{tag}", secrets.token_hex(8).encode(), self.tag_ttl)
+        except Exception:
+            self.counters["errors"] += 1
+
+    def stats(self) -> dict:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            "enabled": self.enabled,
+            "ttl": self.ttl,
+            "loading": len(self._loads),
+            **self.counters,
+            "hit_ratio": round(self.counters["hits"] / lookups, 4) if lookups else None,
+            **self._backend.stats(),
+        }
+
+response_cache = ResponseCache(MemoryCacheBackend())
+
+def _collect_response_cache_stats():
+    stats = response_cache.stats()
+    for key in ("hits", "misses", "stale", "coalesced", "invalidations", "errors", "evictions", "expirations"):
+        if key in stats:
+            yield f"response_cache_{key}_total", "counter", f"Response cache {key}", [({}, stats[key])]
+
+registry.add_collector(_collect_response_cache_stats)
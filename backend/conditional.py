@@ -0,0 +1,28 @@
+"""
+Conditional GET support.
+
+Cached responses carry a weak ETag over their serialized body (see
+cache.json_response). When the client already holds that version, the route
+answers 304 with no body, so polling an unchanged resource costs a cache
+lookup.
+"""
+from fastapi import Request, Response, status
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True when If-None-Match names `etag` (weak comparison) or is *"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    if "*" in candidates:
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    return any((candidate[2:] if candidate.startswith("W/") else candidate) == opaque for candidate in candidates)
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+def set_etag(response: Response, etag: str):
+    """Attach the ETag and make clients revalidate before reusing the body"""
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
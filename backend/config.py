@@ -0,0 +1,138 @@
+import os
+
+# Runtime configuration read from the environment. Defaults keep the local
+# SQLite development setup working without any variables set.
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+# Database
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./expense_management.db")
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")  # Derived from DATABASE_URL when unset
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+# Connection pool
+DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 10)
+DB_MAX_OVERFLOW = _env_int("DB_MAX_OVERFLOW", 20)
+DB_POOL_TIMEOUT = _env_int("DB_POOL_TIMEOUT", 30)  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = _env_int("DB_POOL_RECYCLE", 1800)  # Seconds before a connection is replaced
+# A local SQLite file cannot drop connections, so pinging it is a wasted round trip
+DB_POOL_PRE_PING = _env_bool("DB_POOL_PRE_PING", not IS_SQLITE)
+DB_POOL_WARM = _env_int("DB_POOL_WARM", min(DB_POOL_SIZE, 4))  # Connections each worker opens at startup
+DB_ECHO = _env_bool("DB_ECHO", False)
+
+# SQLite connect-time pragmas
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = _env_int("SQLITE_BUSY_TIMEOUT_MS", 5000)
+SQLITE_MMAP_SIZE = _env_int("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)
+SQLITE_CACHE_SIZE_KB = _env_int("SQLITE_CACHE_SIZE_KB", 64 * 1024)
+
+# Currency conversion
+BASE_CURRENCY = os.getenv("BASE_CURRENCY", "USD")
+# CSV with currency,effective_date,rate columns; the exchange_rates table is used when unset
+EXCHANGE_RATES_FILE = os.getenv("EXCHANGE_RATES_FILE")
+RATE_CACHE_SIZE = _env_int("RATE_CACHE_SIZE", 10000)
+RATE_CACHE_TTL = _env_int("RATE_CACHE_TTL", 3600)  # Seconds before rates are reloaded
+
+# Approval change feed
+EVENT_HISTORY_SIZE = _env_int("EVENT_HISTORY_SIZE", 10000)  # Events kept for resuming subscribers
+EVENT_QUEUE_SIZE = _env_int("EVENT_QUEUE_SIZE", 1000)  # Undelivered events per subscriber before it is reset
+EVENT_HEARTBEAT_SECONDS = _env_int("EVENT_HEARTBEAT_SECONDS", 15)
+EVENT_STREAMS = _env_bool("EVENT_STREAMS", True)  # Off answers the stream endpoints with 503
+
+# Receipt attachments
+RECEIPTS_DIR = os.getenv("RECEIPTS_DIR", "./uploads/receipts")
+RECEIPT_MAX_BYTES = _env_int("RECEIPT_MAX_BYTES", 20 * 1024 * 1024)
+RECEIPT_CHUNK_SIZE = _env_int("RECEIPT_CHUNK_SIZE", 64 * 1024)
+# URL prefix of an nginx internal location aliased to RECEIPTS_DIR; when set,
+# downloads are handed to nginx (X-Accel-Redirect) for sendfile and ranges
+RECEIPTS_ACCEL_REDIRECT = os.getenv("RECEIPTS_ACCEL_REDIRECT")
+THUMBNAIL_WORKERS = _env_int("THUMBNAIL_WORKERS", 2)
+THUMBNAIL_SIZE = _env_int("THUMBNAIL_SIZE", 320)  # Longest edge in pixels
+
+# Receipt OCR
+OCR_ENGINE = os.getenv("OCR_ENGINE", "auto")  # auto, tesseract or stub
+OCR_CONCURRENCY = _env_int("OCR_CONCURRENCY", 2)  # Receipts extracted at the same time
+OCR_MAX_ATTEMPTS = _env_int("OCR_MAX_ATTEMPTS", 3)
+OCR_RETRY_DELAY = _env_int("OCR_RETRY_DELAY", 5)  # Seconds before the first retry; doubles per attempt
+OCR_TIMEOUT = _env_int("OCR_TIMEOUT", 60)  # Seconds one engine run may take
+
+# Description search
+# Matches ranked by relevance per query; broader queries are listed newest first
+SEARCH_RANK_LIMIT = _env_int("SEARCH_RANK_LIMIT", 5000)
+
+# Response cache for read endpoints
+RESPONSE_CACHE_TTL = _env_int("RESPONSE_CACHE_TTL", 60)  # Seconds; 0 disables the cache
+RESPONSE_CACHE_SIZE = _env_int("RESPONSE_CACHE_SIZE", 10000)  # Entries and tag tokens kept per process
+REDIS_URL = os.getenv("REDIS_URL")  # Shares the response cache, rate limits and approval events between workers; needs the redis package
+
+# Instrumentation
+N_PLUS_ONE_THRESHOLD = _env_int("N_PLUS_ONE_THRESHOLD", 10)  # Repeats of one statement per request before it is flagged
+HEALTH_DB_TIMEOUT_MS = _env_int("HEALTH_DB_TIMEOUT_MS", 2000)
+
+# Authentication
+JWT_SECRET = os.getenv("JWT_SECRET")  # Random per process when unset, so tokens die with the process
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWT_EXPIRE_MINUTES = _env_int("JWT_EXPIRE_MINUTES", 60)
+AUTH_CACHE_SIZE = _env_int("AUTH_CACHE_SIZE", 10000)  # Verified tokens kept per process
+AUTH_CACHE_TTL = _env_int("AUTH_CACHE_TTL", 300)  # Seconds a role change may take to reach other workers
+BCRYPT_ROUNDS = _env_int("BCRYPT_ROUNDS", 12)
+AUTH_DEV_USER_ID = _env_int("AUTH_DEV_USER_ID", 0)  # Development only: requests without a token act as this user
+
+# Rate limiting and admission control (ratelimit.py)
+RATE_LIMIT_ENABLED = _env_bool("RATE_LIMIT_ENABLED", True)
+# Token buckets per client and route class: sustained requests per minute
+# (0 leaves the class unlimited) and burst size
+RATE_LIMIT_EXPORT_PER_MINUTE = _env_int("RATE_LIMIT_EXPORT_PER_MINUTE", 10)
+RATE_LIMIT_EXPORT_BURST = _env_int("RATE_LIMIT_EXPORT_BURST", 3)
+RATE_LIMIT_LIST_PER_MINUTE = _env_int("RATE_LIMIT_LIST_PER_MINUTE", 600)
+RATE_LIMIT_LIST_BURST = _env_int("RATE_LIMIT_LIST_BURST", 60)
+RATE_LIMIT_READ_PER_MINUTE = _env_int("RATE_LIMIT_READ_PER_MINUTE", 1200)
+RATE_LIMIT_READ_BURST = _env_int("RATE_LIMIT_READ_BURST", 200)
+RATE_LIMIT_WRITE_PER_MINUTE = _env_int("RATE_LIMIT_WRITE_PER_MINUTE", 300)
+RATE_LIMIT_WRITE_BURST = _env_int("RATE_LIMIT_WRITE_BURST", 60)
+RATE_LIMIT_KEYS = _env_int("RATE_LIMIT_KEYS", 100000)  # Buckets kept per process
+# Requests a worker handles at once before answering 503; 0 disables a cap.
+# The total defaults to the async pool's capacity.
+ADMISSION_MAX_IN_FLIGHT = _env_int("ADMISSION_MAX_IN_FLIGHT", DB_POOL_SIZE + DB_MAX_OVERFLOW)
+ADMISSION_MAX_LISTS = _env_int("ADMISSION_MAX_LISTS", max(1, ADMISSION_MAX_IN_FLIGHT * 2 // 3))
+ADMISSION_MAX_EXPORTS = _env_int("ADMISSION_MAX_EXPORTS", 2)  # Each holds a sync connection for the whole stream
+
+# Expense audit trail (audit.py)
+# Write events in the changing transaction instead of batching them after commit
+AUDIT_DURABLE = _env_bool("AUDIT_DURABLE", False)
+AUDIT_BATCH_SIZE = _env_int("AUDIT_BATCH_SIZE", 500)  # Events per INSERT
+AUDIT_FLUSH_INTERVAL_MS = _env_int("AUDIT_FLUSH_INTERVAL_MS", 200)  # Longest a committed event waits in memory
+AUDIT_MAX_ATTEMPTS = _env_int("AUDIT_MAX_ATTEMPTS", 3)  # Failed batch inserts before writing the batch row by row
+AUDIT_MAX_BUFFERED = _env_int("AUDIT_MAX_BUFFERED", 100000)  # Events held in memory; the oldest are dropped beyond this
+
+# Archival of decided expenses (archive.py)
+ARCHIVE_AFTER_DAYS = _env_int("ARCHIVE_AFTER_DAYS", 365)  # Age, by expense date, at which decided expenses leave the hot table
+ARCHIVE_CHUNK_SIZE = _env_int("ARCHIVE_CHUNK_SIZE", 1000)  # Expenses moved per transaction
+
+# Duplicate detection (duplicates.py)
+DUPLICATE_DETECTION = _env_bool("DUPLICATE_DETECTION", True)
+DUPLICATE_SIMILARITY = _env_int("DUPLICATE_SIMILARITY", 75)  # Percent of shared description shingles for a "similar" suspect
+DUPLICATE_MAX_CANDIDATES = _env_int("DUPLICATE_MAX_CANDIDATES", 20)  # Earlier expenses compared with each new one
+
+# Application startup
+# Create tables and requeue interrupted OCR jobs when the app starts. server.py
+# does this once before starting its workers and turns it off for them.
+INIT_ON_STARTUP = _env_bool("INIT_ON_STARTUP", True)
+
+# Production server (server.py)
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = _env_int("WEB_PORT", 8000)
+WEB_WORKERS = _env_int("WEB_WORKERS", os.cpu_count() or 1)
+WEB_BACKLOG = _env_int("WEB_BACKLOG", 2048)  # Pending connections the listening socket queues
+WEB_KEEPALIVE = _env_int("WEB_KEEPALIVE", 5)  # Seconds an idle keep-alive connection stays open
+WEB_GRACEFUL_TIMEOUT = _env_int("WEB_GRACEFUL_TIMEOUT", 30)  # Seconds in-flight requests get after SIGTERM
+WEB_LIMIT_CONCURRENCY = _env_int("WEB_LIMIT_CONCURRENCY", 0)  # Connections per worker before 503s; 0 is unlimited
@@ -0,0 +1,245 @@
+"""
+Conversion of expense amounts into the company base currency.
+
+Rates come from a CSV file (config.EXCHANGE_RATES_FILE, columns
+currency,effective_date,rate) or from the exchange_rates table. A rate applies
+from its effective date until the next one for the same currency. Lookups are
+cached per (currency, day), and batch conversion resolves each distinct
+(currency, day) once instead of once per row.
+
+In the app the table is reloaded every RATE_CACHE_TTL by a background task
+(converter.start()) on a worker thread, so conversions in request handlers
+only ever read memory. Without the task (scripts, benchmarks) an expired
+table is reloaded by the next conversion.
+
+Load a CSV into the exchange_rates table:
+
+    python -m currency load rates.csv
+"""
+import asyncio
+import bisect
+import csv
+import logging
+import threading
+import time
+from datetime import date, datetime
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+
+import config
+from cache import MISSING, TTLCache
+from models import ExchangeRate
+
+logger = logging.getLogger(__name__)
+
+RateRow = Tuple[str, date, float]
+
+def _as_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+class RateTable:
+    """Effective-dated rates per currency, searchable by bisection"""
+
+    def __init__(self, rows: Iterable[RateRow]):
+        by_currency: Dict[str, List[Tuple[date, float]]] = {}
+        for currency, effective_date, rate in rows:
+            by_currency.setdefault(currency.upper(), []).append((_as_date(effective_date), float(rate)))
+        self._dates: Dict[str, List[date]] = {}
+        self._rates: Dict[str, List[float]] = {}
+        for currency, entries in by_currency.items():
+            entries.sort()
+            self._dates[currency] = [entry[0] for entry in entries]
+            self._rates[currency] = [entry[1] for entry in entries]
+
+    def rate(self, currency: str, on: date) -> Optional[float]:
+        """Rate effective on `on`, or None if none is effective yet"""
+        dates = self._dates.get(currency)
+        if not dates:
+            return None
+        position = bisect.bisect_right(dates, on) - 1
+        return self._rates[currency][position] if position >= 0 else None
+
+def load_rates_file(path: str) -> List[RateRow]:
+    with open(path, newline="") as handle:
+        return [
+            (row["currency"], date.fromisoformat(row["effective_date"]), float(row["rate"]))
+            for row in csv.DictReader(handle)
+        ]
+
+def load_rates_table() -> List[RateRow]:
+    from database import SessionLocal
+
+    with SessionLocal() as db:
+        return [
+            tuple(row)
+            for row in db.execute(select(ExchangeRate.currency, ExchangeRate.effective_date, ExchangeRate.rate))
+        ]
+
+def default_loader() -> List[RateRow]:
+    if config.EXCHANGE_RATES_FILE:
+        return load_rates_file(config.EXCHANGE_RATES_FILE)
+    return load_rates_table()
+
+class CurrencyConverter:
+    """Converts amounts into the base currency using a periodically reloaded rate table"""
+
+    def __init__(
+        self,
+        base_currency: str = config.BASE_CURRENCY,
+        loader: Callable[[], Iterable[RateRow]] = default_loader,
+        cache_size: int = config.RATE_CACHE_SIZE,
+        ttl: float = config.RATE_CACHE_TTL,
+    ):
+        self.base_currency = base_currency.upper()
+        self._loader = loader
+        self._ttl = ttl
+        self._cache = TTLCache(maxsize=cache_size, ttl=ttl)
+        self._table: Optional[RateTable] = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stale: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _rate_table(self) -> RateTable:
+        table = self._table
+        # With the refresher running an old table is served until the new one is in
+        if table is not None and (self._task is not None or time.monotonic() - self._loaded_at <= self._ttl):
+            return table
+        with self._lock:
+            if self._table is None or (self._task is None and time.monotonic() - self._loaded_at > self._ttl):
+                self._table = RateTable(self._loader())
+                self._loaded_at = time.monotonic()
+            return self._table
+
+    def reload(self):
+        """Load a fresh rate table (blocking) and drop lookups made from the old one"""
+        table = RateTable(self._loader())
+        with self._lock:
+            self._table = table
+            self._loaded_at = time.monotonic()
+            self._cache.clear()
+
+    def use_loader(self, loader: Callable[[], Iterable[RateRow]]):
+        """Switch the rate source, e.g. to a fixed table in benchmarks"""
+        self._loader = loader
+        self.invalidate()
+
+    def warm(self):
+        """Load the rate table now rather than on the first conversion"""
+        self._rate_table()
+
+    def invalidate(self):
+        """Drop cached rates, e.g. after the rate table was edited"""
+        if self._task is not None:
+            # Reloaded off the request path; conversions keep the current table meanwhile
+            self._loop.call_soon_threadsafe(self._stale.set)
+            return
+        with self._lock:
+            self._table = None
+            self._cache.clear()
+
+    async def _refresh(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stale.wait(), timeout=self._ttl)
+            except asyncio.TimeoutError:
+                pass
+            self._stale.clear()
+            try:
+                await run_in_threadpool(self.reload)
+            except Exception:
+                logger.exception("Failed to reload exchange rates; keeping the current table")
+
+    async def start(self):
+        """Load the rates, then keep reloading them in the background every ttl seconds"""
+        if self._task is None:
+            await run_in_threadpool(self.warm)
+            self._loop = asyncio.get_running_loop()
+            self._stale = asyncio.Event()
+            self._task = asyncio.create_task(self._refresh())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def rate(self, currency: str, on) -> Optional[float]:
+        currency = currency.upper()
+        if currency == self.base_currency:
+            return 1.0
+        key = (currency, _as_date(on))
+        rate = self._cache.get(key)
+        if rate is MISSING:
+            rate = self._rate_table().rate(*key)
+            self._cache.set(key, rate)
+        return rate
+
+    def convert(self, amount: float, currency: str, on) -> Optional[float]:
+        rate = self.rate(currency, on)
+        return None if rate is None else round(amount * rate, 2)
+
+    def convert_batch(
+        self,
+        amounts: Sequence[float],
+        currencies: Sequence[str],
+        dates: Sequence,
+    ) -> List[Optional[float]]:
+        """Convert parallel sequences, resolving each distinct (currency, day) once"""
+        rates: Dict[tuple, Optional[float]] = {}
+        converted = []
+        for amount, currency, on in zip(amounts, currencies, dates):
+            key = (currency, on.date() if isinstance(on, datetime) else on)
+            rate = rates.get(key, MISSING)
+            if rate is MISSING:
+                rate = rates[key] = self.rate(currency, key[1])
+            converted.append(None if rate is None else round(amount * rate, 2))
+        return converted
+
+# Shared converter used by the API
+converter = CurrencyConverter()
+
+def attach_base_amounts(expenses):
+    """Set amount_base on a list of Expense objects in one batch"""
+    expenses = list(expenses)
+    converted = converter.convert_batch(
+        [expense.amount for expense in expenses],
+        [expense.currency for expense in expenses],
+        [expense.date for expense in expenses],
+    )
+    for expense, amount_base in zip(expenses, converted):
+        expense.amount_base = amount_base
+    return expenses
+
+if __name__ == "__main__":
+    import sys
+    from database import SessionLocal, create_tables
+
+    if len(sys.argv) != 3 or sys.argv[1] != "load":
+        print(__doc__)
+        sys.exit(2)
+    create_tables()
+    rows = load_rates_file(sys.argv[2])
+    with SessionLocal() as session:
+        existing = {
+            (rate.currency, rate.effective_date): rate
+            for rate in session.execute(select(ExchangeRate)).scalars()
+        }
+        for currency, effective_date, rate in rows:
+            key = (currency.upper(), effective_date)
+            if key in existing:
+                existing[key].rate = rate
+            else:
+                session.add(ExchangeRate(currency=key[0], effective_date=effective_date, rate=rate))
+        session.commit()
+    print(f"Loaded {len(rows)} exchange rates")
@@ -1,18 +1,144 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-import os
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.schema import CreateTable
+import asyncio
+import threading
+import time
+import config
+from metrics import registry, track_queries
 
-# SQLite database URL
-SQLALCHEMY_DATABASE_URL = "sqlite:///./expense_management.db"
+# Database URL (SQLite by default, see config.DATABASE_URL)
+SQLALCHEMY_DATABASE_URL = config.DATABASE_URL
+
+# Async drivers used by the request handlers, keyed by sync URL scheme
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def to_async_url(url: str) -> str:
+    """Map a sync database URL onto the matching async driver"""
+    scheme, rest = url.split("://", 1)
+    backend = scheme.split("+", 1)[0]
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for database backend '{backend}'")
+    return f"{ASYNC_DRIVERS[backend]}://{rest}"
+
+# Async URL, overridable to pick a different async driver
+ASYNC_SQLALCHEMY_DATABASE_URL = config.ASYNC_DATABASE_URL or to_async_url(SQLALCHEMY_DATABASE_URL)
+
+class PoolMetrics:
+    """Thread-safe counters for connection pool checkouts and wait time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts = 0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def incr(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self, pool) -> dict:
+        with self._lock:
+            stats = {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "wait_count": self.waits,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+                "timeouts": self.timeouts,
+            }
+        if isinstance(pool, QueuePool):
+            stats.update(
+                size=pool.size(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow(),
+            )
+        return stats
+
+def _timed_pool(base):
+    """Build a pool class that records how long each checkout waited"""
+    class TimedPool(base):
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                connection = super()._do_get()
+            except Exception:
+                self._metrics.record_wait(time.perf_counter() - started, timed_out=True)
+                raise
+            self._metrics.record_wait(time.perf_counter() - started)
+            return connection
+    TimedPool.__name__ = f"Timed{base.__name__}"
+    return TimedPool
+
+def _engine_options(metrics: PoolMetrics, pool_base) -> dict:
+    """Pool and driver options shared by the sync and async engines"""
+    options = {
+        "echo": config.DB_ECHO,  # Set DB_ECHO=1 for SQL query logging during development
+        "pool_pre_ping": config.DB_POOL_PRE_PING,
+    }
+    if config.IS_SQLITE:
+        options["connect_args"] = {"check_same_thread": False}  # Needed for SQLite
+    if ":memory:" not in SQLALCHEMY_DATABASE_URL:
+        pool_class = _timed_pool(pool_base)
+        pool_class._metrics = metrics
+        options.update(
+            poolclass=pool_class,
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_recycle=config.DB_POOL_RECYCLE,
+        )
+    return options
+
+def _instrument(sync_engine, metrics: PoolMetrics, name: str):
+    """Attach pool and query counters and, for SQLite, connect-time pragmas"""
+    track_queries(sync_engine, name)
+
+    @event.listens_for(sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        metrics.incr("connects")
+        if config.IS_SQLITE:
+            cursor = dbapi_connection.cursor()
+            # WAL lets readers proceed while an approval is being written
+            cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+            cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+            cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+            cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE}")
+            # Negative cache_size is in KiB rather than pages
+            cursor.execute(f"PRAGMA cache_size=-{config.SQLITE_CACHE_SIZE_KB}")
+            cursor.close()
+
+    @event.listens_for(sync_engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.incr("checkouts")
+
+    @event.listens_for(sync_engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        metrics.incr("checkins")
 
 # Create SQLAlchemy engine with proper configuration
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, 
-    connect_args={"check_same_thread": False},  # Needed for SQLite
-    echo=False,  # Set to True for SQL query logging during development
-    pool_pre_ping=True,  # Verify connections before use
-)
+sync_pool_metrics = PoolMetrics()
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **_engine_options(sync_pool_metrics, QueuePool))
+_instrument(engine, sync_pool_metrics, "sync")
 
 # Create SessionLocal class
 SessionLocal = sessionmaker(
@@ -21,6 +147,52 @@ SessionLocal = sessionmaker(
     bind=engine
 )
 
+# Async engine and session factory used by the API routes so database I/O
+# never blocks the event loop
+async_pool_metrics = PoolMetrics()
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    **_engine_options(async_pool_metrics, AsyncAdaptedQueuePool)
+)
+_instrument(async_engine.sync_engine, async_pool_metrics, "async")
+
+AsyncSessionLocal = async_sessionmaker(
+    async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False,  # Attribute access after commit must not trigger lazy I/O
+)
+
+async def warm_pool(connections: int = config.DB_POOL_WARM):
+    """Open pooled connections ahead of the first requests, which then skip connect and pragma setup"""
+    async def ping():
+        async with async_engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+    # Held concurrently, so each ping opens its own connection
+    await asyncio.gather(*(ping() for _ in range(min(connections, config.DB_POOL_SIZE))))
+
+def pool_stats() -> dict:
+    """Connection pool checkout and wait statistics for both engines"""
+    return {
+        "sync": sync_pool_metrics.snapshot(engine.pool),
+        "async": async_pool_metrics.snapshot(async_engine.sync_engine.pool),
+    }
+
+def _collect_pool_stats():
+    stats = pool_stats()
+    for name, key, metric_type, documentation in [
+        ("db_pool_checked_out", "checked_out", "gauge", "Connections currently checked out"),
+        ("db_pool_overflow", "overflow", "gauge", "Connections open beyond the pool size"),
+        ("db_pool_checkouts_total", "checkouts", "counter", "Connection checkouts"),
+        ("db_pool_wait_seconds_total", "wait_seconds_total", "counter", "Time spent waiting for a free connection"),
+        ("db_pool_timeouts_total", "timeouts", "counter", "Checkouts that timed out waiting for a connection"),
+    ]:
+        yield name, metric_type, documentation, [
+            ({"engine": engine_name}, engine_stats.get(key)) for engine_name, engine_stats in stats.items()
+        ]
+
+registry.add_collector(_collect_pool_stats)
+
 # Create Base class for models
 Base = declarative_base()
 
@@ -36,12 +208,92 @@ def get_db():
     finally:
         db.close()
 
+# Dependency to get an async database session
+async def get_async_db():
+    """
+    Dependency function that provides an async database session.
+    Automatically closes the session after use.
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def _add_missing_columns(connection):
+    """
+    create_all never alters existing tables, so add nullable columns that
+    later versions of the models introduced
+    """
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}')
+
+def _expenses_schema(connection):
+    return connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'expenses'"
+    ).scalar()
+
+def _rebuild_expenses_with_autoincrement(connection):
+    """
+    SQLite reuses the highest deleted rowid unless a table is AUTOINCREMENT,
+    which would hand archived expense ids out again. Databases created before
+    `expenses` was declared that way get the table rebuilt (SQLite cannot
+    alter a primary key), with its sequence starting after the highest id in
+    either the hot or the archive table.
+    """
+    schema = _expenses_schema(connection)
+    if schema is None or "AUTOINCREMENT" in schema.upper():
+        return
+    # One write transaction, DDL included: a failed rebuild leaves the old
+    # table as it was, and another worker starting up waits here, then finds
+    # the table already rebuilt
+    connection.exec_driver_sql("BEGIN IMMEDIATE")
+    if "AUTOINCREMENT" in _expenses_schema(connection).upper():
+        return
+    from models import Expense
+    table = Expense.__table__
+    columns = ", ".join(f'"{column.name}"' for column in table.columns)
+    create = str(CreateTable(table).compile(dialect=connection.dialect))
+    connection.exec_driver_sql(create.replace("CREATE TABLE expenses (", "CREATE TABLE expenses_rebuild (", 1))
+    connection.exec_driver_sql(f"INSERT INTO expenses_rebuild ({columns}) SELECT {columns} FROM expenses")
+    # Foreign keys are not enforced on these connections, so the steps and
+    # receipts pointing at expenses are left alone; the search triggers go
+    # with the old table and install_search_index puts them back
+    connection.exec_driver_sql("DROP TABLE expenses")
+    connection.exec_driver_sql("ALTER TABLE expenses_rebuild RENAME TO expenses")
+    for index in table.indexes:
+        index.create(connection)
+    connection.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name IN ('expenses', 'expenses_rebuild')")
+    connection.exec_driver_sql(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'expenses', coalesce(max(id), 0) FROM "
+        "(SELECT max(id) AS id FROM expenses UNION ALL SELECT max(id) FROM expenses_archive)"
+    )
+
 # Function to create all tables
 def create_tables():
     """Create all database tables"""
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        _add_missing_columns(connection)
+    if config.IS_SQLITE:
+        with engine.begin() as connection:
+            _rebuild_expenses_with_autoincrement(connection)
+    # Imported here because search and hierarchy depend on the models, which depend on this module
+    from search import install_search_index
+    from hierarchy import install_hierarchy
+    with engine.begin() as connection:
+        install_search_index(connection)
+        install_hierarchy(connection)
 
 # Function to drop all tables (useful for testing)
 def drop_tables():
     """Drop all database tables"""
+    if config.IS_SQLITE:
+        with engine.begin() as connection:
+            connection.exec_driver_sql("DROP TABLE IF EXISTS expenses_fts")
+            connection.exec_driver_sql("DROP TABLE IF EXISTS expenses_archive_fts")
     Base.metadata.drop_all(bind=engine)
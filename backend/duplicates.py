@@ -0,0 +1,301 @@
+"""
+Duplicate detection for incoming expenses.
+
+Every created or imported expense is compared with its owner's earlier ones
+through expense_signatures, which holds a few 64-bit keys per expense:
+
+- a fingerprint of (owner, amount to the cent, currency, day): the same
+  claim submitted twice
+- MinHash LSH bands over character shingles of the description: BANDS bands
+  of ROWS_PER_BAND hashes, so two descriptions sharing half their shingles
+  collide in some band about 3 times in 4, and ones sharing 70% nearly
+  always
+
+Every key includes the owner, and a lookup reads at most the newest
+DUPLICATE_MAX_CANDIDATES expenses under each key from its index, so its
+cost does not grow with the table or with one owner's history. At most
+DUPLICATE_MAX_CANDIDATES candidates in all (newest first) are confirmed by
+comparing shingle sets. A fingerprint match is an "Exact" suspect; a band
+match sharing DUPLICATE_SIMILARITY percent of its shingles is a "Similar"
+one. Suspects are stored in expense_suspects and returned by the create and
+bulk routes and the approval queues. Nothing is rejected; reviewers decide.
+
+    python duplicates.py                      # index and check all existing expenses
+    python duplicates.py --workers 8 --chunk-size 5000
+
+The batch mode rebuilds both tables from history, oldest first. Worker
+processes compute the signatures of the next chunks while the main process
+checks and writes the current one, so the scan is bound by whichever is
+slower rather than by both.
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import re
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List, Mapping, Sequence, Set, Tuple
+
+from sqlalchemy import bindparam, delete, insert, or_, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from metrics import Counter, registry
+from models import DuplicateReason, Expense, ExpenseSignature, ExpenseSuspect
+
+logger = logging.getLogger(__name__)
+
+SHINGLE_SIZE = 3  # Characters per shingle
+BANDS = 10
+ROWS_PER_BAND = 3
+
+# Keys per UNION ALL of bucket reads, under SQLite's limit of 500 compound terms
+BUCKET_BATCH = 100
+
+# Fixed seed: signatures must match across workers and restarts
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0x5EED)
+PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(BANDS * ROWS_PER_BAND)]
+del _rng
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+FLAGGED = registry.register(Counter("duplicate_suspects_total", "Pairs of expenses flagged as suspected duplicates", ("reason",)))
+
+# (expense id, signature keys, description shingles)
+Signature = Tuple[int, List[int], Set[str]]
+
+def shingles(description: str) -> Set[str]:
+    """Overlapping character shingles of the normalized description"""
+    text = " ".join(WORD.findall(description.lower()))
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+def _hash64(*parts: Any) -> int:
+    """Stable signed 64-bit hash, the range of a BIGINT"""
+    digest = hashlib.blake2b("\x1f".join(map(str, parts)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+def minhash(shingle_set: Set[str]) -> List[int]:
+    hashes = [_hash64(shingle) % _PRIME for shingle in shingle_set]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in PERMUTATIONS]
+
+def signature(expense: Mapping[str, Any]) -> Signature:
+    """Fingerprint key first, then one key per MinHash band"""
+    owner_id = expense["owner_id"]
+    shingle_set = shingles(expense["description"])
+    values = minhash(shingle_set)
+    keys = [_hash64("fingerprint", owner_id, f"{expense['amount']:.2f}", expense["currency"].upper(), expense["date"].date().isoformat())]
+    keys.extend(
+        _hash64("band", owner_id, band, *values[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND])
+        for band in range(BANDS)
+    )
+    return expense["id"], keys, shingle_set
+
+def compute_signatures(rows: Sequence[Mapping[str, Any]]) -> List[Signature]:
+    """Signatures of a chunk of rows; runs in the batch mode's worker processes"""
+    return [signature(row) for row in rows]
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+@lru_cache(maxsize=BUCKET_BATCH)
+def _bucket_query(size: int):
+    """
+    The newest DUPLICATE_MAX_CANDIDATES expenses under each of `size` keys
+    (bound as key_0, key_1, ...) with their descriptions, each read
+    backwards on the primary key index: a busy bucket (an owner filing
+    "Taxi" every day) costs no more than a small one. Deleted and archived
+    expenses drop out in the join. Built once per size; building it costs
+    more than running it.
+    """
+    newest = [
+        select(ExpenseSignature.key, ExpenseSignature.expense_id, Expense.description)
+        .join(Expense, Expense.id == ExpenseSignature.expense_id)
+        .where(ExpenseSignature.key == bindparam(f"key_{index}"))
+        .order_by(ExpenseSignature.expense_id.desc())
+        .limit(config.DUPLICATE_MAX_CANDIDATES)
+        .subquery()
+        for index in range(size)
+    ]
+    return union_all(*[select(bucket.c.key, bucket.c.expense_id, bucket.c.description) for bucket in newest])
+
+async def _index(db: AsyncSession, signatures: List[Signature]) -> Dict[int, List[dict]]:
+    """
+    Compare each signature with earlier expenses, including earlier ones in
+    the same list, then store the keys and any suspects in db's transaction.
+    Returns the suspects per expense id.
+    """
+    buckets: Dict[int, List[int]] = defaultdict(list)
+    descriptions: Dict[int, str] = {}
+    keys = list({key for _, expense_keys, _ in signatures for key in expense_keys})
+    for start in range(0, len(keys), BUCKET_BATCH):
+        part = keys[start:start + BUCKET_BATCH]
+        found = await db.execute(_bucket_query(len(part)), {f"key_{index}": key for index, key in enumerate(part)})
+        for key, expense_id, description in found:
+            buckets[key].append(expense_id)
+            descriptions[expense_id] = description
+
+    # Pick candidates in order, adding each expense to the buckets after its turn
+    candidates: Dict[int, Tuple[Set[int], List[int]]] = {}
+    batch_shingles: Dict[int, Set[str]] = {}
+    for expense_id, expense_keys, shingle_set in signatures:
+        exact = {other for other in buckets.get(expense_keys[0], ()) if other < expense_id}
+        similar = {other for key in expense_keys[1:] for other in buckets.get(key, ()) if other < expense_id}
+        nearest = sorted(exact | similar, reverse=True)[:config.DUPLICATE_MAX_CANDIDATES]
+        candidates[expense_id] = (exact, nearest)
+        batch_shingles[expense_id] = shingle_set
+        for key in expense_keys:
+            buckets[key].append(expense_id)
+
+    known = dict(batch_shingles)
+    for _, nearest in candidates.values():
+        for other in nearest:
+            if other not in known:
+                known[other] = shingles(descriptions[other])
+
+    threshold = config.DUPLICATE_SIMILARITY / 100
+    suspects: Dict[int, List[dict]] = {}
+    rows = []
+    for expense_id, (exact, nearest) in candidates.items():
+        for other in nearest:
+            similarity = round(jaccard(batch_shingles[expense_id], known[other]), 4)
+            if other in exact:
+                reason = DuplicateReason.EXACT
+            elif similarity >= threshold:
+                reason = DuplicateReason.SIMILAR
+            else:
+                continue
+            FLAGGED.inc(reason.value)
+            suspects.setdefault(expense_id, []).append(
+                {"expense_id": other, "reason": reason.value, "similarity": similarity}
+            )
+            rows.append({"expense_id": expense_id, "duplicate_of_id": other, "reason": reason, "similarity": similarity})
+
+    await db.execute(insert(ExpenseSignature), [
+        {"key": key, "expense_id": expense_id}
+        for expense_id, expense_keys, _ in signatures
+        for key in dict.fromkeys(expense_keys)
+    ])
+    if rows:
+        await db.execute(insert(ExpenseSuspect), rows)
+    return suspects
+
+async def detect(db: AsyncSession, expenses: Sequence[Mapping[str, Any]]) -> Dict[int, List[dict]]:
+    """
+    Index new expenses (mappings with id, owner_id, amount, currency, date
+    and description) and flag the ones that look like earlier expenses, in
+    db's transaction. Returns the suspects per expense id.
+    """
+    if not config.DUPLICATE_DETECTION or not expenses:
+        return {}
+    return await _index(db, compute_signatures(expenses))
+
+async def forget(db: AsyncSession, expense_ids: Sequence[int], suspects: bool = True):
+    """Drop the keys of expenses and, unless archiving, the suspects naming them"""
+    await db.execute(delete(ExpenseSignature).where(ExpenseSignature.expense_id.in_(expense_ids)))
+    if suspects:
+        await db.execute(delete(ExpenseSuspect).where(or_(
+            ExpenseSuspect.expense_id.in_(expense_ids),
+            ExpenseSuspect.duplicate_of_id.in_(expense_ids)
+        )))
+
+async def reindex(db: AsyncSession, expense: Expense) -> Dict[int, List[dict]]:
+    """Re-check an edited expense against the ones before it"""
+    if not config.DUPLICATE_DETECTION:
+        return {}
+    # Flags raised against the old values no longer hold either way
+    await forget(db, [expense.id])
+    return await detect(db, [expense_values(expense)])
+
+def expense_values(expense: Expense) -> dict:
+    return {name: getattr(expense, name) for name in ("id", "owner_id", "amount", "currency", "date", "description")}
+
+async def attach_suspects(db: AsyncSession, items: List[Dict[str, Any]]):
+    """Set suspected_duplicates on response dicts with one query for the page"""
+    if not items:
+        return
+    found: Dict[int, List[dict]] = defaultdict(list)
+    rows = await db.execute(
+        select(ExpenseSuspect.expense_id, ExpenseSuspect.duplicate_of_id, ExpenseSuspect.reason, ExpenseSuspect.similarity)
+        .where(ExpenseSuspect.expense_id.in_([item["id"] for item in items]))
+        .order_by(ExpenseSuspect.expense_id, ExpenseSuspect.duplicate_of_id.desc())
+    )
+    for expense_id, duplicate_of_id, reason, similarity in rows:
+        found[expense_id].append({"expense_id": duplicate_of_id, "reason": reason.value, "similarity": similarity})
+    for item in items:
+        item["suspected_duplicates"] = found.get(item["id"], [])
+
+async def scan_history(workers: int, chunk_size: int) -> Tuple[int, int]:
+    """Rebuild the signatures and suspects of every expense, oldest first; returns (checked, flagged)"""
+    from database import AsyncSessionLocal
+
+    columns = [Expense.id, Expense.owner_id, Expense.amount, Expense.currency, Expense.date, Expense.description]
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(ExpenseSignature))
+        await db.execute(delete(ExpenseSuspect))
+        await db.commit()
+
+    loop = asyncio.get_running_loop()
+    checked = flagged = 0
+    last_id = 0
+    exhausted = False
+    in_flight = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while in_flight or not exhausted:
+            # Keep every worker busy with an upcoming chunk
+            while not exhausted and len(in_flight) < workers:
+                async with AsyncSessionLocal() as db:
+                    rows = (await db.execute(
+                        select(*columns).where(Expense.id > last_id).order_by(Expense.id).limit(chunk_size)
+                    )).mappings().all()
+                if not rows:
+                    exhausted = True
+                    break
+                last_id = rows[-1]["id"]
+                in_flight.append(loop.run_in_executor(pool, compute_signatures, [dict(row) for row in rows]))
+            if not in_flight:
+                break
+
+            signatures = await in_flight.popleft()
+            async with AsyncSessionLocal() as db:
+                try:
+                    suspects = await _index(db, signatures)
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
+            checked += len(signatures)
+            flagged += len(suspects)
+            logger.info("Checked %d expenses, %d suspected duplicates so far", checked, flagged)
+    return checked, flagged
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes computing signatures")
+    parser.add_argument("--chunk-size", type=int, default=2000, help="Expenses per chunk")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s:     %(message)s")
+    logger.setLevel(logging.INFO)
+
+    from database import async_engine, create_tables, engine
+
+    async def run() -> Tuple[int, int]:
+        try:
+            return await scan_history(max(1, args.workers), args.chunk_size)
+        finally:
+            await async_engine.dispose()
+
+    # Creates the detection tables on databases that predate them
+    create_tables()
+    engine.dispose()
+    checked, flagged = asyncio.run(run())
+    logger.info("Done: %d expenses checked, %d suspected duplicates", checked, flagged)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+"""
+Change feed for approval queues.
+
+Expense writes build their events inside the transaction (so the audience
+reflects the new workflow state) and publish them after commit. Each event
+carries the expense, the users whose queue it may touch (`audience`) and
+the users it is now pending for (`pending_for`): a client upserts the
+expense when its own id is in pending_for and drops it otherwise.
+
+Events are numbered by the backend. Subscribers pass the last sequence
+number they saw to resume after a reconnect; if the backend no longer has
+every event since then, the stream starts with a `reset` event telling the
+client to refetch /api/approvals/pending and continue from there.
+
+MemoryBackend keeps the history and subscribers in process, which is what a
+single worker needs. Several workers need SharedBackend, which numbers,
+keeps and broadcasts events through Redis (FakeSharedEventClient stands in
+for it in tests); the app installs redis_backend() when REDIS_URL is set,
+and server.py turns the streams off for several workers without it.
+"""
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import AsyncIterator, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from cache import EXPENSES_TAG, expense_tag, owner_tag, pending_tag
+from models import ApprovalStep, Expense, ExpenseStatus, StepStatus, User
+
+logger = logging.getLogger(__name__)
+
+EXPENSE_CREATED = "expense.created"
+EXPENSE_UPDATED = "expense.updated"
+EXPENSE_DELETED = "expense.deleted"
+EXPENSE_DECIDED = "expense.decided"
+RESET = "reset"
+
+class ChangeEvent(NamedTuple):
+    seq: int
+    type: str
+    audience: Optional[FrozenSet[int]]  # None means every subscriber
+    data: dict
+
+class PendingEvent(NamedTuple):
+    """An event built inside a transaction, published once it commits"""
+    type: str
+    audience: FrozenSet[int]
+    data: dict
+
+class Subscription:
+    """Replayed history plus a bounded queue of live events for one subscriber"""
+
+    def __init__(self, replay: List[ChangeEvent], reset: Optional[ChangeEvent], queue_size: int):
+        self.replay = replay
+        self.reset = reset
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    def deliver(self, event: ChangeEvent):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # A subscriber this far behind refetches instead of holding more memory
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(reset_event(event.seq))
+
+def reset_event(seq: int) -> ChangeEvent:
+    return ChangeEvent(seq, RESET, None, {})
+
+def resume_point(since: Optional[int], current: int, oldest: Optional[int]) -> Optional[bool]:
+    """
+    For a subscriber resuming after `since`, with `current` the last number
+    handed out and `oldest` the first one still retained: None when nothing
+    was missed, False when history covers the gap, True when it must reset.
+    """
+    if since is None or since == current:
+        return None
+    if oldest is None:
+        oldest = current + 1
+    # Sequence from before a restart, or older than the retained history
+    return since > current or since + 1 < oldest
+
+class EventBackend(ABC):
+    """Interface for event storage and fan-out"""
+
+    @abstractmethod
+    async def publish(self, events: Iterable[PendingEvent]) -> List[ChangeEvent]:
+        """Number and store `events`, deliver them to every subscriber and return them"""
+
+    @abstractmethod
+    async def subscribe(self, since: Optional[int]) -> Subscription:
+        """Register a subscriber resuming after sequence `since` (None for live events only)"""
+
+    @abstractmethod
+    def unsubscribe(self, subscription: Subscription):
+        pass
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class MemoryBackend(EventBackend):
+    """In-process history ring and subscriber queues"""
+
+    def __init__(self, history_size: int = config.EVENT_HISTORY_SIZE, queue_size: int = config.EVENT_QUEUE_SIZE):
+        self._history: deque = deque(maxlen=history_size)
+        self._subscribers: Set[Subscription] = set()
+        self._queue_size = queue_size
+        self._seq = 0
+
+    async def publish(self, events: Iterable[PendingEvent]) -> List[ChangeEvent]:
+        published = []
+        for pending in events:
+            self._seq += 1
+            event = ChangeEvent(self._seq, pending.type, pending.audience, pending.data)
+            self._history.append(event)
+            published.append(event)
+            for subscription in self._subscribers:
+                subscription.deliver(event)
+        return published
+
+    async def subscribe(self, since: Optional[int]) -> Subscription:
+        replay, reset = [], None
+        oldest = self._history[0].seq if self._history else None
+        missed = resume_point(since, self._seq, oldest)
+        if missed:
+            reset = reset_event(self._seq)
+        elif missed is not None:
+            replay = [event for event in self._history if event.seq > since]
+        subscription = Subscription(replay, reset, self._queue_size)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+
+def encode_event(event: ChangeEvent) -> list:
+    audience = None if event.audience is None else sorted(event.audience)
+    return [event.seq, event.type, audience, event.data]
+
+def decode_event(raw) -> ChangeEvent:
+    seq, event_type, audience, data = raw
+    return ChangeEvent(seq, event_type, None if audience is None else frozenset(audience), data)
+
+def encode_unnumbered(pending: PendingEvent) -> str:
+    """encode_event's JSON without the leading sequence number, which PUBLISH_SCRIPT splices in"""
+    raw = encode_event(ChangeEvent(0, pending.type, pending.audience, pending.data))
+    return json.dumps(raw[1:], separators=(",", ":"))
+
+def number_event(seq: int, unnumbered: str) -> str:
+    return f"[{seq},{unnumbered[1:]}"
+
+# KEYS: counter, history, channel; ARGV: history size, then each event as
+# encode_unnumbered() built it. Returns the last sequence number handed out.
+PUBLISH_SCRIPT = """
+local count = #ARGV - 1
+local last = redis.call('INCRBY', KEYS[1], count)
+local members = {}
+for i = 1, count do
+    local seq = last - count + i
+    members[i] = '[' .. seq .. ',' .. string.sub(ARGV[i + 1], 2)
+    redis.call('ZADD', KEYS[2], seq, members[i])
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[1]) - 1)
+redis.call('PUBLISH', KEYS[3], '[' .. table.concat(members, ',') .. ']')
+return last
+"""
+
+class SharedBackend(EventBackend):
+    """
+    Events on a redis.asyncio-style client, shared by every worker. A counter
+    numbers the events, a sorted set scored by sequence keeps the last
+    `history_size` for resuming, and each publish is broadcast on a pub/sub
+    channel, all three in one script (PUBLISH_SCRIPT). Every worker runs one
+    listener (start/stop) feeding its own subscribers' queues.
+    """
+
+    def __init__(
+        self,
+        client,
+        prefix: str = "expenses:events:",
+        history_size: int = config.EVENT_HISTORY_SIZE,
+        queue_size: int = config.EVENT_QUEUE_SIZE,
+    ):
+        self._client = client
+        self._seq_key = prefix + "seq"
+        self._history_key = prefix + "history"
+        self._channel = prefix + "live"
+        self._history_size = history_size
+        self._queue_size = queue_size
+        self._subscribers: Set[Subscription] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._listening = asyncio.Event()
+        self._last_seq = 0  # Newest event the listener has seen
+
+    async def publish(self, events: Iterable[PendingEvent]) -> List[ChangeEvent]:
+        events = list(events)
+        # Numbered, stored and broadcast in one script, so concurrent workers
+        # publish in sequence order
+        last = int(await self._client.eval(
+            PUBLISH_SCRIPT, 3, self._seq_key, self._history_key, self._channel,
+            self._history_size, *(encode_unnumbered(pending) for pending in events),
+        ))
+        return [
+            ChangeEvent(seq, pending.type, pending.audience, pending.data)
+            for seq, pending in enumerate(events, start=last - len(events) + 1)
+        ]
+
+    async def subscribe(self, since: Optional[int]) -> Subscription:
+        # Registered before history is read, so nothing published meanwhile is lost
+        subscription = Subscription([], None, self._queue_size)
+        self._subscribers.add(subscription)
+        if since is None:
+            return subscription
+        try:
+            current = int(await self._client.get(self._seq_key) or 0)
+            oldest = await self._client.zrange(self._history_key, 0, 0, withscores=True)
+            missed = resume_point(since, current, int(oldest[0][1]) if oldest else None)
+            if missed:
+                subscription.reset = reset_event(current)
+            elif missed is not None:
+                subscription.replay = [
+                    decode_event(json.loads(raw))
+                    for raw in await self._client.zrangebyscore(self._history_key, since + 1, "+inf")
+                ]
+        except BaseException:
+            self._subscribers.discard(subscription)
+            raise
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+            # Subscribers must not miss what is published right after startup
+            await self._listening.wait()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _listen(self):
+        lost = False
+        while True:
+            pubsub = self._client.pubsub()
+            try:
+                await pubsub.subscribe(self._channel)
+                self._listening.set()
+                if lost:
+                    # Whatever was published while disconnected is gone: every subscriber refetches
+                    lost = False
+                    logger.info("Event listener reconnected")
+                    for subscription in self._subscribers:
+                        subscription.deliver(reset_event(self._last_seq))
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    for raw in json.loads(message["data"]):
+                        event = decode_event(raw)
+                        self._last_seq = max(self._last_seq, event.seq)
+                        for subscription in self._subscribers:
+                            subscription.deliver(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if not lost:
+                    logger.exception("Event listener lost its connection; retrying")
+                lost = True
+                self._listening.set()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+def redis_backend(url: str) -> SharedBackend:
+    """SharedBackend over redis.asyncio; the redis package is only needed when REDIS_URL is set"""
+    import redis.asyncio
+    return SharedBackend(redis.asyncio.from_url(url))
+
+class FakeSharedEventClient:
+    """In-memory stand-in for a shared client (counter, sorted set and pub/sub) for tests and local runs; eval runs PUBLISH_SCRIPT's logic in Python"""
+
+    def __init__(self):
+        self._values: Dict[str, int] = {}
+        self._sorted: Dict[str, Dict[str, float]] = {}
+        self._channels: Dict[str, Set["FakePubSub"]] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value = self._values.get(key)
+        return None if value is None else str(value).encode()
+
+    def _ranked(self, key: str, start: int = 0, stop: int = -1) -> List[tuple]:
+        """Members with their scores, lowest first, between two ranks as Redis reads them"""
+        ranked = sorted(self._sorted.get(key, {}).items(), key=lambda item: item[1])
+        start = max(len(ranked) + start, 0) if start < 0 else start
+        stop = len(ranked) + stop if stop < 0 else stop
+        return ranked[start:stop + 1] if stop >= 0 else []
+
+    async def eval(self, script: str, numkeys: int, seq_key: str, history_key: str, channel: str, history_size: int, *events: str) -> int:
+        """PUBLISH_SCRIPT's steps in Python, with no await between them, as Redis runs a script"""
+        last = self._values[seq_key] = self._values.get(seq_key, 0) + len(events)
+        numbered = {number_event(seq, raw): seq for seq, raw in enumerate(events, start=last - len(events) + 1)}
+        history = self._sorted.setdefault(history_key, {})
+        history.update(numbered)
+        for member, _ in self._ranked(history_key, 0, -int(history_size) - 1):
+            del history[member]
+        message = f"[{','.join(numbered)}]".encode()
+        for pubsub in self._channels.get(channel, set()):
+            pubsub.messages.put_nowait({"type": "message", "channel": channel.encode(), "data": message})
+        return last
+
+    async def zrange(self, key: str, start: int, stop: int, withscores: bool = False) -> list:
+        selected = self._ranked(key, start, stop)
+        return [(member.encode(), score) for member, score in selected] if withscores else [member.encode() for member, _ in selected]
+
+    async def zrangebyscore(self, key: str, low: float, high) -> List[bytes]:
+        high = float(high)
+        return [member.encode() for member, score in self._ranked(key) if low <= score <= high]
+
+    def pubsub(self) -> "FakePubSub":
+        return FakePubSub(self)
+
+class FakePubSub:
+    def __init__(self, client: FakeSharedEventClient):
+        self._client = client
+        self._channels: Set[str] = set()
+        self.messages: asyncio.Queue = asyncio.Queue()
+
+    async def subscribe(self, channel: str):
+        self._client._channels.setdefault(channel, set()).add(self)
+        self._channels.add(channel)
+
+    async def listen(self) -> AsyncIterator[dict]:
+        while True:
+            yield await self.messages.get()
+
+    async def reset(self):
+        for channel in self._channels:
+            self._client._channels.get(channel, set()).discard(self)
+        self._channels.clear()
+
+class EventBus:
+    """Publishes expense changes and streams them to the approvers they concern"""
+
+    def __init__(self, backend: EventBackend):
+        self._backend = backend
+
+    def use_backend(self, backend: EventBackend):
+        """Swap the event backend, e.g. for a shared one when running several workers"""
+        self._backend = backend
+
+    async def start(self):
+        await self._backend.start()
+
+    async def stop(self):
+        await self._backend.stop()
+
+    async def publish(self, events: Iterable[PendingEvent]) -> List[ChangeEvent]:
+        events = list(events)
+        if not events:
+            return []
+        return await self._backend.publish(events)
+
+    async def stream(
+        self,
+        user_id: int,
+        since: Optional[int] = None,
+        heartbeat: float = config.EVENT_HEARTBEAT_SECONDS,
+    ) -> AsyncIterator[Optional[ChangeEvent]]:
+        """
+        Events visible to `user_id` after sequence `since`. Yields None when
+        nothing happened for `heartbeat` seconds so callers can keep the
+        connection alive.
+        """
+        subscription = await self._backend.subscribe(since)
+        try:
+            if subscription.reset is not None:
+                yield subscription.reset
+            # A shared backend may also queue events it has just replayed
+            replayed = {event.seq for event in subscription.replay}
+            for event in subscription.replay:
+                if event.audience is None or user_id in event.audience:
+                    yield event
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event.seq in replayed and event.type != RESET:
+                    continue
+                if event.audience is None or user_id in event.audience:
+                    yield event
+        finally:
+            self._backend.unsubscribe(subscription)
+
+bus = EventBus(MemoryBackend())
+
+def expense_data(expense: Expense) -> dict:
+    # Server-generated timestamps are left out: they are expired after a flush
+    return jsonable_encoder({
+        "id": expense.id,
+        "amount": expense.amount,
+        "currency": expense.currency,
+        "date": expense.date,
+        "description": expense.description,
+        "status": expense.status,
+        "owner_id": expense.owner_id,
+    })
+
+async def build_expense_events(db: AsyncSession, event_type: str, expenses: List[Expense]) -> List[PendingEvent]:
+    """
+    Events for changed expenses, built in the writing transaction: everyone
+    holding a step and the owner's manager hear about the change. Two
+    queries regardless of the number of expenses.
+    """
+    if not expenses:
+        return []
+    steps: Dict[int, List[tuple]] = {}
+    for row in await db.execute(
+        select(ApprovalStep.expense_id, ApprovalStep.approver_id, ApprovalStep.status)
+        .where(ApprovalStep.expense_id.in_([expense.id for expense in expenses]))
+    ):
+        steps.setdefault(row.expense_id, []).append((row.approver_id, row.status))
+    managers = dict((await db.execute(
+        select(User.id, User.manager_id)
+        .where(User.id.in_({expense.owner_id for expense in expenses}), User.manager_id.is_not(None))
+    )).all())
+
+    events = []
+    for expense in expenses:
+        expense_steps = steps.get(expense.id, [])
+        manager_id = managers.get(expense.owner_id)
+        audience = {approver_id for approver_id, _ in expense_steps}
+        if manager_id is not None:
+            audience.add(manager_id)
+        if event_type == EXPENSE_DELETED or expense.status != ExpenseStatus.PENDING:
+            pending_for = []
+        elif expense_steps:
+            pending_for = sorted(approver_id for approver_id, step_status in expense_steps if step_status == StepStatus.PENDING)
+        else:
+            pending_for = [manager_id] if manager_id is not None else []
+        data = expense_data(expense)
+        data["pending_for"] = pending_for
+        events.append(PendingEvent(event_type, frozenset(audience), data))
+    return events
+
+def change_tags(events: List[PendingEvent]) -> Set[str]:
+    """Response cache tags the changes behind `events` can show up under"""
+    tags = {EXPENSES_TAG} if events else set()
+    for event in events:
+        tags.add(expense_tag(event.data["id"]))
+        tags.add(owner_tag(event.data["owner_id"]))
+        tags.update(pending_tag(user_id) for user_id in event.audience)
+    return tags
+
+def format_sse(event: Optional[ChangeEvent]) -> str:
+    """Server-Sent Events framing; None becomes a keep-alive comment"""
+    if event is None:
+        return ": keep-alive\n\n"
+    data = json.dumps(event.data, separators=(",", ":"))
+    return f"id: {event.seq}\nevent: {event.type}\ndata: {data}\n\n"
+
+def event_message(event: ChangeEvent) -> dict:
+    return {"seq": event.seq, "type": event.type, "data": event.data}
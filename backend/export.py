@@ -0,0 +1,92 @@
+import csv
+import io
+import zlib
+from datetime import datetime
+from typing import Iterable, Iterator, List, Sequence
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from archive import archive_probe
+from currency import converter
+from models import Expense, ExpenseArchive
+from pagination import ExpenseFilters
+from responses import dumps
+
+# Number of rows fetched per round trip from the server-side cursor
+EXPORT_BATCH_SIZE = 5000
+
+# Columns read from the table; amount_base is appended per batch
+SELECTED_COLUMNS = [
+    "id", "amount", "currency", "date", "description",
+    "status", "owner_id", "created_at", "updated_at",
+]
+EXPORT_COLUMNS = SELECTED_COLUMNS + ["amount_base"]
+
+def _to_plain(value):
+    """Convert column values into JSON/CSV friendly scalars."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, "value"):  # Enum members such as ExpenseStatus
+        return value.value
+    return value
+
+def iter_expense_batches(
+    db: Session,
+    filters: ExpenseFilters,
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> Iterator[List[Sequence]]:
+    """
+    Yield lists of plain row tuples read through a server-side cursor.
+    Only one batch is held in memory at a time. Base-currency amounts are
+    converted per batch so each distinct (currency, day) is resolved once.
+    Hot expenses come first in id order, then archived ones when the
+    filters can reach the archive.
+    """
+    models = [Expense]
+    probe = archive_probe(filters)
+    if probe is not None and db.execute(probe).first() is not None:
+        models.append(ExpenseArchive)
+    for model in models:
+        columns = [getattr(model, name) for name in SELECTED_COLUMNS]
+        stmt = filters.apply(select(*columns), model).order_by(model.id)
+        result = db.execute(stmt.execution_options(yield_per=batch_size))
+        for partition in result.partitions():
+            converted = converter.convert_batch(
+                [row.amount for row in partition],
+                [row.currency for row in partition],
+                [row.date for row in partition],
+            )
+            yield [
+                tuple(_to_plain(value) for value in row) + (amount_base,)
+                for row, amount_base in zip(partition, converted)
+            ]
+
+def render_ndjson(batches: Iterable[List[Sequence]]) -> Iterator[bytes]:
+    """Render row batches as newline-delimited JSON, one chunk per batch."""
+    for batch in batches:
+        lines = [dumps(dict(zip(EXPORT_COLUMNS, row))) for row in batch]
+        yield b"\n".join(lines) + b"\n"
+
+def render_csv(batches: Iterable[List[Sequence]]) -> Iterator[bytes]:
+    """Render row batches as CSV with a header line, one chunk per batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only when there were no rows at all
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def gzip_stream(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """Compress a byte stream incrementally into a single gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,133 @@
+"""
+The reporting hierarchy as a closure table.
+
+users.manager_id stays the source of truth for who approves whose expenses.
+user_hierarchy mirrors it with one row per (ancestor, descendant) pair and
+their distance, plus every user paired with themselves at depth 0. Both
+"my direct reports" and "everyone below me" are then a range scan of the
+(ancestor_id, descendant_id) primary key in id order, however deep the
+organisation is, and keyset pagination on descendant_id follows the index.
+
+Changes to manager_id go through move_user(), which re-links the user's
+whole subtree in two statements and refuses a manager who already reports
+to the user. install_hierarchy() runs with create_tables() and rebuilds
+the table when users were inserted without it (an existing database, seed
+scripts writing users directly).
+"""
+import logging
+from typing import Optional
+
+from sqlalchemy import Connection, and_, delete, func, insert, literal, select, true
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from models import User, UserHierarchy
+
+logger = logging.getLogger(__name__)
+
+# Rebuilds stop descending here, so a cycle in legacy manager_id data cannot loop forever
+MAX_DEPTH = 64
+
+COLUMNS = ["ancestor_id", "descendant_id", "depth"]
+
+def reportees_filter(manager_id: int, recursive: bool = False):
+    """WHERE clause on UserHierarchy selecting the users below `manager_id`"""
+    depth = UserHierarchy.depth >= 1 if recursive else UserHierarchy.depth == 1
+    return and_(UserHierarchy.ancestor_id == manager_id, depth)
+
+async def is_below(db: AsyncSession, manager_id: int, user_id: int) -> bool:
+    """Whether `user_id` reports to `manager_id`, directly or not"""
+    row = (await db.execute(
+        select(UserHierarchy.depth).where(
+            UserHierarchy.ancestor_id == manager_id,
+            UserHierarchy.descendant_id == user_id,
+            UserHierarchy.depth > 0
+        )
+    )).first()
+    return row is not None
+
+async def has_reportees(db: AsyncSession, user_id: int) -> bool:
+    return (await db.execute(
+        select(UserHierarchy.descendant_id).where(reportees_filter(user_id)).limit(1)
+    )).first() is not None
+
+async def add_user(db: AsyncSession, user_id: int, manager_id: Optional[int]):
+    """Rows for a new (flushed) user; its users.manager_id is set by the caller"""
+    await db.execute(insert(UserHierarchy).values(ancestor_id=user_id, descendant_id=user_id, depth=0))
+    if manager_id is not None:
+        await move_user(db, user_id, manager_id)
+
+async def move_user(db: AsyncSession, user_id: int, manager_id: Optional[int]):
+    """
+    Put `user_id` and everyone below them under `manager_id` (None for the
+    top of the organisation). Raises ValueError when that would make someone
+    their own manager. The caller updates users.manager_id in the same
+    transaction.
+    """
+    if manager_id == user_id:
+        raise ValueError(f"User {user_id} cannot be their own manager")
+    if manager_id is not None and await is_below(db, user_id, manager_id):
+        raise ValueError(f"User {manager_id} reports to user {user_id} and cannot become their manager")
+
+    # Aliased so the subqueries are not correlated with the statement's own table
+    subtree = aliased(UserHierarchy)
+    members = select(subtree.descendant_id).where(subtree.ancestor_id == user_id)
+    # Detach the subtree from its current ancestors; links inside it are unchanged
+    await db.execute(
+        delete(UserHierarchy).where(
+            UserHierarchy.descendant_id.in_(members),
+            UserHierarchy.ancestor_id.not_in(members)
+        )
+    )
+    if manager_id is None:
+        return
+
+    # Every ancestor of the new manager (the manager included) above every member of the subtree
+    above = aliased(UserHierarchy)
+    below = aliased(UserHierarchy)
+    await db.execute(
+        insert(UserHierarchy).from_select(
+            COLUMNS,
+            select(above.ancestor_id, below.descendant_id, above.depth + below.depth + 1)
+            .select_from(above)
+            .join(below, true())
+            .where(above.descendant_id == manager_id, below.ancestor_id == user_id)
+        )
+    )
+
+async def remove_user(db: AsyncSession, user_id: int):
+    """Drop the rows of a user without reportees, before the user is deleted"""
+    await db.execute(
+        delete(UserHierarchy).where(UserHierarchy.descendant_id == user_id)
+    )
+
+def rebuild_hierarchy(connection: Connection):
+    """Recompute the whole table from users.manager_id"""
+    reports = aliased(User)
+    tree = select(
+        User.id.label("ancestor_id"), User.id.label("descendant_id"), literal(0).label("depth")
+    ).cte("tree", recursive=True)
+    tree = tree.union_all(
+        select(tree.c.ancestor_id, reports.id, tree.c.depth + 1)
+        .join(reports, reports.manager_id == tree.c.descendant_id)
+        .where(tree.c.depth < MAX_DEPTH)
+    )
+    connection.execute(delete(UserHierarchy))
+    # A cycle reaches the same pair more than once; keep the shortest path
+    connection.execute(
+        insert(UserHierarchy).from_select(
+            COLUMNS,
+            select(tree.c.ancestor_id, tree.c.descendant_id, func.min(tree.c.depth))
+            .group_by(tree.c.ancestor_id, tree.c.descendant_id)
+        )
+    )
+
+def install_hierarchy(connection: Connection):
+    """Rebuild the table if some user has no row of their own"""
+    users = connection.execute(select(func.count()).select_from(User)).scalar_one()
+    nodes = connection.execute(
+        select(func.count()).select_from(UserHierarchy).where(UserHierarchy.depth == 0)
+    ).scalar_one()
+    if users != nodes:
+        logger.info("Rebuilding user_hierarchy for %d users", users)
+        rebuild_hierarchy(connection)
@@ -1,10 +1,65 @@
-from fastapi import FastAPI
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from database import engine, Base, create_tables
-from routers import users, expenses, approvals
+from sqlalchemy import text
+import config
+from database import engine, async_engine, Base, create_tables, pool_stats, warm_pool
+from routers import auth, users, expenses, approvals, rules, receipts, audit
+from auth import get_current_principal
+from receipts import shutdown_thumbnail_pool
+from ocr import ocr_queue
+from audit import audit_log
+from cache import redis_backend, response_cache
+from currency import converter
+from responses import ORJSONResponse
+from metrics import MetricsMiddleware, render_metrics
+import events
+import ratelimit
+from events import bus
+from ratelimit import RateLimitMiddleware, rate_limiter
 
-# Create database tables
-create_tables()
+async def initialize_database():
+    """One-time setup per deployment: schema, and OCR jobs the last shutdown interrupted"""
+    await run_in_threadpool(create_tables)
+    await ocr_queue.requeue_interrupted()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Warm the worker before it takes traffic and release everything once it
+    has drained. On SIGTERM the server stops accepting connections and lets
+    in-flight requests finish (server.py bounds that with
+    WEB_GRACEFUL_TIMEOUT) before the shutdown half runs.
+    """
+    if config.INIT_ON_STARTUP:
+        await initialize_database()
+    if config.REDIS_URL:
+        response_cache.use_backend(redis_backend(config.REDIS_URL))
+        rate_limiter.use_backend(ratelimit.redis_backend(config.REDIS_URL))
+        bus.use_backend(events.redis_backend(config.REDIS_URL))
+    await warm_pool()
+    # Exchange rates, reloaded in the background from here on
+    await converter.start()
+    # Receipt OCR workers, picking up jobs left queued
+    await ocr_queue.start()
+    # Batched writer for the expense audit trail
+    await audit_log.start()
+    # Approval change feed listener (a no-op without a shared backend)
+    await bus.start()
+    yield
+    await bus.stop()
+    await ocr_queue.stop()
+    await converter.stop()
+    # After the last request, so every committed audit event is written
+    await audit_log.stop()
+    shutdown_thumbnail_pool()
+    # Close pooled connections so driver threads do not outlive the app
+    await async_engine.dispose()
+    engine.dispose()
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -12,9 +67,14 @@ app = FastAPI(
     description="Backend API for Expense Management System with React frontend support",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
+# Innermost of the three, so refusals still carry CORS headers and are timed
+app.add_middleware(RateLimitMiddleware)
+
 # Add CORS middleware for React frontend
 app.add_middleware(
     CORSMiddleware,
@@ -25,14 +85,22 @@ app.add_middleware(
         "http://127.0.0.1:5173",
     ],
     allow_credentials=True,
-    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
     allow_headers=["*"],
 )
 
-# Include all routers
-app.include_router(users.router, prefix="/api/users", tags=["users"])
-app.include_router(expenses.router, prefix="/api/expenses", tags=["expenses"])
-app.include_router(approvals.router, prefix="/api/approvals", tags=["approvals"])
+# Outermost, so the timings include the other middleware
+app.add_middleware(MetricsMiddleware)
+
+# Include all routers; everything but login requires a bearer token
+authenticated = [Depends(get_current_principal)]
+app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
+app.include_router(users.router, prefix="/api/users", tags=["users"], dependencies=authenticated)
+app.include_router(expenses.router, prefix="/api/expenses", tags=["expenses"], dependencies=authenticated)
+app.include_router(approvals.router, prefix="/api/approvals", tags=["approvals"], dependencies=authenticated)
+app.include_router(rules.router, prefix="/api/approval-rules", tags=["approval-rules"], dependencies=authenticated)
+app.include_router(receipts.router, prefix="/api/expenses", tags=["receipts"], dependencies=authenticated)
+app.include_router(audit.router, prefix="/api/audit", tags=["audit"], dependencies=authenticated)
 
 @app.get("/")
 async def root():
@@ -41,50 +109,106 @@ async def root():
         "version": "1.0.0",
         "docs": "/docs",
         "endpoints": {
+            "auth": "/api/auth",
             "users": "/api/users",
             "expenses": "/api/expenses", 
-            "approvals": "/api/approvals"
+            "approvals": "/api/approvals",
+            "approval_rules": "/api/approval-rules",
+            "audit": "/api/audit"
         }
     }
 
+async def probe_database() -> dict:
+    """Run a trivial query through the async pool, bounded by HEALTH_DB_TIMEOUT_MS"""
+    started = time.perf_counter()
+    try:
+        async def ping():
+            async with async_engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+        await asyncio.wait_for(ping(), timeout=config.HEALTH_DB_TIMEOUT_MS / 1000)
+    except asyncio.TimeoutError:
+        return {"status": "timeout", "latency_ms": config.HEALTH_DB_TIMEOUT_MS}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
+    return {"status": "connected", "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+
 @app.get("/health")
 async def health_check():
-    return {
-        "status": "healthy",
-        "database": "connected",
-        "tables_created": True
-    }
+    database = await probe_database()
+    healthy = database["status"] == "connected"
+    return ORJSONResponse(
+        status_code=status.HTTP_200_OK if healthy else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={
+            "status": "healthy" if healthy else "unhealthy",
+            "database": database,
+            "pool": pool_stats(),
+            "ocr": ocr_queue.stats(),
+            "response_cache": response_cache.stats()
+        }
+    )
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text exposition"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 @app.get("/api")
 async def api_info():
     return {
         "message": "Expense Management System API",
         "endpoints": {
+            "auth": {
+                "base_url": "/api/auth",
+                "endpoints": {
+                    "login": "POST /api/auth/login",
+                    "me": "GET /api/auth/me"
+                }
+            },
             "users": {
                 "base_url": "/api/users",
-                "description": "User management endpoints"
+                "endpoints": {
+                    "list": "GET /api/users (Admin only)",
+                    "create": "POST /api/users (Admin only)",
+                    "reportees": "GET /api/users/{user_id}/reportees?recursive=",
+                    "role": "PATCH /api/users/{user_id}/role (Admin only)",
+                    "batch": "POST /api/users/batch (Admin only)"
+                }
             },
             "expenses": {
                 "base_url": "/api/expenses",
                 "endpoints": {
                     "create": "POST /api/expenses",
                     "my_expenses": "GET /api/expenses/mine",
-                    "all_expenses": "GET /api/expenses/all (Admin only)"
+                    "all_expenses": "GET /api/expenses/all (Admin only)",
+                    "search": "GET /api/expenses/search?q=",
+                    "export": "GET /api/expenses/export (Admin only)",
+                    "receipts": "POST/GET /api/expenses/{expense_id}/receipts",
+                    "ocr": "GET/POST /api/expenses/{expense_id}/ocr"
                 }
             },
             "approvals": {
                 "base_url": "/api/approvals",
                 "endpoints": {
                     "pending": "GET /api/approvals/pending",
-                    "approve_reject": "POST /api/approvals/{expense_id}"
+                    "assigned": "GET /api/approvals/assigned",
+                    "stream": "GET /api/approvals/stream (SSE) or WebSocket /api/approvals/stream",
+                    "approve_reject": "POST /api/approvals/{expense_id}",
+                    "batch": "POST /api/approvals/batch"
+                }
+            },
+            "audit": {
+                "base_url": "/api/audit",
+                "endpoints": {
+                    "events": "GET /api/audit/events?expense_id=&actor_id=&action="
                 }
             }
         }
     }
 
 if __name__ == "__main__":
+    # Development server with auto-reload; run server.py in production
     import uvicorn
     print("Starting Expense Management System API...")
     print("API Documentation available at: http://localhost:8000/docs")
     print("React frontend should connect to: http://localhost:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
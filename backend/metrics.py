@@ -0,0 +1,297 @@
+"""
+Request and database instrumentation, exposed in Prometheus text format.
+
+MetricsMiddleware times every HTTP request and labels it with the route
+template (/api/expenses/{expense_id}, not the concrete path) so label
+cardinality stays bounded. SQLAlchemy cursor hooks count statements and SQL
+time, both in total and for the request that issued them; the per-request
+tally travels in a context variable, which SQLAlchemy's async greenlets and
+the thread pool both inherit.
+
+A request running the same statement N_PLUS_ONE_THRESHOLD times or more,
+or lazy-loading the same relationship that often (Expense.owner per row, for
+example), is counted under db_n_plus_one_total and logged with the
+offending statement.
+
+Responses carry a Server-Timing header with the time spent so far and the
+database share, which browser dev tools display per request.
+
+No client library is needed: the registry below renders the exposition
+format itself. Other modules report their own state through collectors
+(see registry.add_collector).
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import ORMExecuteState, Session
+
+import config
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Metric:
+    """A named family of samples keyed by label values"""
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in values
+        ]
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels: str, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: per-bucket counts (last one is +Inf), sum
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        lines = self.header()
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+# A collector returns (name, type, help, [(labels, value)]) families computed at scrape time
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors: List[Collector] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+HTTP_REQUESTS = registry.register(Counter(
+    "http_requests_total", "HTTP requests by route and status code", ("method", "route", "status")
+))
+HTTP_LATENCY = registry.register(Histogram(
+    "http_request_duration_seconds", "Time from request start to the end of the response body", ("method", "route")
+))
+HTTP_IN_FLIGHT = registry.register(Gauge(
+    "http_requests_in_flight", "Requests currently being handled", ("method",)
+))
+DB_QUERIES = registry.register(Counter(
+    "db_queries_total", "SQL statements executed", ("engine",)
+))
+DB_QUERY_LATENCY = registry.register(Histogram(
+    "db_query_duration_seconds", "Time spent executing one SQL statement", ("engine",)
+))
+DB_QUERIES_PER_REQUEST = registry.register(Histogram(
+    "db_queries_per_request", "SQL statements executed while handling one request", ("route",), QUERY_COUNT_BUCKETS
+))
+DB_SECONDS_PER_REQUEST = registry.register(Histogram(
+    "db_seconds_per_request", "SQL time spent while handling one request", ("route",)
+))
+DB_LAZY_LOADS = registry.register(Counter(
+    "db_lazy_loads_total", "Relationship lazy loads", ("relationship",)
+))
+DB_N_PLUS_ONE = registry.register(Counter(
+    "db_n_plus_one_total", "Requests that repeated one statement or lazy load at least N_PLUS_ONE_THRESHOLD times", ("route",)
+))
+
+class RequestStats:
+    """Database work done on behalf of one request"""
+    __slots__ = ("queries", "sql_seconds", "statements", "lazy_loads")
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.statements: Dict[str, int] = {}
+        self.lazy_loads: Dict[str, int] = {}
+
+    def repeated(self, threshold: int) -> List[Tuple[str, int]]:
+        """Statements and lazy-loaded relationships seen at least `threshold` times"""
+        found = [(f"lazy load of {name}", count) for name, count in self.lazy_loads.items() if count >= threshold]
+        found += [(statement, count) for statement, count in self.statements.items() if count >= threshold]
+        return found
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+def current_request_stats() -> Optional[RequestStats]:
+    return _request_stats.get()
+
+def track_queries(sync_engine, name: str):
+    """Count statements and SQL time on an engine, globally and per request"""
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        DB_QUERIES.inc(name)
+        DB_QUERY_LATENCY.observe(elapsed, name)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.sql_seconds += elapsed
+            # Bound parameters are placeholders here, so repeats of one lookup share a key
+            if statement.lstrip()[:6].upper() == "SELECT":
+                stats.statements[statement] = stats.statements.get(statement, 0) + 1
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_started"):
+            connection.info["query_started"].pop()
+
+@event.listens_for(Session, "do_orm_execute")
+def _count_lazy_loads(orm_execute_state: ORMExecuteState):
+    if not orm_execute_state.is_select or orm_execute_state.lazy_loaded_from is None:
+        return
+    path = orm_execute_state.loader_strategy_path
+    relationship = str(path[-1]) if path else "unknown"
+    DB_LAZY_LOADS.inc(relationship)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.lazy_loads[relationship] = stats.lazy_loads.get(relationship, 0) + 1
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, so streamed bodies are timed to their last chunk"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        started = time.perf_counter()
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                timing = (
+                    f'app;dur={elapsed_ms:.1f}, '
+                    f'db;dur={stats.sql_seconds * 1000:.1f};desc="queries: {stats.queries}"'
+                )
+                message.setdefault("headers", []).append((b"server-timing", timing.encode()))
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(method)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec(method)
+            _request_stats.reset(token)
+            # The router stores the matched route in the scope; unmatched paths share one label
+            route = getattr(scope.get("route"), "path", "unmatched")
+            elapsed = time.perf_counter() - started
+            HTTP_REQUESTS.inc(method, route, str(status_code))
+            HTTP_LATENCY.observe(elapsed, method, route)
+            DB_QUERIES_PER_REQUEST.observe(stats.queries, route)
+            DB_SECONDS_PER_REQUEST.observe(stats.sql_seconds, route)
+
+            repeated = stats.repeated(config.N_PLUS_ONE_THRESHOLD)
+            if repeated:
+                DB_N_PLUS_ONE.inc(route)
+                for statement, count in repeated:
+                    logger.warning(
+                        "Possible N+1 in %s %s: %d executions of %s",
+                        method, route, count, " ".join(statement.split())[:300]
+                    )
+
+def render_metrics() -> str:
+    return registry.render()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Text, Enum
+from sqlalchemy import BigInteger, Column, Integer, String, Float, Date, DateTime, ForeignKey, Text, Enum, Index, UniqueConstraint, Boolean, JSON
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import enum
@@ -16,6 +16,34 @@ class ExpenseStatus(str, enum.Enum):
     APPROVED = "Approved"
     REJECTED = "Rejected"
 
+# Enum for the state of one approver's step in an approval workflow
+class StepStatus(str, enum.Enum):
+    WAITING = "Waiting"  # Earlier steps of a sequential chain are still open
+    PENDING = "Pending"  # Awaiting this approver's decision
+    APPROVED = "Approved"
+    REJECTED = "Rejected"
+    SKIPPED = "Skipped"  # The expense was decided before this step was reached
+
+# Enum for the state of a receipt OCR job
+class OcrStatus(str, enum.Enum):
+    QUEUED = "Queued"
+    RUNNING = "Running"
+    DONE = "Done"
+    FAILED = "Failed"
+
+# Enum for the change an audit event records
+class AuditAction(str, enum.Enum):
+    CREATED = "Created"
+    UPDATED = "Updated"
+    DELETED = "Deleted"
+    APPROVED = "Approved"
+    REJECTED = "Rejected"
+
+# Enum for why an expense is suspected to duplicate another
+class DuplicateReason(str, enum.Enum):
+    EXACT = "Exact"  # Same owner, amount, currency and day
+    SIMILAR = "Similar"  # Near-identical description
+
 class User(Base):
     __tablename__ = "users"
     
@@ -23,6 +51,8 @@ class User(Base):
     name = Column(String(100), nullable=False, index=True)
     role = Column(Enum(UserRole), nullable=False, default=UserRole.EMPLOYEE)
     email = Column(String(255), unique=True, index=True, nullable=False)
+    manager_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)  # Approves this user's expenses
+    password_hash = Column(String(255), nullable=True)  # bcrypt; users without one cannot log in
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
@@ -32,6 +62,22 @@ class User(Base):
     def __repr__(self):
         return f"<User(id={self.id}, name='{self.name}', role='{self.role}')>"
 
+class UserHierarchy(Base):
+    """Closure of users.manager_id: one row per (manager, anyone below them), plus (user, user) at depth 0"""
+    __tablename__ = "user_hierarchy"
+    
+    ancestor_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    depth = Column(Integer, nullable=False)  # 1 for direct reportees
+    
+    __table_args__ = (
+        # Moving a subtree looks up its members' ancestors
+        Index("ix_user_hierarchy_descendant_ancestor", "descendant_id", "ancestor_id"),
+    )
+    
+    def __repr__(self):
+        return f"<UserHierarchy(ancestor_id={self.ancestor_id}, descendant_id={self.descendant_id}, depth={self.depth})>"
+
 class Expense(Base):
     __tablename__ = "expenses"
     
@@ -48,5 +94,266 @@ class Expense(Base):
     # Relationships
     owner = relationship("User", back_populates="expenses")
     
+    # Converted amount in the base currency; filled in by currency.attach_base_amounts, not persisted
+    amount_base = None
+    # Earlier expenses this one may duplicate; filled in by duplicates.detect on create, not persisted
+    suspected_duplicates = None
+    
+    # Composite indexes backing keyset pagination on (date, id) and (amount, id),
+    # optionally narrowed by the most common equality filters
+    __table_args__ = (
+        Index("ix_expenses_date_id", "date", "id"),
+        Index("ix_expenses_amount_id", "amount", "id"),
+        Index("ix_expenses_status_date_id", "status", "date", "id"),
+        Index("ix_expenses_owner_date_id", "owner_id", "date", "id"),
+        Index("ix_expenses_currency_date_id", "currency", "date", "id"),
+        # Per-manager pending queue over the manager's reportees
+        Index("ix_expenses_status_owner_id", "status", "owner_id", "id"),
+        # SQLite would otherwise hand a deleted highest id out again, colliding with the archive
+        {"sqlite_autoincrement": True},
+    )
+    
+    def __repr__(self):
+        return f"<Expense(id={self.id}, amount={self.amount}, status='{self.status}')>"
+
+class ExpenseArchive(Base):
+    """Decided expenses moved out of `expenses` by archive.py, with the ids they had there"""
+    __tablename__ = "expenses_archive"
+    
+    id = Column(Integer, primary_key=True)
+    amount = Column(Float, nullable=False)
+    currency = Column(String(3), nullable=False)
+    date = Column(DateTime(timezone=True), nullable=False)
+    description = Column(Text, nullable=False)
+    status = Column(Enum(ExpenseStatus), nullable=False)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    created_at = Column(DateTime(timezone=True))
+    updated_at = Column(DateTime(timezone=True))
+    archived_at = Column(DateTime(timezone=True), nullable=False)
+    
+    # Cold rows are read by date range and by owner only
+    __table_args__ = (
+        Index("ix_expenses_archive_date_id", "date", "id"),
+        Index("ix_expenses_archive_owner_date_id", "owner_id", "date", "id"),
+    )
+    
+    def __repr__(self):
+        return f"<ExpenseArchive(id={self.id}, amount={self.amount}, status='{self.status}')>"
+
+class ExpenseSummary(Base):
+    """Running totals per owner, status, currency and month, maintained on every expense write"""
+    __tablename__ = "expense_summaries"
+    
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    status = Column(Enum(ExpenseStatus), nullable=False)
+    currency = Column(String(3), nullable=False)
+    month = Column(String(7), nullable=False)  # YYYY-MM of the expense date
+    expense_count = Column(Integer, nullable=False, default=0)
+    total_amount = Column(Float, nullable=False, default=0.0)
+    
+    __table_args__ = (
+        UniqueConstraint("owner_id", "status", "currency", "month", name="uq_expense_summaries_group"),
+        Index("ix_expense_summaries_status_month", "status", "month"),
+    )
+    
+    def __repr__(self):
+        return f"<ExpenseSummary(owner_id={self.owner_id}, status='{self.status}', currency='{self.currency}', month='{self.month}')>"
+
+class ExchangeRate(Base):
+    """Units of the base currency per unit of `currency`, effective from `effective_date`"""
+    __tablename__ = "exchange_rates"
+    
+    id = Column(Integer, primary_key=True)
+    currency = Column(String(3), nullable=False)
+    effective_date = Column(Date, nullable=False)
+    rate = Column(Float, nullable=False)
+    
+    __table_args__ = (
+        UniqueConstraint("currency", "effective_date", name="uq_exchange_rates_currency_date"),
+    )
+    
+    def __repr__(self):
+        return f"<ExchangeRate(currency='{self.currency}', effective_date={self.effective_date}, rate={self.rate})>"
+
+class ApprovalRule(Base):
+    """Routes expenses within an amount band to a chain of approvers"""
+    __tablename__ = "approval_rules"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(100), nullable=False)
+    is_active = Column(Boolean, nullable=False, default=True)
+    priority = Column(Integer, nullable=False, default=100)  # Lower wins when bands overlap
+    min_amount = Column(Float, nullable=False, default=0.0)  # Inclusive, in the base currency
+    max_amount = Column(Float, nullable=True)  # Exclusive; no upper bound when null
+    is_sequential = Column(Boolean, nullable=False, default=True)  # Otherwise all approvers decide in parallel
+    approval_percentage = Column(Integer, nullable=True)  # Quorum for parallel rules; all approvers when null
+    specific_approver_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # Approves outright
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    
+    # Relationships
+    approvers = relationship(
+        "ApprovalRuleApprover",
+        back_populates="rule",
+        cascade="all, delete-orphan",
+        order_by="ApprovalRuleApprover.sequence",
+    )
+    
+    def __repr__(self):
+        return f"<ApprovalRule(id={self.id}, name='{self.name}', priority={self.priority})>"
+
+class ApprovalRuleApprover(Base):
+    __tablename__ = "approval_rule_approvers"
+    
+    id = Column(Integer, primary_key=True)
+    rule_id = Column(Integer, ForeignKey("approval_rules.id", ondelete="CASCADE"), nullable=False)
+    sequence = Column(Integer, nullable=False)
+    approver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    
+    # Relationships
+    rule = relationship("ApprovalRule", back_populates="approvers")
+    
+    __table_args__ = (
+        UniqueConstraint("rule_id", "sequence", name="uq_approval_rule_approvers_sequence"),
+    )
+
+class ApprovalRulesVersion(Base):
+    """Single row counting rule edits, so every worker can tell its compiled rules are stale"""
+    __tablename__ = "approval_rules_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class ApprovalStep(Base):
+    """One approver's part in the workflow of a single expense"""
+    __tablename__ = "approval_steps"
+    
+    id = Column(Integer, primary_key=True)
+    expense_id = Column(Integer, ForeignKey("expenses.id", ondelete="CASCADE"), nullable=False)
+    rule_id = Column(Integer, ForeignKey("approval_rules.id", ondelete="SET NULL"), nullable=True)
+    approver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    sequence = Column(Integer, nullable=False)
+    is_override = Column(Boolean, nullable=False, default=False)  # Specific approver step
+    status = Column(Enum(StepStatus), nullable=False)
+    comments = Column(Text, nullable=True)
+    decided_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    __table_args__ = (
+        # "Pending for me" lookups
+        Index("ix_approval_steps_status_approver_created", "status", "approver_id", "created_at"),
+        Index("ix_approval_steps_expense_sequence", "expense_id", "sequence"),
+    )
+    
+    def __repr__(self):
+        return f"<ApprovalStep(expense_id={self.expense_id}, approver_id={self.approver_id}, status='{self.status}')>"
+
+class ApprovalStepArchive(Base):
+    """Workflow steps of archived expenses, moved alongside them"""
+    __tablename__ = "approval_steps_archive"
+    
+    id = Column(Integer, primary_key=True)
+    expense_id = Column(Integer, nullable=False, index=True)
+    rule_id = Column(Integer, nullable=True)
+    approver_id = Column(Integer, nullable=False)
+    sequence = Column(Integer, nullable=False)
+    is_override = Column(Boolean, nullable=False, default=False)
+    status = Column(Enum(StepStatus), nullable=False)
+    comments = Column(Text, nullable=True)
+    decided_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True))
+    
+    def __repr__(self):
+        return f"<ApprovalStepArchive(expense_id={self.expense_id}, approver_id={self.approver_id}, status='{self.status}')>"
+
+class Receipt(Base):
+    """A file attached to an expense; the bytes live in content-addressed storage"""
+    __tablename__ = "receipts"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    expense_id = Column(Integer, ForeignKey("expenses.id", ondelete="CASCADE"), nullable=False, index=True)
+    sha256 = Column(String(64), nullable=False, index=True)  # Blob key; shared by duplicate uploads
+    filename = Column(String(255), nullable=False)
+    content_type = Column(String(100), nullable=False)  # Sniffed from the file, not taken from the client
+    size = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    def __repr__(self):
+        return f"<Receipt(id={self.id}, expense_id={self.expense_id}, sha256='{self.sha256[:12]}')>"
+
+class OcrResult(Base):
+    """Extraction result for one receipt file, shared by every upload of the same content"""
+    __tablename__ = "ocr_results"
+    
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String(64), nullable=False, unique=True)  # Receipt blob digest
+    status = Column(Enum(OcrStatus), nullable=False, default=OcrStatus.QUEUED)
+    attempts = Column(Integer, nullable=False, default=0)
+    engine = Column(String(50), nullable=True)
+    vendor = Column(String(255), nullable=True)
+    amount = Column(Float, nullable=True)
+    currency = Column(String(3), nullable=True)
+    date = Column(DateTime(timezone=True), nullable=True)
+    text = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    duration_ms = Column(Integer, nullable=True)  # Engine time of the last attempt
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    
+    __table_args__ = (
+        Index("ix_ocr_results_status", "status"),
+    )
+    
+    def __repr__(self):
+        return f"<OcrResult(sha256='{self.sha256[:12]}', status='{self.status}')>"
+
+class ExpenseEvent(Base):
+    """Append-only audit trail of expense changes; rows are only ever inserted (see audit.py)"""
+    __tablename__ = "expense_events"
+    
+    id = Column(Integer, primary_key=True)
+    # No foreign keys: the trail outlives deleted expenses and users
+    expense_id = Column(Integer, nullable=False)
+    actor_id = Column(Integer, nullable=True)
+    action = Column(Enum(AuditAction), nullable=False)
+    comments = Column(Text, nullable=True)
+    before_values = Column(JSON, nullable=True)  # Changed fields before the write; null for creations
+    after_values = Column(JSON, nullable=True)  # Changed fields after the write; null for deletions
+    created_at = Column(DateTime(timezone=True), nullable=False)  # When the change was made, not when the row was flushed
+    
+    __table_args__ = (
+        Index("ix_expense_events_expense_id_id", "expense_id", "id"),
+        Index("ix_expense_events_actor_id_id", "actor_id", "id"),
+    )
+    
+    def __repr__(self):
+        return f"<ExpenseEvent(id={self.id}, expense_id={self.expense_id}, action='{self.action}')>"
+
+class ExpenseSignature(Base):
+    """Duplicate-detection keys of an expense: its fingerprint and MinHash bands (see duplicates.py)"""
+    __tablename__ = "expense_signatures"
+    
+    key = Column(BigInteger, primary_key=True)
+    expense_id = Column(Integer, primary_key=True)
+    
+    __table_args__ = (
+        Index("ix_expense_signatures_expense_id", "expense_id"),
+    )
+    
+    def __repr__(self):
+        return f"<ExpenseSignature(key={self.key}, expense_id={self.expense_id})>"
+
+class ExpenseSuspect(Base):
+    """An expense flagged as a possible duplicate of an earlier one"""
+    __tablename__ = "expense_suspects"
+    
+    # No foreign keys, like expense_events: the earlier expense may be archived
+    expense_id = Column(Integer, primary_key=True)
+    duplicate_of_id = Column(Integer, primary_key=True)
+    reason = Column(Enum(DuplicateReason), nullable=False)
+    similarity = Column(Float, nullable=False)  # Jaccard similarity of the description shingles
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
     def __repr__(self):
-        return f"<Expense(id={self.id}, amount={self.amount}, status='{self.status}')>"
\ No newline at end of file
+        return f"<ExpenseSuspect(expense_id={self.expense_id}, duplicate_of_id={self.duplicate_of_id}, reason='{self.reason}')>"
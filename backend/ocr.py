@@ -0,0 +1,324 @@
+"""
+Receipt OCR.
+
+Uploaded receipts are queued for text extraction, and the text is parsed
+into the fields of an expense (vendor, amount, currency, date) so reviewers
+can confirm instead of retyping them. Results live in ocr_results keyed by
+the receipt's SHA-256, which makes the table the result cache: a re-upload
+of the same file, on any expense, reuses the finished extraction.
+
+Jobs run on OCR_CONCURRENCY worker tasks. The engine itself runs in the
+thread pool; TesseractEngine shells out to the tesseract / pdftotext
+binaries, so the CPU work happens in child processes. Failed attempts are
+retried with exponential backoff up to OCR_MAX_ATTEMPTS. Jobs left queued
+or running by a previous process are picked up again on startup.
+
+Engines are pluggable: ocr_queue.use_engine() installs any OcrEngine
+subclass (a `name` and an `extract_text(path, content_type)` method), such
+as a test double.
+"""
+import asyncio
+import logging
+import re
+import shutil
+import subprocess
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from typing import Deque, NamedTuple, Optional, Set
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+import config
+from database import AsyncSessionLocal
+from metrics import registry
+from models import OcrResult, OcrStatus
+from receipts import blob_path, sniff_content_type
+
+logger = logging.getLogger(__name__)
+
+class OcrEngine(ABC):
+    """Turns a stored receipt file into plain text"""
+    name = "none"
+
+    @abstractmethod
+    def extract_text(self, path: str, content_type: str) -> str:
+        """Text of the file at `path`; runs in the thread pool"""
+
+class StubEngine(OcrEngine):
+    """Extracts nothing; used when no local OCR engine is installed"""
+    name = "stub"
+
+    def extract_text(self, path: str, content_type: str) -> str:
+        return ""
+
+class TesseractEngine(OcrEngine):
+    """tesseract for images, pdftotext for PDFs with a text layer"""
+    name = "tesseract"
+
+    def extract_text(self, path: str, content_type: str) -> str:
+        if content_type == "application/pdf":
+            command = ["pdftotext", "-layout", path, "-"]
+        else:
+            command = ["tesseract", path, "stdout"]
+        result = subprocess.run(command, capture_output=True, timeout=config.OCR_TIMEOUT, check=True)
+        return result.stdout.decode("utf-8", errors="replace")
+
+def blob_content_type(sha256: str) -> str:
+    with open(blob_path(sha256), "rb") as handle:
+        return sniff_content_type(handle.read(16))
+
+def default_engine() -> OcrEngine:
+    if config.OCR_ENGINE == "stub":
+        return StubEngine()
+    if config.OCR_ENGINE == "tesseract" or shutil.which("tesseract"):
+        return TesseractEngine()
+    return StubEngine()
+
+class ExtractedFields(NamedTuple):
+    vendor: Optional[str]
+    amount: Optional[float]
+    currency: Optional[str]
+    date: Optional[datetime]
+
+CURRENCY_SYMBOLS = {"$": "USD", "€": "EUR", "£": "GBP", "₹": "INR", "¥": "JPY"}
+CURRENCY_CODES = re.compile(r"\b(USD|EUR|GBP|INR|JPY|CAD|AUD|CHF|CNY|SGD|AED)\b")
+MONEY = re.compile(r"(?<![\d.,])(\d{1,3}(?:[,\s]\d{3})*|\d+)[.,](\d{2})(?!\d)")
+TOTAL_LINE = re.compile(r"\b(grand\s+total|total|amount\s+due|balance\s+due)\b", re.IGNORECASE)
+SUBTOTAL_LINE = re.compile(r"\bsub\s*-?\s*total\b", re.IGNORECASE)
+MONTHS = {name: number for number, name in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], start=1
+)}
+DATE_PATTERNS = [
+    (re.compile(r"\b(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})\b"), "ymd"),
+    (re.compile(r"\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})\b"), "dmy"),
+    (re.compile(r"\b(\d{1,2})\s+([A-Za-z]{3})[a-z]*\.?,?\s+(\d{4})\b"), "d_mon_y"),
+    (re.compile(r"\b([A-Za-z]{3})[a-z]*\.?\s+(\d{1,2}),?\s+(\d{4})\b"), "mon_d_y"),
+]
+
+def _money(match) -> float:
+    return float(re.sub(r"[,\s]", "", match.group(1)) + "." + match.group(2))
+
+def _parse_date(text: str) -> Optional[datetime]:
+    for pattern, layout in DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            a, b, c = match.groups()
+            try:
+                if layout == "ymd":
+                    return datetime(int(a), int(b), int(c))
+                if layout == "dmy":
+                    day, month = int(a), int(b)
+                    if month > 12:
+                        # Only a US-style month/day order fits
+                        day, month = month, day
+                    return datetime(int(c), month, day)
+                if layout == "d_mon_y" and b.lower() in MONTHS:
+                    return datetime(int(c), MONTHS[b.lower()], int(a))
+                if layout == "mon_d_y" and a.lower() in MONTHS:
+                    return datetime(int(c), MONTHS[a.lower()], int(b))
+            except ValueError:
+                continue
+    return None
+
+def parse_receipt_text(text: str) -> ExtractedFields:
+    """Best-effort field extraction from receipt text"""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+
+    vendor = next((line[:255] for line in lines if re.search(r"[A-Za-z]{2}", line)), None)
+
+    amount = None
+    for line in reversed(lines):
+        # The last "total" line wins over earlier subtotals and tax lines
+        if TOTAL_LINE.search(line) and not SUBTOTAL_LINE.search(line):
+            amounts = [_money(match) for match in MONEY.finditer(line)]
+            if amounts:
+                amount = amounts[-1]
+                break
+    if amount is None:
+        amounts = [_money(match) for match in MONEY.finditer(text)]
+        amount = max(amounts) if amounts else None
+
+    currency = None
+    code = CURRENCY_CODES.search(text)
+    if code:
+        currency = code.group(1)
+    else:
+        currency = next((iso for symbol, iso in CURRENCY_SYMBOLS.items() if symbol in text), None)
+
+    return ExtractedFields(vendor, amount, currency, _parse_date(text))
+
+class OcrQueue:
+    """Bounded-concurrency extraction jobs with retries, backed by ocr_results"""
+
+    def __init__(self, engine: OcrEngine, concurrency: int = config.OCR_CONCURRENCY):
+        self._engine = engine
+        self._concurrency = concurrency
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: Set[asyncio.Task] = set()
+        self._retries: Set[asyncio.TimerHandle] = set()
+        self._running = 0
+        self._latencies: Deque[float] = deque(maxlen=1000)
+        self.counters = {"completed": 0, "failed": 0, "retried": 0, "cache_hits": 0}
+
+    def use_engine(self, engine: OcrEngine):
+        self._engine = engine
+
+    async def requeue_interrupted(self):
+        """
+        Mark jobs a previous shutdown left running as queued again. Runs once
+        per deployment, before any worker starts: in a running worker it would
+        hand another worker's job out a second time.
+        """
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(OcrResult).where(OcrResult.status == OcrStatus.RUNNING).values(status=OcrStatus.QUEUED)
+            )
+            await db.commit()
+
+    async def start(self):
+        """Start the workers and pick up queued jobs; several processes may share them"""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = {asyncio.create_task(self._work()) for _ in range(self._concurrency)}
+        async with AsyncSessionLocal() as db:
+            for sha256 in (await db.execute(
+                select(OcrResult.sha256).where(OcrResult.status == OcrStatus.QUEUED)
+            )).scalars():
+                self._queue.put_nowait(sha256)
+
+    async def stop(self):
+        for handle in self._retries:
+            handle.cancel()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        self._retries.clear()
+        self._queue = None
+
+    async def submit(self, db: AsyncSession, sha256: str, rerun_failed: bool = False) -> OcrResult:
+        """
+        Queue extraction for a receipt blob unless a result (or a pending job)
+        already exists for its content. Commits its own row.
+        """
+        result = (await db.execute(select(OcrResult).where(OcrResult.sha256 == sha256))).scalar_one_or_none()
+        if result is not None and not (rerun_failed and result.status == OcrStatus.FAILED):
+            self.counters["cache_hits"] += 1
+            return result
+        if result is None:
+            result = OcrResult(sha256=sha256, status=OcrStatus.QUEUED, attempts=0)
+            db.add(result)
+        else:
+            result.status, result.attempts, result.error = OcrStatus.QUEUED, 0, None
+        try:
+            await db.commit()
+        except IntegrityError:
+            # A concurrent upload of the same file queued it first
+            await db.rollback()
+            self.counters["cache_hits"] += 1
+            return (await db.execute(select(OcrResult).where(OcrResult.sha256 == sha256))).scalar_one()
+        await db.refresh(result)
+        if self._queue is not None:
+            self._queue.put_nowait(sha256)
+        return result
+
+    async def _work(self):
+        while True:
+            sha256 = await self._queue.get()
+            self._running += 1
+            try:
+                await self._run(sha256)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Database failures must not kill the worker; a job they leave
+                # running is requeued by the next deployment's startup
+                logger.exception("OCR job %s failed outside extraction", sha256)
+            finally:
+                self._running -= 1
+                self._queue.task_done()
+
+    async def _run(self, sha256: str):
+        async with AsyncSessionLocal() as db:
+            # Claim the job; the status guard keeps another worker from running it twice
+            claimed = await db.execute(
+                update(OcrResult)
+                .where(OcrResult.sha256 == sha256, OcrResult.status == OcrStatus.QUEUED)
+                .values(status=OcrStatus.RUNNING, attempts=OcrResult.attempts + 1, engine=self._engine.name)
+            )
+            await db.commit()
+            if claimed.rowcount != 1:
+                return
+            result = (await db.execute(select(OcrResult).where(OcrResult.sha256 == sha256))).scalar_one()
+
+            started = time.perf_counter()
+            try:
+                # A missing or unreadable blob is retried and then failed like any other error
+                content_type = await run_in_threadpool(blob_content_type, sha256)
+                text = await run_in_threadpool(self._engine.extract_text, blob_path(sha256), content_type)
+                fields = parse_receipt_text(text)
+            except Exception as e:
+                result.duration_ms = int((time.perf_counter() - started) * 1000)
+                result.error = str(e) or type(e).__name__
+                if result.attempts < config.OCR_MAX_ATTEMPTS:
+                    result.status = OcrStatus.QUEUED
+                    self.counters["retried"] += 1
+                    self._retry_later(sha256, config.OCR_RETRY_DELAY * 2 ** (result.attempts - 1))
+                else:
+                    result.status = OcrStatus.FAILED
+                    result.finished_at = datetime.utcnow()
+                    self.counters["failed"] += 1
+                await db.commit()
+                return
+
+            elapsed = time.perf_counter() - started
+            self._latencies.append(elapsed)
+            result.vendor, result.amount, result.currency, result.date = fields
+            result.text = text
+            result.error = None
+            result.duration_ms = int(elapsed * 1000)
+            result.status = OcrStatus.DONE
+            result.finished_at = datetime.utcnow()
+            await db.commit()
+            self.counters["completed"] += 1
+
+    def _retry_later(self, sha256: str, delay: float):
+        queue = self._queue
+        def requeue():
+            self._retries.discard(handle)
+            if queue is self._queue:
+                queue.put_nowait(sha256)
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retries.add(handle)
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        def percentile(fraction: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 1)
+        return {
+            "engine": self._engine.name,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "running": self._running,
+            "waiting_retry": len(self._retries),
+            **self.counters,
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "max": percentile(1.0)},
+        }
+
+ocr_queue = OcrQueue(default_engine())
+
+def _collect_ocr_stats():
+    stats = ocr_queue.stats()
+    yield "ocr_queue_depth", "gauge", "Receipts waiting for extraction", [({}, stats["queue_depth"])]
+    yield "ocr_running", "gauge", "Receipts being extracted", [({}, stats["running"])]
+    yield "ocr_jobs_total", "counter", "Extraction jobs by outcome", [
+        ({"outcome": outcome}, stats[outcome]) for outcome in ("completed", "failed", "retried", "cache_hits")
+    ]
+
+registry.add_collector(_collect_ocr_stats)
@@ -0,0 +1,258 @@
+import base64
+import enum
+import json
+from operator import itemgetter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+from fastapi import HTTPException, Query, status
+from pydantic import BaseModel
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from archive import reaches_archive
+from currency import converter
+from models import Expense, ExpenseArchive, ExpenseStatus
+
+# Hard upper bound for a single page so one request cannot pull the whole table
+MAX_PAGE_SIZE = 1000
+DEFAULT_PAGE_SIZE = 100
+
+# Columns that may be requested through ?fields=
+EXPENSE_FIELDS = {
+    "id": Expense.id,
+    "amount": Expense.amount,
+    "currency": Expense.currency,
+    "date": Expense.date,
+    "description": Expense.description,
+    "status": Expense.status,
+    "owner_id": Expense.owner_id,
+    "created_at": Expense.created_at,
+    "updated_at": Expense.updated_at,
+}
+
+# Computed fields and the columns they are derived from
+DERIVED_FIELDS = {
+    "amount_base": ["amount", "currency", "date"],
+}
+
+# Sort options for listings. Each sort is keyset-paginated on (column, id).
+class ExpenseSort(str, enum.Enum):
+    DATE_DESC = "-date"
+    DATE_ASC = "date"
+    AMOUNT_DESC = "-amount"
+    AMOUNT_ASC = "amount"
+
+    @property
+    def column_name(self) -> str:
+        return self.value.lstrip("-")
+
+    @property
+    def descending(self) -> bool:
+        return self.value.startswith("-")
+
+class ExpensePage(BaseModel):
+    items: List[Dict[str, Any]]
+    next_cursor: Optional[str] = None
+    limit: int
+
+class ExpenseFilters:
+    """Query-string filters shared by every expense listing route."""
+
+    def __init__(
+        self,
+        status: Optional[ExpenseStatus] = Query(None, description="Filter by expense status"),
+        owner_id: Optional[int] = Query(None, description="Filter by owner"),
+        currency: Optional[str] = Query(None, min_length=3, max_length=3, description="ISO currency code"),
+        date_from: Optional[datetime] = Query(None, description="Inclusive lower bound on expense date"),
+        date_to: Optional[datetime] = Query(None, description="Exclusive upper bound on expense date"),
+        min_amount: Optional[float] = Query(None, description="Inclusive lower bound on amount"),
+        max_amount: Optional[float] = Query(None, description="Inclusive upper bound on amount"),
+    ):
+        self.status = status
+        self.owner_id = owner_id
+        self.currency = currency.upper() if currency else None
+        self.date_from = date_from
+        self.date_to = date_to
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+
+    def apply(self, query, model=Expense):
+        """Push the filters into the SQL WHERE clause of a query or select() on `model` (Expense or ExpenseArchive)."""
+        if self.status is not None:
+            query = query.filter(model.status == self.status)
+        if self.owner_id is not None:
+            query = query.filter(model.owner_id == self.owner_id)
+        if self.currency is not None:
+            query = query.filter(model.currency == self.currency)
+        if self.date_from is not None:
+            query = query.filter(model.date >= self.date_from)
+        if self.date_to is not None:
+            query = query.filter(model.date < self.date_to)
+        if self.min_amount is not None:
+            query = query.filter(model.amount >= self.min_amount)
+        if self.max_amount is not None:
+            query = query.filter(model.amount <= self.max_amount)
+        return query
+
+class PageParams:
+    """Cursor, page size, sort order and column projection for listing routes."""
+
+    def __init__(
+        self,
+        cursor: Optional[str] = Query(None, description="Opaque cursor returned as next_cursor"),
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        sort: ExpenseSort = Query(ExpenseSort.DATE_DESC),
+        fields: Optional[str] = Query(None, description="Comma-separated list of columns to return"),
+    ):
+        self.cursor = cursor
+        self.limit = limit
+        self.sort = sort
+        self.fields = parse_fields(fields)
+
+def parse_fields(fields: Optional[str]) -> List[str]:
+    """Validate a ?fields= projection, defaulting to every column."""
+    if not fields:
+        return list(EXPENSE_FIELDS) + list(DERIVED_FIELDS)
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in EXPENSE_FIELDS and name not in DERIVED_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(unknown)}"
+        )
+    return requested
+
+def dump_cursor(payload: Dict[str, Any]) -> str:
+    """Opaque, URL-safe encoding of a cursor payload."""
+    encoded = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(encoded).decode().rstrip("=")
+
+def load_cursor(cursor: str) -> Dict[str, Any]:
+    """Inverse of dump_cursor; raises ValueError on malformed input."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode()))
+
+def encode_cursor(sort: ExpenseSort, value: Any, expense_id: int) -> str:
+    """Encode the last row's sort key as an opaque cursor."""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return dump_cursor({"s": sort.value, "v": value, "id": expense_id})
+
+def decode_cursor(cursor: str, sort: ExpenseSort):
+    """Decode a cursor back into (sort value, id), rejecting tampered or mismatched cursors."""
+    try:
+        payload = load_cursor(cursor)
+        if payload["s"] != sort.value:
+            raise ValueError("cursor was issued for a different sort order")
+        value = payload["v"]
+        if sort.column_name == "date":
+            value = datetime.fromisoformat(value)
+        else:
+            value = float(value)
+        return value, int(payload["id"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid cursor: {str(e)}"
+        )
+
+def encode_id_cursor(expense_id: int) -> str:
+    """Cursor for queues paged in plain id (insertion) order."""
+    return dump_cursor({"s": "id", "id": expense_id})
+
+def decode_id_cursor(cursor: str) -> int:
+    try:
+        payload = load_cursor(cursor)
+        if payload["s"] != "id":
+            raise ValueError("cursor was issued for a different listing")
+        return int(payload["id"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid cursor: {str(e)}"
+        )
+
+def expense_items(rows: Sequence[Any], fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Response dicts for rows selected from EXPENSE_FIELDS, built directly
+    instead of validating a model per row. amount_base is converted for the
+    whole batch when requested (by default every field is).
+    """
+    if not rows:
+        return []
+    fields = fields or list(EXPENSE_FIELDS) + list(DERIVED_FIELDS)
+    columns = [name for name in fields if name in EXPENSE_FIELDS]
+    # Positional access is several times faster than attribute lookups on Row
+    position = {name: index for index, name in enumerate(rows[0]._fields)}
+    values = itemgetter(*[position[name] for name in columns] + [-1])
+    # The trailing element pads the getter so it always returns a tuple
+    items = [dict(zip(columns, values(row))) for row in rows]
+    if "amount_base" in fields:
+        amount, currency, date = (itemgetter(position[name]) for name in ("amount", "currency", "date"))
+        converted = converter.convert_batch(
+            list(map(amount, rows)),
+            list(map(currency, rows)),
+            list(map(date, rows)),
+        )
+        for item, amount_base in zip(items, converted):
+            item["amount_base"] = amount_base
+    return items
+
+def expense_columns(model=Expense) -> Dict[str, Any]:
+    """EXPENSE_FIELDS as columns of `model`, Expense or ExpenseArchive."""
+    if model is Expense:
+        return EXPENSE_FIELDS
+    return {name: getattr(model, name) for name in EXPENSE_FIELDS}
+
+async def paginate_expenses(db: AsyncSession, filters: ExpenseFilters, page: PageParams) -> ExpensePage:
+    """
+    Fetch one page of expenses using keyset pagination on (sort column, id).
+    Only the projected columns are selected, and filters, ordering and the
+    cursor predicate are all evaluated in SQL so cost is independent of offset.
+    When the archive may hold matches, the same page is read from it and
+    merged with the hot one; ids are unique across both tables.
+    """
+    # The sort key and id are always selected so the next cursor can be built
+    selected = [name for name in page.fields if name in EXPENSE_FIELDS]
+    for name in page.fields:
+        selected.extend(DERIVED_FIELDS.get(name, []))
+    selected = list(dict.fromkeys(selected + [page.sort.column_name, "id"]))
+    cursor = decode_cursor(page.cursor, page.sort) if page.cursor else None
+
+    models = [Expense]
+    if await reaches_archive(db, filters):
+        models.append(ExpenseArchive)
+
+    rows = []
+    for model in models:
+        columns = expense_columns(model)
+        sort_column = columns[page.sort.column_name]
+        query = filters.apply(select(*[columns[name] for name in selected]), model)
+
+        if cursor:
+            key = tuple_(sort_column, model.id)
+            query = query.filter(key < cursor if page.sort.descending else key > cursor)
+
+        if page.sort.descending:
+            query = query.order_by(sort_column.desc(), model.id.desc())
+        else:
+            query = query.order_by(sort_column.asc(), model.id.asc())
+
+        # Fetch one extra row to know whether another page exists
+        rows.extend((await db.execute(query.limit(page.limit + 1))).all())
+
+    if len(models) > 1 and rows:
+        position = rows[0]._fields
+        rows.sort(key=itemgetter(position.index(page.sort.column_name), position.index("id")), reverse=page.sort.descending)
+    has_more = len(rows) > page.limit
+    rows = rows[:page.limit]
+
+    items = expense_items(rows, page.fields)
+    next_cursor = None
+    if has_more and rows:
+        last = rows[-1]
+        next_cursor = encode_cursor(page.sort, getattr(last, page.sort.column_name), last.id)
+
+    # Items are built from typed columns, so the page skips validation
+    return ExpensePage.model_construct(items=items, next_cursor=next_cursor, limit=page.limit)
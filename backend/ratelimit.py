@@ -0,0 +1,301 @@
+"""
+Rate limiting and admission control.
+
+Every request is sorted into a route class with its own token bucket per
+client:
+
+  export  /api/.../export, which streams the whole table
+  list    paged listings, search and summaries
+  read    other GETs (one expense, receipts, OCR status)
+  write   POST, PUT and DELETE
+
+A client is the user behind its bearer token once the auth cache holds
+that token as verified, and its address otherwise: without a token, with
+one not verified yet (its first request) and with a forged one. Made-up
+credentials therefore neither escape the limit nor crowd real clients'
+buckets out of the LRU. A bucket holds up to `burst` tokens and refills at
+the class's per-minute rate; a request takes one token or is answered 429
+with Retry-After saying when the next token arrives. A client flooding /all
+thus runs out of list tokens without touching anyone else's budget.
+
+Admission control then caps the requests a worker handles at once, in total
+and for the heavy classes, answering 503 with Retry-After beyond the cap.
+The total defaults to the async pool's capacity, so excess load is shed at
+the door instead of queuing for a connection until DB_POOL_TIMEOUT, and the
+list cap keeps some of that capacity free for approvals and writes.
+
+Buckets live in a RateLimitBackend: MemoryRateLimitBackend (per process) or
+SharedRateLimitBackend, which runs the bucket update as one Lua script on a
+redis.asyncio-style client so all workers draw from the same buckets.
+FakeSharedRateLimitClient evaluates that script's logic in memory for tests
+and local runs. The app installs redis_backend() when REDIS_URL is set.
+"""
+import logging
+import math
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from starlette.requests import HTTPConnection
+
+import config
+from auth import cached_principal, request_token
+from metrics import Counter, registry
+from responses import ORJSONResponse
+
+logger = logging.getLogger(__name__)
+
+EXPORT, LIST, READ, WRITE = "export", "list", "read", "write"
+
+class Budget(NamedTuple):
+    per_minute: int  # Sustained rate; 0 leaves the class unlimited
+    burst: int  # Requests allowed back to back after a quiet period
+
+    @property
+    def rate(self) -> float:
+        """Tokens per second"""
+        return self.per_minute / 60
+
+BUDGETS: Dict[str, Budget] = {
+    EXPORT: Budget(config.RATE_LIMIT_EXPORT_PER_MINUTE, config.RATE_LIMIT_EXPORT_BURST),
+    LIST: Budget(config.RATE_LIMIT_LIST_PER_MINUTE, config.RATE_LIMIT_LIST_BURST),
+    READ: Budget(config.RATE_LIMIT_READ_PER_MINUTE, config.RATE_LIMIT_READ_BURST),
+    WRITE: Budget(config.RATE_LIMIT_WRITE_PER_MINUTE, config.RATE_LIMIT_WRITE_BURST),
+}
+
+# Paths compared without a trailing slash
+LIST_PATHS = {
+    "/api/expenses/all", "/api/expenses/mine", "/api/expenses/search", "/api/expenses/summary",
+    "/api/approvals", "/api/approvals/pending", "/api/approvals/assigned", "/api/users", "/api/audit/events",
+}
+EXEMPT_PATHS = {"", "/api", "/health", "/metrics", "/docs", "/docs/oauth2-redirect", "/redoc", "/openapi.json"}
+# Long-lived streams pay for the connection but do not count against admission
+STREAM_PATHS = {"/api/approvals/stream"}
+
+REJECTED = registry.register(Counter(
+    "http_requests_rejected_total", "Requests refused by rate limiting (429) or admission control (503)", ("class", "reason")
+))
+
+def route_class(method: str, path: str) -> Optional[str]:
+    """The budget a request draws from, or None for probes, docs and preflight"""
+    path = path.rstrip("/")
+    if method == "OPTIONS" or path in EXEMPT_PATHS:
+        return None
+    if path.endswith("/export"):
+        return EXPORT
+    if method in ("GET", "HEAD"):
+        return LIST if path in LIST_PATHS else READ
+    return WRITE
+
+def client_identity(scope) -> str:
+    """The user behind an already verified token, else the client address"""
+    token = request_token(HTTPConnection(scope))
+    principal = cached_principal(token) if token else None
+    if principal is not None:
+        return f"user:{principal.user_id}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+def take_token(tokens: Optional[float], stamp: Optional[float], now: float, budget: Budget) -> Tuple[float, float]:
+    """
+    Refill a bucket up to `now` and take one token. Returns the remaining
+    tokens and the seconds to wait, which is 0 when the token was granted
+    (the tokens are then already reduced).
+    """
+    if tokens is None:
+        tokens = float(budget.burst)
+    else:
+        tokens = min(float(budget.burst), tokens + max(0.0, now - stamp) * budget.rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / budget.rate
+
+class RateLimitBackend(ABC):
+    """Interface for bucket storage"""
+
+    @abstractmethod
+    async def take(self, key: str, budget: Budget) -> float:
+        """Take one token from `key`'s bucket; seconds to wait, 0 when granted"""
+
+    def stats(self) -> dict:
+        return {}
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """Per-process buckets, least recently used evicted beyond `maxsize`"""
+
+    def __init__(self, maxsize: int = config.RATE_LIMIT_KEYS):
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._maxsize = maxsize
+
+    async def take(self, key: str, budget: Budget) -> float:
+        # No await between the read and the write, so the update is atomic on the event loop
+        tokens, stamp = self._buckets.pop(key, (None, None))
+        now = time.monotonic()
+        tokens, wait = take_token(tokens, stamp, now, budget)
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self._maxsize:
+            # An evicted client simply starts again with a full bucket
+            self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "buckets": len(self._buckets)}
+
+# Same arithmetic as take_token. Redis truncates Lua numbers to integers in
+# replies, so the wait comes back as a string; TIME keeps every worker on the
+# server's clock.
+TAKE_SCRIPT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(state[1])
+if tokens == nil then
+    tokens = burst
+else
+    tokens = math.min(burst, tokens + math.max(0, now - tonumber(state[2])) * rate)
+end
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+class SharedRateLimitBackend(RateLimitBackend):
+    """Buckets on a redis.asyncio-style client (eval); keys are namespaced by `prefix`"""
+
+    def __init__(self, client, prefix: str = "expenses:ratelimit:"):
+        self._client = client
+        self._prefix = prefix
+
+    async def take(self, key: str, budget: Budget) -> float:
+        wait = await self._client.eval(TAKE_SCRIPT, 1, self._prefix + key, budget.rate, budget.burst)
+        return float(wait.decode() if isinstance(wait, bytes) else wait)
+
+    def stats(self) -> dict:
+        return {"backend": type(self._client).__name__}
+
+def redis_backend(url: str) -> SharedRateLimitBackend:
+    """SharedRateLimitBackend over redis.asyncio; the redis package is only needed when REDIS_URL is set"""
+    import redis.asyncio
+    return SharedRateLimitBackend(redis.asyncio.from_url(url))
+
+class FakeSharedRateLimitClient:
+    """In-memory stand-in for a shared client; eval runs TAKE_SCRIPT's logic in Python"""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[float, float]] = {}
+
+    async def eval(self, script: str, numkeys: int, key: str, rate: float, burst: int) -> bytes:
+        tokens, stamp = self._data.get(key, (None, None))
+        now = time.time()
+        tokens, wait = take_token(tokens, stamp, now, Budget(round(rate * 60), int(burst)))
+        self._data[key] = (tokens, now)
+        return str(wait).encode()
+
+class RateLimiter:
+    def __init__(self, backend: RateLimitBackend):
+        self._backend = backend
+
+    def use_backend(self, backend: RateLimitBackend):
+        self._backend = backend
+
+    async def check(self, kind: str, identity: str) -> float:
+        """Seconds `identity` must wait before its next `kind` request; 0 admits it"""
+        budget = BUDGETS[kind]
+        if not budget.per_minute:
+            return 0.0
+        try:
+            return await self._backend.take(f"{kind}:{identity}", budget)
+        except Exception:
+            # An unreachable shared store must not take the API down with it
+            logger.exception("Rate limit backend failed; admitting the request")
+            return 0.0
+
+    def stats(self) -> dict:
+        return self._backend.stats()
+
+class Admission:
+    """In-flight requests per worker, in total and per capped class"""
+
+    def __init__(self, max_in_flight: int, class_limits: Dict[str, int]):
+        self.max_in_flight = max_in_flight
+        self.class_limits = {kind: limit for kind, limit in class_limits.items() if limit}
+        self.in_flight = 0
+        self.by_class: Dict[str, int] = {kind: 0 for kind in self.class_limits}
+
+    def try_enter(self, kind: str) -> bool:
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return False
+        limit = self.class_limits.get(kind)
+        if limit is not None and self.by_class[kind] >= limit:
+            return False
+        self.in_flight += 1
+        if limit is not None:
+            self.by_class[kind] += 1
+        return True
+
+    def leave(self, kind: str):
+        self.in_flight -= 1
+        if kind in self.by_class:
+            self.by_class[kind] -= 1
+
+rate_limiter = RateLimiter(MemoryRateLimitBackend())
+admission = Admission(config.ADMISSION_MAX_IN_FLIGHT, {
+    EXPORT: config.ADMISSION_MAX_EXPORTS,
+    LIST: config.ADMISSION_MAX_LISTS,
+})
+
+async def _reject(scope, receive, send, status_code: int, detail: str, retry_after: float):
+    response = ORJSONResponse(
+        status_code=status_code,
+        content={"detail": detail},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+    await response(scope, receive, send)
+
+class RateLimitMiddleware:
+    """Pure ASGI middleware applying the token buckets, then admission control"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not config.RATE_LIMIT_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        kind = route_class(scope["method"], scope["path"])
+        if kind is None:
+            await self.app(scope, receive, send)
+            return
+
+        wait = await rate_limiter.check(kind, client_identity(scope))
+        if wait:
+            REJECTED.inc(kind, "rate")
+            await _reject(scope, receive, send, 429, "Rate limit exceeded", wait)
+            return
+
+        if scope["path"].rstrip("/") in STREAM_PATHS:
+            await self.app(scope, receive, send)
+            return
+        if not admission.try_enter(kind):
+            REJECTED.inc(kind, "capacity")
+            await _reject(scope, receive, send, 503, "Server busy, retry shortly", 1)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.leave(kind)
+
+def _collect_admission_stats():
+    yield "admission_in_flight", "gauge", "Requests counted against admission control", [({"class": "all"}, admission.in_flight)] + [
+        ({"class": kind}, count) for kind, count in admission.by_class.items()
+    ]
+
+registry.add_collector(_collect_admission_stats)
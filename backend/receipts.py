@@ -0,0 +1,393 @@
+"""
+Content-addressed receipt storage.
+
+Uploads are streamed in chunks into a temporary file under RECEIPTS_DIR
+while being hashed, then renamed to blobs/<aa>/<bb>/<sha256>. A receipt
+that was uploaded before is stored once; every Receipt row referencing the
+digest shares the blob. Files are typed by their leading bytes, never by
+the client's Content-Type.
+
+Downloads honour single byte ranges. With RECEIPTS_ACCEL_REDIRECT set they
+are handed to nginx; otherwise the server's zero-copy send is used when it
+offers one, with threaded chunked reads as the fallback.
+
+Thumbnails are rendered in a process pool after the upload commits, so the
+request never waits on image decoding.
+
+Remove blobs no receipt references any more:
+
+    python -m receipts gc
+"""
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote
+
+from fastapi import HTTPException, Request, Response, status
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+import config
+from thumbnails import render_thumbnail
+
+# Leading bytes of the accepted receipt formats
+SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+]
+THUMBNAIL_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp"}
+# Multipart fields that may carry the receipt; the frontend posts "receipt"
+UPLOAD_FIELDS = {"receipt", "file"}
+
+def sniff_content_type(head: bytes) -> Optional[str]:
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(config.RECEIPTS_DIR, "blobs", sha256[:2], sha256[2:4], sha256)
+
+def thumbnail_path(sha256: str) -> str:
+    return os.path.join(config.RECEIPTS_DIR, "thumbnails", sha256[:2], f"{sha256}.jpg")
+
+class BlobWriter:
+    """Hashes and spools an upload to disk, then files it under its digest"""
+
+    def __init__(self, max_bytes: int = config.RECEIPT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.content_type: Optional[str] = None
+        self._head = b""
+        self._hash = hashlib.sha256()
+        spool_dir = os.path.join(config.RECEIPTS_DIR, "tmp")
+        os.makedirs(spool_dir, exist_ok=True)
+        # Same filesystem as the blobs, so storing is an atomic rename
+        handle, self._path = tempfile.mkstemp(dir=spool_dir)
+        self._file = os.fdopen(handle, "wb")
+
+    def _write(self, data: bytes):
+        self._hash.update(data)
+        self._file.write(data)
+
+    async def write(self, data: bytes):
+        if not data:
+            return
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Receipt exceeds the {self.max_bytes} byte limit"
+            )
+        if self.content_type is None and len(self._head) < 16:
+            self._head += data[:16]
+            if len(self._head) >= 16:
+                self._check_type()
+        await run_in_threadpool(self._write, data)
+
+    def _check_type(self):
+        self.content_type = sniff_content_type(self._head)
+        if self.content_type is None:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail="Receipts must be JPEG, PNG, GIF, WebP or PDF files"
+            )
+
+    def _store(self) -> Tuple[str, bool]:
+        self._file.close()
+        sha256 = self._hash.hexdigest()
+        destination = blob_path(sha256)
+        if os.path.exists(destination):
+            os.unlink(self._path)
+            # Refresh the mtime so garbage collection leaves it alone until the row commits
+            os.utime(destination)
+            return sha256, False
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(self._path, destination)
+        return sha256, True
+
+    async def store(self) -> Tuple[str, bool]:
+        """Returns (sha256, whether the blob is new)"""
+        if self.size == 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Receipt file is empty"
+            )
+        if self.content_type is None:
+            self._check_type()
+        return await run_in_threadpool(self._store)
+
+    def _discard(self):
+        self._file.close()
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+    async def discard(self):
+        await run_in_threadpool(self._discard)
+
+class _MultipartReceiver:
+    """python-multipart callbacks that route the receipt part into a BlobWriter"""
+
+    def __init__(self):
+        self.filename: Optional[str] = None
+        self.pending = []
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._in_file = False
+
+    def on_part_begin(self):
+        self._disposition = b""
+        self._in_file = False
+
+    def on_header_field(self, data, start, end):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        name = options.get(b"name", b"").decode("latin-1")
+        if b"filename" in options and name in UPLOAD_FIELDS:
+            if self.filename is not None:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Upload one receipt per request"
+                )
+            self.filename = options[b"filename"].decode("utf-8", errors="replace")
+            self._in_file = True
+
+    def on_part_data(self, data, start, end):
+        # Other form fields are ignored; the receipt is written after each network chunk
+        if self._in_file:
+            self.pending.append(data[start:end])
+
+    def on_part_end(self):
+        self._in_file = False
+
+async def receive_upload(request: Request) -> Tuple[BlobWriter, str]:
+    """
+    Stream the receipt in `request` to a BlobWriter. Accepts multipart form
+    data (field "receipt" or "file") or a raw body with ?filename=.
+    Returns the writer (not yet stored) and the client's filename.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    writer = BlobWriter()
+    try:
+        if content_type == b"multipart/form-data":
+            if b"boundary" not in params:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Missing boundary in multipart body"
+                )
+            receiver = _MultipartReceiver()
+            parser = MultipartParser(params[b"boundary"], {
+                name: getattr(receiver, name) for name in dir(receiver) if name.startswith("on_")
+            })
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if receiver.pending:
+                    await writer.write(b"".join(receiver.pending))
+                    receiver.pending.clear()
+            parser.finalize()
+            if receiver.filename is None:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="No receipt file in the form (expected field 'receipt')"
+                )
+            filename = receiver.filename
+        else:
+            async for chunk in request.stream():
+                await writer.write(chunk)
+            filename = request.query_params.get("filename", "receipt")
+        return writer, os.path.basename(filename)[:255] or "receipt"
+    except Exception:
+        await writer.discard()
+        raise
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Inclusive (start, end) for a single `bytes=` range, or None to send the
+    whole file. Unsatisfiable ranges raise 416.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        # Multiple ranges are allowed to fall back to the full body
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+class BlobResponse(Response):
+    """A whole blob or one byte range of it, sent without loading it into memory"""
+
+    def __init__(self, path: str, size: int, media_type: str, headers: Dict[str, str], byte_range: Optional[Tuple[int, int]] = None):
+        self.path = path
+        self.offset, last = byte_range if byte_range else (0, size - 1)
+        self.count = last - self.offset + 1
+        headers = dict(headers)
+        headers["Accept-Ranges"] = "bytes"
+        headers["Content-Length"] = str(self.count)
+        if byte_range:
+            headers["Content-Range"] = f"bytes {self.offset}-{last}/{size}"
+        super().__init__(
+            status_code=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+            headers=headers,
+            media_type=media_type,
+        )
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+        handle = await run_in_threadpool(open, self.path, "rb")
+        try:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": handle.fileno(),
+                    "offset": self.offset,
+                    "count": self.count,
+                })
+                return
+            await run_in_threadpool(handle.seek, self.offset)
+            remaining = self.count
+            while remaining > 0:
+                chunk = await run_in_threadpool(handle.read, min(config.RECEIPT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            await run_in_threadpool(handle.close)
+
+def blob_response(
+    request: Request,
+    path: str,
+    size: int,
+    media_type: str,
+    filename: str,
+    etag: str,
+) -> Response:
+    """Conditional, range-aware download of a stored file"""
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=86400",
+        "Content-Disposition": f"inline; filename*=UTF-8''{quote(filename)}",
+        "X-Content-Type-Options": "nosniff",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if config.RECEIPTS_ACCEL_REDIRECT:
+        relative = os.path.relpath(path, config.RECEIPTS_DIR).replace(os.sep, "/")
+        headers["X-Accel-Redirect"] = config.RECEIPTS_ACCEL_REDIRECT.rstrip("/") + "/" + relative
+        return Response(headers=headers, media_type=media_type)
+    # A stale If-Range means the client's partial copy is of other content
+    if_range = request.headers.get("if-range")
+    byte_range = None
+    if if_range is None or if_range == etag:
+        byte_range = parse_range(request.headers.get("range"), size)
+    return BlobResponse(path, size, media_type, headers, byte_range)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_inflight: Dict[str, asyncio.Future] = {}
+
+def thumbnail_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Spawned workers do not inherit the database pools and driver threads
+        _pool = ProcessPoolExecutor(
+            max_workers=config.THUMBNAIL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+def schedule_thumbnail(sha256: str, content_type: str) -> Optional[asyncio.Future]:
+    """Render the thumbnail for a blob in the background, at most once at a time per blob"""
+    if content_type not in THUMBNAIL_TYPES or os.path.exists(thumbnail_path(sha256)):
+        return None
+    if sha256 in _inflight:
+        return _inflight[sha256]
+    future = asyncio.get_running_loop().run_in_executor(
+        thumbnail_pool(), render_thumbnail, blob_path(sha256), thumbnail_path(sha256), config.THUMBNAIL_SIZE
+    )
+    _inflight[sha256] = future
+    future.add_done_callback(lambda done: _thumbnail_done(sha256, done))
+    return future
+
+def _thumbnail_done(sha256: str, future: asyncio.Future):
+    _inflight.pop(sha256, None)
+    if not future.cancelled():
+        # Retrieve the exception so a broken worker does not log "never retrieved"
+        future.exception()
+
+def shutdown_thumbnail_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def collect_garbage(grace_seconds: int = 3600) -> int:
+    """
+    Delete blobs and thumbnails that no receipt references, and abandoned
+    spool files. Files touched within `grace_seconds` are kept because their
+    upload may not have committed yet. Returns the number of files removed.
+    """
+    import time
+    from sqlalchemy import select
+    from database import SessionLocal
+    from models import Receipt
+
+    cutoff = time.time() - grace_seconds
+    with SessionLocal() as db:
+        referenced = set(db.execute(select(Receipt.sha256).distinct()).scalars())
+    removed = 0
+    for root in ("blobs", "thumbnails", "tmp"):
+        for directory, _, files in os.walk(os.path.join(config.RECEIPTS_DIR, root)):
+            for name in files:
+                path = os.path.join(directory, name)
+                if root != "tmp" and name.split(".")[0] in referenced:
+                    continue
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+                    removed += 1
+    return removed
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 2 or sys.argv[1] != "gc":
+        print(__doc__)
+        sys.exit(2)
+    print(f"Removed {collect_garbage()} unreferenced files")
@@ -0,0 +1,49 @@
+"""
+JSON rendering for responses.
+
+orjson is used when installed: it serializes datetimes and enums natively
+and is several times faster than the stdlib encoder on large listings.
+Without it the stdlib encoder produces the same compact output.
+ORJSONResponse is the app's default response class; dumps() renders bodies
+built outside of a response, such as cached ones.
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from enum import Enum
+from typing import Any
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(value: Any) -> Any:
+    """Types neither encoder handles on its own"""
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, Decimal):
+        return float(value)
+    if orjson is None:
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, Enum):
+            return value.value
+    return jsonable_encoder(value)
+
+if orjson is not None:
+    def dumps(content: Any) -> bytes:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    _encoder = json.JSONEncoder(default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+
+    def dumps(content: Any) -> bytes:
+        return _encoder.encode(content).encode("utf-8")
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
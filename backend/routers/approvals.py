@@ -1,8 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from database import get_db
-from models import Expense, User, UserRole, ExpenseStatus
+import asyncio
+from contextlib import aclosing
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, not_, select, union, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+import config
+from auth import Principal, get_current_principal
+from database import get_async_db
+from models import ApprovalStep, AuditAction, Expense, User, ExpenseStatus, StepStatus
+from workflow import decide_step, has_workflow
+from audit import audit_entry, audit_log
+from duplicates import attach_suspects
+from events import EXPENSE_DECIDED, build_expense_events, bus, change_tags, event_message, format_sse
+from cache import PENDING_TAG, cache_key, json_response, pending_tag, response_cache
+from summaries import SummaryDelta, apply_summary_delta
+from currency import attach_base_amounts
+from pagination import (
+    DEFAULT_PAGE_SIZE, EXPENSE_FIELDS, MAX_PAGE_SIZE, ExpenseFilters, ExpensePage, PageParams,
+    decode_id_cursor, encode_id_cursor, expense_items, paginate_expenses,
+)
+from schemas import ExpenseResponse
+from responses import ORJSONResponse
 from pydantic import BaseModel
 
 router = APIRouter()
@@ -12,59 +31,121 @@ class ExpenseApprovalRequest(BaseModel):
     status: str  # "Approved" or "Rejected"
     comments: str = None
 
-class ExpenseResponse(BaseModel):
-    id: int
-    amount: float
-    currency: str
-    date: str
-    description: str
-    status: str
-    owner_id: int
-    created_at: str
-    updated_at: str = None
-    
-    class Config:
-        from_attributes = True
+class PendingQueuePage(BaseModel):
+    items: List[ExpenseResponse]
+    next_cursor: Optional[str] = None
+    limit: int
 
 class ApprovalResponse(BaseModel):
     message: str
     expense: ExpenseResponse
 
-# Mock function to get current user (for now returns user_id=1)
-def get_current_user_id():
-    """Mock function to get current user ID. In real app, this would come from JWT token."""
-    return 1
+class BatchApprovalItem(BaseModel):
+    expense_id: int
+    status: str  # "Approved" or "Rejected"
+    comments: Optional[str] = None
+
+class BatchApprovalRequest(BaseModel):
+    decisions: List[BatchApprovalItem]
+
+class BatchApprovalResponse(BaseModel):
+    applied: List[int]
+    already_decided: List[int]
+    not_found: List[int]
+    not_assigned: List[int] = []  # Pending expenses the caller may not decide: no open step, their own, or not a reportee's
+
+def decision_entry(expense: Expense, approver_id: int, decision: str, comments: Optional[str]) -> dict:
+    """
+    Audit row for one approver's decision. Every decided expense was pending
+    before; a workflow step that does not settle the expense leaves it so.
+    """
+    action = AuditAction.APPROVED if decision == "Approved" else AuditAction.REJECTED
+    return audit_entry(
+        action, expense.id, approver_id,
+        before={"status": ExpenseStatus.PENDING.value},
+        after={"status": ExpenseStatus(expense.status).value},
+        comments=comments
+    )
 
-# Mock function to get current user role (for now returns Manager)
-def get_current_user_role():
-    """Mock function to get current user role. In real app, this would come from JWT token."""
-    return UserRole.MANAGER  # For now, assume user_id=1 is a Manager
+def decidable_by(principal: Principal):
+    """
+    WHERE clause on Expense for the expenses outside any workflow that
+    `principal` may decide: their reportees' (anyone's for admins), never
+    their own. Matches the reportee half of pending_queue_ids.
+    """
+    clause = Expense.owner_id != principal.user_id
+    if not principal.is_admin:
+        clause = and_(clause, Expense.owner_id.in_(select(User.id).where(User.manager_id == principal.user_id)))
+    return clause
 
-# Mock function to check if user can approve (Manager or Admin)
-def can_approve(user_role: UserRole):
-    """Check if user has approval privileges (Manager or Admin)"""
-    return user_role in [UserRole.MANAGER, UserRole.ADMIN]
+def pending_queue_ids(approver_id: int):
+    """
+    Ids of pending expenses waiting on `approver_id`: expenses with an open
+    workflow step for them, plus their reportees' expenses that were not
+    routed through a workflow.
+    """
+    has_steps = select(ApprovalStep.id).where(ApprovalStep.expense_id == Expense.id).exists()
+    assigned = select(ApprovalStep.expense_id).where(
+        ApprovalStep.status == StepStatus.PENDING,
+        ApprovalStep.approver_id == approver_id
+    )
+    reportees = select(Expense.id).where(
+        Expense.status == ExpenseStatus.PENDING,
+        Expense.owner_id.in_(select(User.id).where(User.manager_id == approver_id)),
+        not_(has_steps)
+    )
+    return union(assigned, reportees)
 
-@router.get("/pending", response_model=List[ExpenseResponse])
-async def get_pending_expenses(db: Session = Depends(get_db)):
-    """Get all expenses with status Pending"""
+@router.get("/pending", response_model=PendingQueuePage)
+async def get_pending_expenses(
+    request: Request,
+    cursor: Optional[str] = Query(None, description="Opaque cursor returned as next_cursor"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Get a page of the pending expenses waiting on the current user, oldest first"""
     try:
-        # Get current user role
-        current_user_role = get_current_user_role()
+        # Get current user info
+        current_user_id = principal.user_id
         
         # Check if user can view pending expenses (Manager or Admin)
-        if not can_approve(current_user_role):
+        if not principal.can_approve:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Access denied. Manager or Admin privileges required."
             )
         
-        # Query all pending expenses
-        pending_expenses = db.query(Expense).filter(
-            Expense.status == ExpenseStatus.PENDING
-        ).all()
+        async def load():
+            # Ids follow insertion order, so paging by id keeps the queue oldest first
+            query = select(*EXPENSE_FIELDS.values()).where(
+                Expense.id.in_(pending_queue_ids(current_user_id)),
+                Expense.status == ExpenseStatus.PENDING
+            )
+            if cursor:
+                query = query.where(Expense.id > decode_id_cursor(cursor))
+            
+            # Fetch one extra row to know whether another page exists
+            rows = (await db.execute(query.order_by(Expense.id).limit(limit + 1))).all()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            items = expense_items(rows)
+            await attach_suspects(db, items)
+            
+            # Same shape as PendingQueuePage
+            return json_response({
+                "items": items,
+                "next_cursor": encode_id_cursor(rows[-1].id) if has_more else None,
+                "limit": limit
+            })
         
-        return pending_expenses
+        # Pollers holding the current version get a 304 without touching the database
+        cached = await response_cache.get_or_load(
+            cache_key("approvals.pending", current_user_id, cursor=cursor, limit=limit),
+            [pending_tag(current_user_id), PENDING_TAG],
+            load
+        )
+        return cached.to_response(request)
         
     except HTTPException:
         raise
@@ -74,20 +155,255 @@ async def get_pending_expenses(db: Session = Depends(get_db)):
             detail=f"Failed to fetch pending expenses: {str(e)}"
         )
 
+@router.get("/assigned", response_model=List[ExpenseResponse])
+async def get_assigned_expenses(db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Get expenses waiting on the current user's approval step"""
+    try:
+        # Get current user ID
+        current_user_id = principal.user_id
+        
+        # Served by the (status, approver_id, created_at) index on approval_steps
+        rows = (await db.execute(
+            select(*EXPENSE_FIELDS.values())
+            .join(ApprovalStep, ApprovalStep.expense_id == Expense.id)
+            .where(
+                ApprovalStep.approver_id == current_user_id,
+                ApprovalStep.status == StepStatus.PENDING
+            )
+            .order_by(ApprovalStep.created_at, ApprovalStep.id)
+        )).all()
+        
+        items = expense_items(rows)
+        await attach_suspects(db, items)
+        
+        # Rows are already typed; skip per-object response validation
+        return ORJSONResponse(items)
+        
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch assigned expenses: {str(e)}"
+        )
+
+@router.get("/stream")
+async def stream_queue_changes(
+    request: Request,
+    since: Optional[int] = Query(None, description="Last sequence number seen; Last-Event-ID also works"),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Server-Sent Events feed of changes to the current user's approval queue"""
+    # Get current user info
+    current_user_id = principal.user_id
+    
+    # Check if user can approve (Manager or Admin)
+    if not principal.can_approve:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access denied. Manager or Admin privileges required."
+        )
+    if not config.EVENT_STREAMS:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Approval event streams are disabled; poll /api/approvals/pending instead"
+        )
+    
+    # EventSource sends Last-Event-ID by itself when it reconnects
+    last_event_id = request.headers.get("last-event-id")
+    if since is None and last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    
+    async def generate():
+        async with aclosing(bus.stream(current_user_id, since)) as events:
+            async for event in events:
+                yield format_sse(event)
+    
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.websocket("/stream")
+async def stream_queue_changes_ws(websocket: WebSocket, since: Optional[int] = None, principal: Principal = Depends(get_current_principal)):
+    """WebSocket variant of the queue feed; each message is {seq, type, data}"""
+    # Get current user info
+    current_user_id = principal.user_id
+    if not principal.can_approve:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if not config.EVENT_STREAMS:
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    
+    await websocket.accept()
+    
+    async def forward():
+        async with aclosing(bus.stream(current_user_id, since)) as events:
+            async for event in events:
+                if event is None:
+                    await websocket.send_json({"type": "keep-alive"})
+                else:
+                    await websocket.send_json(event_message(event))
+    
+    # Clients only listen, so reading just watches for the disconnect
+    sender = asyncio.ensure_future(forward())
+    try:
+        while not sender.done():
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+
+@router.post("/batch", response_model=BatchApprovalResponse)
+async def approve_or_reject_batch(
+    batch_request: BatchApprovalRequest,
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Approve or reject many expenses in a single transaction"""
+    try:
+        # Get current user info
+        current_user_id = principal.user_id
+        
+        # Check if user can approve (Manager or Admin)
+        if not principal.can_approve:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Access denied. Manager or Admin privileges required."
+            )
+        
+        # Group requested ids by target status
+        ids_by_status = {ExpenseStatus.APPROVED: [], ExpenseStatus.REJECTED: []}
+        decisions = {}
+        seen = set()
+        for decision in batch_request.decisions:
+            if decision.status not in ["Approved", "Rejected"]:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Status for expense {decision.expense_id} must be either 'Approved' or 'Rejected'"
+                )
+            if decision.expense_id in seen:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Expense {decision.expense_id} appears more than once in the batch"
+                )
+            seen.add(decision.expense_id)
+            decisions[decision.expense_id] = decision
+            ids_by_status[ExpenseStatus(decision.status)].append(decision.expense_id)
+        
+        # Expenses routed through an approval workflow are decided step by step
+        has_steps = select(ApprovalStep.id).where(ApprovalStep.expense_id == Expense.id).exists()
+        
+        # The pending-only guard lives in the WHERE clause, so a concurrent
+        # decision on the same expense can never be overwritten
+        applied = []
+        delta = SummaryDelta()
+        for new_status, expense_ids in ids_by_status.items():
+            if not expense_ids:
+                continue
+            result = await db.execute(
+                update(Expense)
+                .where(
+                    Expense.status == ExpenseStatus.PENDING,
+                    Expense.id.in_(expense_ids),
+                    not_(has_steps),
+                    decidable_by(principal)
+                )
+                .values(status=new_status)
+                .returning(Expense.id, Expense.owner_id, Expense.currency, Expense.date, Expense.amount)
+                .execution_options(synchronize_session=False)
+            )
+            for row in result:
+                applied.append(row.id)
+                delta.remove(row.owner_id, ExpenseStatus.PENDING, row.currency, row.date, row.amount)
+                delta.add(row.owner_id, new_status, row.currency, row.date, row.amount)
+        
+        # Record the caller's step on pending workflow expenses
+        not_assigned = []
+        workflow_expenses = (await db.execute(
+            select(Expense).where(
+                Expense.id.in_(seen.difference(applied)),
+                Expense.status == ExpenseStatus.PENDING,
+                Expense.owner_id != current_user_id,
+                has_steps
+            )
+        )).scalars().all()
+        for expense in workflow_expenses:
+            decision = decisions[expense.id]
+            try:
+                final_status = await decide_step(
+                    db, expense, current_user_id, decision.status == "Approved", decision.comments
+                )
+            except HTTPException:
+                not_assigned.append(expense.id)
+                continue
+            applied.append(expense.id)
+            if final_status is not None:
+                delta.add_expense(expense, sign=-1)
+                expense.status = final_status
+                delta.add_expense(expense)
+        await apply_summary_delta(db, delta)
+        
+        # Anything else does not exist, was already decided or is not the caller's to decide
+        remaining = seen.difference(applied).difference(not_assigned)
+        existing = set()
+        if remaining:
+            for row in await db.execute(
+                select(Expense.id, Expense.status).where(Expense.id.in_(remaining))
+            ):
+                if row.status == ExpenseStatus.PENDING:
+                    not_assigned.append(row.id)
+                else:
+                    existing.add(row.id)
+            remaining.difference_update(not_assigned)
+        
+        # Reload the decided expenses; the bulk UPDATE bypassed the session
+        decided = (await db.execute(
+            select(Expense).where(Expense.id.in_(applied)).execution_options(populate_existing=True)
+        )).scalars().all()
+        await audit_log.record(db, [
+            decision_entry(expense, current_user_id, decisions[expense.id].status, decisions[expense.id].comments)
+            for expense in decided
+        ])
+        events = await build_expense_events(db, EXPENSE_DECIDED, decided)
+        
+        await db.commit()
+        await response_cache.invalidate(change_tags(events))
+        await bus.publish(events)
+        
+        return BatchApprovalResponse(
+            applied=sorted(applied),
+            already_decided=sorted(existing),
+            not_found=sorted(remaining - existing),
+            not_assigned=sorted(not_assigned)
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to update expense statuses: {str(e)}"
+        )
+
 @router.post("/{expense_id}", response_model=ApprovalResponse)
 async def approve_or_reject_expense(
     expense_id: int, 
     approval_request: ExpenseApprovalRequest, 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
 ):
     """Approve or reject an expense"""
     try:
         # Get current user info
-        current_user_id = get_current_user_id()
-        current_user_role = get_current_user_role()
+        current_user_id = principal.user_id
         
         # Check if user can approve (Manager or Admin)
-        if not can_approve(current_user_role):
+        if not principal.can_approve:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Access denied. Manager or Admin privileges required."
@@ -101,7 +417,9 @@ async def approve_or_reject_expense(
             )
         
         # Find the expense
-        expense = db.query(Expense).filter(Expense.id == expense_id).first()
+        expense = (await db.execute(
+            select(Expense).where(Expense.id == expense_id)
+        )).scalar_one_or_none()
         
         if not expense:
             raise HTTPException(
@@ -116,20 +434,53 @@ async def approve_or_reject_expense(
                 detail=f"Expense is already {expense.status.value}. Cannot change status."
             )
         
+        if expense.owner_id == current_user_id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Access denied. You cannot decide your own expense."
+            )
+        
+        # Workflow expenses only change status once their last required step is decided
+        if await has_workflow(db, expense.id):
+            new_status = await decide_step(
+                db, expense, current_user_id, approval_request.status == "Approved", approval_request.comments
+            )
+        else:
+            # Without a workflow the owner's manager decides, or an admin
+            if await db.scalar(select(Expense.id).where(Expense.id == expense.id, decidable_by(principal))) is None:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="Access denied. Only the owner's manager or an admin can decide this expense."
+                )
+            new_status = ExpenseStatus.APPROVED if approval_request.status == "Approved" else ExpenseStatus.REJECTED
+        
         # Update expense status
-        new_status = ExpenseStatus.APPROVED if approval_request.status == "Approved" else ExpenseStatus.REJECTED
-        expense.status = new_status
+        if new_status is not None:
+            delta = SummaryDelta().add_expense(expense, sign=-1)
+            expense.status = new_status
+            delta.add_expense(expense)
+            await apply_summary_delta(db, delta)
+        await audit_log.record(db, [
+            decision_entry(expense, current_user_id, approval_request.status, approval_request.comments)
+        ])
+        events = await build_expense_events(db, EXPENSE_DECIDED, [expense])
         
-        db.commit()
-        db.refresh(expense)
+        await db.commit()
+        await response_cache.invalidate(change_tags(events))
+        await bus.publish(events)
+        await db.refresh(expense)
         
         # Prepare response message
-        action = "approved" if new_status == ExpenseStatus.APPROVED else "rejected"
-        message = f"Expense {action} successfully"
+        if new_status is None:
+            message = "Approval recorded; waiting for the remaining approvers"
+        else:
+            action = "approved" if new_status == ExpenseStatus.APPROVED else "rejected"
+            message = f"Expense {action} successfully"
         
         if approval_request.comments:
             message += f" with comments: {approval_request.comments}"
         
+        attach_base_amounts([expense])
         return ApprovalResponse(
             message=message,
             expense=expense
@@ -138,30 +489,30 @@ async def approve_or_reject_expense(
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to update expense status: {str(e)}"
         )
 
-@router.get("/", response_model=List[ExpenseResponse])
-async def get_all_expenses_for_approval(db: Session = Depends(get_db)):
-    """Get all expenses for approval management (Manager/Admin only)"""
+@router.get("/", response_model=ExpensePage)
+async def get_all_expenses_for_approval(
+    filters: ExpenseFilters = Depends(),
+    page: PageParams = Depends(),
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Get a page of expenses for approval management (Manager/Admin only)"""
     try:
-        # Get current user role
-        current_user_role = get_current_user_role()
-        
         # Check if user can view all expenses (Manager or Admin)
-        if not can_approve(current_user_role):
+        if not principal.can_approve:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Access denied. Manager or Admin privileges required."
             )
         
-        # Query all expenses
-        expenses = db.query(Expense).all()
-        
-        return expenses
+        # Query one page of expenses
+        return await paginate_expenses(db, filters, page)
         
     except HTTPException:
         raise
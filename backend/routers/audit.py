@@ -0,0 +1,107 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Any, Dict, List, Optional
+from datetime import datetime
+from audit import audit_log
+from auth import Principal, get_current_principal
+from database import get_async_db
+from models import AuditAction, Expense, ExpenseArchive, ExpenseEvent
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_id_cursor, encode_id_cursor
+from pydantic import BaseModel
+
+router = APIRouter()
+
+# Pydantic models for request/response
+class ExpenseEventResponse(BaseModel):
+    id: int
+    expense_id: int
+    actor_id: Optional[int] = None
+    action: AuditAction
+    comments: Optional[str] = None
+    before: Optional[Dict[str, Any]] = None
+    after: Optional[Dict[str, Any]] = None
+    created_at: datetime
+
+class ExpenseEventPage(BaseModel):
+    items: List[ExpenseEventResponse]
+    next_cursor: Optional[str] = None
+    limit: int
+
+async def require_audit_access(db: AsyncSession, principal: Principal, expense_id: Optional[int], actor_id: Optional[int]):
+    """Admins read the whole trail; other users their own actions and the history of their own expenses"""
+    if principal.is_admin or actor_id == principal.user_id:
+        return
+    if expense_id is not None:
+        owner_id = (await db.execute(
+            select(Expense.owner_id).where(Expense.id == expense_id)
+        )).scalar_one_or_none()
+        if owner_id is None:
+            owner_id = (await db.execute(
+                select(ExpenseArchive.owner_id).where(ExpenseArchive.id == expense_id)
+            )).scalar_one_or_none()
+        if owner_id == principal.user_id:
+            return
+    raise HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="Access denied. Filter by one of your expenses or by your own user id."
+    )
+
+@router.get("/events", response_model=ExpenseEventPage)
+async def get_expense_events(
+    expense_id: Optional[int] = Query(None, description="Events of one expense"),
+    actor_id: Optional[int] = Query(None, description="Events caused by one user"),
+    action: Optional[AuditAction] = Query(None, description="Filter by action"),
+    cursor: Optional[str] = Query(None, description="Opaque cursor returned as next_cursor"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Get a page of audit events, newest first"""
+    try:
+        await require_audit_access(db, principal, expense_id, actor_id)
+
+        # Events this worker committed but has not written yet
+        await audit_log.flush()
+
+        # Served by the (expense_id, id) and (actor_id, id) indexes
+        query = select(ExpenseEvent)
+        if expense_id is not None:
+            query = query.where(ExpenseEvent.expense_id == expense_id)
+        if actor_id is not None:
+            query = query.where(ExpenseEvent.actor_id == actor_id)
+        if action is not None:
+            query = query.where(ExpenseEvent.action == action)
+        if cursor:
+            query = query.where(ExpenseEvent.id < decode_id_cursor(cursor))
+
+        # Fetch one extra row to know whether another page exists
+        rows = (await db.execute(query.order_by(ExpenseEvent.id.desc()).limit(limit + 1))).scalars().all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        return ExpenseEventPage(
+            items=[
+                ExpenseEventResponse(
+                    id=row.id,
+                    expense_id=row.expense_id,
+                    actor_id=row.actor_id,
+                    action=row.action,
+                    comments=row.comments,
+                    before=row.before_values,
+                    after=row.after_values,
+                    created_at=row.created_at
+                )
+                for row in rows
+            ],
+            next_cursor=encode_id_cursor(rows[-1].id) if has_more else None,
+            limit=limit
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch audit events: {str(e)}"
+        )
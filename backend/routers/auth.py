@@ -0,0 +1,60 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+import config
+from auth import Principal, check_credentials, create_access_token, get_current_principal
+from database import get_async_db
+from models import UserRole
+from pydantic import BaseModel
+
+router = APIRouter()
+
+# Pydantic models for request/response
+class LoginRequest(BaseModel):
+    email: str
+    password: str
+
+class TokenResponse(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+    expires_in: int  # Seconds
+
+class PrincipalResponse(BaseModel):
+    user_id: int
+    role: UserRole
+    is_admin: bool
+    can_approve: bool
+
+@router.post("/login", response_model=TokenResponse)
+async def login(credentials: LoginRequest, db: AsyncSession = Depends(get_async_db)):
+    """Exchange an email and password for a bearer token"""
+    try:
+        user = await check_credentials(db, credentials.email, credentials.password)
+        if user is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Incorrect email or password",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+        
+        return TokenResponse(
+            access_token=create_access_token(user.id),
+            expires_in=config.JWT_EXPIRE_MINUTES * 60
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to log in: {str(e)}"
+        )
+
+@router.get("/me", response_model=PrincipalResponse)
+async def get_me(principal: Principal = Depends(get_current_principal)):
+    """The authenticated caller"""
+    return PrincipalResponse(
+        user_id=principal.user_id,
+        role=principal.role,
+        is_admin=principal.is_admin,
+        can_approve=principal.can_approve
+    )
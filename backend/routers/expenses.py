@@ -1,10 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, List, Optional
 from datetime import datetime
-from database import get_db
-from models import Expense, User, UserRole, ExpenseStatus
-from pydantic import BaseModel
+import json
+from auth import Principal, get_current_principal
+from database import get_async_db, SessionLocal
+from models import ApprovalStep, AuditAction, Expense, ExpenseArchive, Receipt, User, UserRole, ExpenseStatus
+from workflow import is_reviewer, route_expenses
+from archive import reject_if_archived
+from audit import audit_entry, audit_log, expense_snapshot, snapshot
+from duplicates import detect, expense_values, forget, reindex
+from events import EXPENSE_CREATED, EXPENSE_DELETED, EXPENSE_UPDATED, build_expense_events, bus, change_tags
+from cache import EXPENSES_TAG, PENDING_TAG, cache_key, expense_tag, json_response, owner_tag, response_cache
+from pagination import (
+    DEFAULT_PAGE_SIZE, EXPENSE_FIELDS, MAX_PAGE_SIZE, ExpenseFilters, ExpensePage, PageParams,
+    expense_columns, expense_items, paginate_expenses,
+)
+from schemas import ExpenseResponse, FlaggedExpense
+from search import search_expenses
+from export import iter_expense_batches, render_csv, render_ndjson, gzip_stream
+from summaries import SummaryDelta, apply_summary_delta, rollup_with_base, summary_query
+from currency import attach_base_amounts, converter
+from bulk import BulkResult, BulkRowError, insert_chunk, iter_chunks, iter_json_array, iter_ndjson
+from pydantic import BaseModel, ValidationError
 
 router = APIRouter()
 
@@ -15,43 +35,35 @@ class ExpenseCreate(BaseModel):
     date: Optional[datetime] = None
     description: str
 
-class ExpenseResponse(BaseModel):
-    id: int
-    amount: float
-    currency: str
-    date: datetime
-    description: str
-    status: str
-    owner_id: int
-    created_at: datetime
-    updated_at: Optional[datetime] = None
-    
-    class Config:
-        from_attributes = True
+class ExpenseSummaryRow(BaseModel):
+    owner_id: Optional[int] = None
+    status: Optional[str] = None
+    currency: Optional[str] = None
+    month: Optional[str] = None
+    count: int
+    total: float
+    total_base: Optional[float] = None
+
+# Columns the summary endpoint can group by
+SUMMARY_GROUP_COLUMNS = ["owner_id", "status", "currency", "month"]
 
 class ExpenseUpdate(BaseModel):
     amount: Optional[float] = None
     currency: Optional[str] = None
     date: Optional[datetime] = None
     description: Optional[str] = None
+    # Accepted only to be refused: status changes go through the approval workflow
     status: Optional[str] = None
 
-# Mock function to get current user (for now returns user_id=1)
-def get_current_user_id():
-    """Mock function to get current user ID. In real app, this would come from JWT token."""
-    return 1
-
-# Mock function to check if user is admin (for now returns True for user_id=1)
-def is_admin(user_id: int = 1):
-    """Mock function to check if user is admin. In real app, this would check user role."""
-    return True  # For now, assume user_id=1 is admin
+# Fields that feed the duplicate-detection keys
+DUPLICATE_KEY_FIELDS = {"amount", "currency", "date", "description"}
 
 @router.post("/", response_model=ExpenseResponse)
-async def create_expense(expense: ExpenseCreate, db: Session = Depends(get_db)):
+async def create_expense(expense: ExpenseCreate, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
     """Create a new expense"""
     try:
-        # Get current user ID (mocked for now)
-        current_user_id = get_current_user_id()
+        # Get current user ID
+        current_user_id = principal.user_id
         
         # Create new expense
         db_expense = Expense(
@@ -64,29 +76,165 @@ async def create_expense(expense: ExpenseCreate, db: Session = Depends(get_db)):
         )
         
         db.add(db_expense)
-        db.commit()
-        db.refresh(db_expense)
+        await db.flush()
+        await apply_summary_delta(db, SummaryDelta().add_expense(db_expense))
+        await route_expenses(db, [{
+            "id": db_expense.id,
+            "amount": db_expense.amount,
+            "currency": db_expense.currency,
+            "date": db_expense.date,
+        }])
+        await audit_log.record(db, [
+            audit_entry(AuditAction.CREATED, db_expense.id, current_user_id, after=expense_snapshot(db_expense))
+        ])
+        suspects = await detect(db, [expense_values(db_expense)])
+        events = await build_expense_events(db, EXPENSE_CREATED, [db_expense])
+        await db.commit()
+        await response_cache.invalidate(change_tags(events))
+        await bus.publish(events)
+        await db.refresh(db_expense)
         
+        attach_base_amounts([db_expense])
+        db_expense.suspected_duplicates = suspects.get(db_expense.id, [])
         return db_expense
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to create expense: {str(e)}"
         )
 
+def _bulk_row_values(raw, owner_id: int, now: datetime) -> dict:
+    """Validate one bulk row and map it to column values for INSERT"""
+    if isinstance(raw, Exception):
+        raise ValueError(f"Invalid JSON: {raw}")
+    expense = ExpenseCreate.model_validate(raw)
+    return {
+        "amount": expense.amount,
+        "currency": expense.currency,
+        "date": expense.date or now,
+        "description": expense.description,
+        "status": ExpenseStatus.PENDING,
+        "owner_id": owner_id,
+        "created_at": now,
+    }
+
+async def _after_bulk_insert(db: AsyncSession, rows: List[dict]) -> Dict[int, List[dict]]:
+    """
+    Fold freshly inserted bulk rows into the summary table, route them for
+    approval and check them for duplicates; returns the suspects per id
+    """
+    delta = SummaryDelta()
+    for row in rows:
+        delta.add(row["owner_id"], row["status"], row["currency"], row["date"], row["amount"])
+    await apply_summary_delta(db, delta)
+    await route_expenses(db, rows)
+    await audit_log.record(db, [
+        audit_entry(AuditAction.CREATED, row["id"], row["owner_id"], after=snapshot(row)) for row in rows
+    ])
+    return await detect(db, rows)
+
+def _format_validation_error(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        return "; ".join(
+            f"{'.'.join(str(part) for part in err['loc']) or 'row'}: {err['msg']}"
+            for err in e.errors()
+        )
+    return str(e)
+
+@router.post("/bulk", response_model=BulkResult)
+async def create_expenses_bulk(request: Request, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Create many expenses from a JSON array or an NDJSON stream"""
+    # Get current user ID
+    current_user_id = principal.user_id
+    
+    # NDJSON is parsed incrementally; a JSON array has to be read in full
+    if "ndjson" in request.headers.get("content-type", ""):
+        rows = iter_ndjson(request.stream())
+    else:
+        try:
+            payload = json.loads(await request.body())
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid JSON body: {str(e)}"
+            )
+        if not isinstance(payload, list):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Request body must be a JSON array of expenses"
+            )
+        rows = iter_json_array(payload)
+    
+    inserted = 0
+    errors: List[BulkRowError] = []
+    flagged: Dict[int, List[dict]] = {}
+    now = datetime.utcnow()
+    
+    async def after_insert(db: AsyncSession, rows: List[dict]):
+        # Keyed by id: rows retried one by one after a failed chunk replace their entries
+        flagged.update(await _after_bulk_insert(db, rows))
+    
+    try:
+        # Validate and insert chunk by chunk, one transaction per chunk
+        async for chunk in iter_chunks(rows):
+            valid = []
+            for index, raw in chunk:
+                try:
+                    valid.append((index, _bulk_row_values(raw, current_user_id, now)))
+                except (ValidationError, ValueError) as e:
+                    errors.append(BulkRowError(index=index, error=_format_validation_error(e)))
+            
+            chunk_errors = await insert_chunk(db, Expense, valid, after_insert=after_insert)
+            errors.extend(chunk_errors)
+            inserted += len(valid) - len(chunk_errors)
+        
+        return BulkResult(
+            inserted=inserted,
+            failed=len(errors),
+            errors=errors,
+            flagged=[
+                FlaggedExpense(expense_id=expense_id, suspected_duplicates=suspects)
+                for expense_id, suspects in sorted(flagged.items())
+            ]
+        )
+        
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to import expenses: {str(e)}"
+        )
+    finally:
+        # Chunks commit one by one, so a failed import may still have added rows.
+        # New rows can land in any approver's queue, hence all of them.
+        if inserted:
+            await response_cache.invalidate([owner_tag(current_user_id), EXPENSES_TAG, PENDING_TAG])
+
 @router.get("/mine", response_model=List[ExpenseResponse])
-async def get_my_expenses(db: Session = Depends(get_db)):
+async def get_my_expenses(request: Request, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
     """Get logged-in user's expenses"""
     try:
-        # Get current user ID (mocked for now)
-        current_user_id = get_current_user_id()
+        # Get current user ID
+        current_user_id = principal.user_id
         
-        # Query expenses for current user
-        expenses = db.query(Expense).filter(Expense.owner_id == current_user_id).all()
+        async def load():
+            # Query expenses for current user, then the ones archived
+            rows = (await db.execute(
+                select(*EXPENSE_FIELDS.values()).where(Expense.owner_id == current_user_id)
+            )).all()
+            rows += (await db.execute(
+                select(*expense_columns(ExpenseArchive).values()).where(ExpenseArchive.owner_id == current_user_id)
+            )).all()
+            return json_response(expense_items(rows))
         
-        return expenses
+        cached = await response_cache.get_or_load(
+            cache_key("expenses.mine", current_user_id),
+            [owner_tag(current_user_id)],
+            load
+        )
+        return cached.to_response(request)
         
     except Exception as e:
         raise HTTPException(
@@ -94,24 +242,38 @@ async def get_my_expenses(db: Session = Depends(get_db)):
             detail=f"Failed to fetch user expenses: {str(e)}"
         )
 
-@router.get("/all", response_model=List[ExpenseResponse])
-async def get_all_expenses(db: Session = Depends(get_db)):
-    """Get all expenses (Admin only)"""
+@router.get("/all", response_model=ExpensePage)
+async def get_all_expenses(
+    request: Request,
+    filters: ExpenseFilters = Depends(),
+    page: PageParams = Depends(),
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Get a page of all expenses (Admin only)"""
     try:
-        # Get current user ID (mocked for now)
-        current_user_id = get_current_user_id()
+        # Get current user ID
+        current_user_id = principal.user_id
         
         # Check if user is admin
-        if not is_admin(current_user_id):
+        if not principal.is_admin:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Access denied. Admin privileges required."
             )
         
-        # Query all expenses
-        expenses = db.query(Expense).all()
+        async def load():
+            # Query one page of expenses
+            return json_response(await paginate_expenses(db, filters, page))
         
-        return expenses
+        # A listing narrowed to one owner only changes with that owner's expenses
+        tag = owner_tag(filters.owner_id) if filters.owner_id is not None else EXPENSES_TAG
+        cached = await response_cache.get_or_load(
+            cache_key("expenses.all", current_user_id, filters=vars(filters), page=vars(page)),
+            [tag],
+            load
+        )
+        return cached.to_response(request)
         
     except HTTPException:
         raise
@@ -121,19 +283,164 @@ async def get_all_expenses(db: Session = Depends(get_db)):
             detail=f"Failed to fetch all expenses: {str(e)}"
         )
 
-@router.get("/{expense_id}", response_model=ExpenseResponse)
-async def get_expense(expense_id: int, db: Session = Depends(get_db)):
-    """Get a specific expense by ID"""
+@router.get("/export")
+async def export_expenses(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    gzip: bool = Query(False, description="Compress the stream with gzip"),
+    filters: ExpenseFilters = Depends(),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Stream all matching expenses as NDJSON or CSV (Admin only)"""
+    # Get current user ID
+    current_user_id = principal.user_id
+    
+    # Check if user is admin
+    if not principal.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access denied. Admin privileges required."
+        )
+    
+    def generate():
+        # The session must outlive the request handler, so it is owned by the stream.
+        # StreamingResponse drains sync iterators in a threadpool, which keeps the
+        # blocking server-side cursor reads off the event loop.
+        db = SessionLocal()
+        try:
+            batches = iter_expense_batches(db, filters)
+            chunks = render_csv(batches) if format == "csv" else render_ndjson(batches)
+            yield from gzip_stream(chunks) if gzip else chunks
+        finally:
+            db.close()
+    
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"expenses.{format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    
+    return StreamingResponse(generate(), media_type=media_type, headers=headers)
+
+@router.get("/summary", response_model=List[ExpenseSummaryRow], response_model_exclude_none=True)
+async def get_expense_summary(
+    group_by: str = Query("status,currency", description="Comma-separated subset of owner_id, status, currency, month"),
+    owner_id: Optional[int] = None,
+    status_filter: Optional[ExpenseStatus] = Query(None, alias="status"),
+    currency: Optional[str] = Query(None, min_length=3, max_length=3),
+    month_from: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    month_to: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Get expense counts and totals from the maintained summary table"""
     try:
-        expense = db.query(Expense).filter(Expense.id == expense_id).first()
+        # Get current user ID
+        current_user_id = principal.user_id
         
-        if not expense:
+        # Non-admins only ever see their own totals
+        if not principal.is_admin:
+            owner_id = current_user_id
+        
+        columns = [name.strip() for name in group_by.split(",") if name.strip()]
+        unknown = [name for name in columns if name not in SUMMARY_GROUP_COLUMNS]
+        if unknown:
             raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Expense not found"
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Cannot group by: {', '.join(unknown)}"
             )
         
-        return expense
+        # Read at (currency, month) grain at least so totals can be converted
+        # to the base currency, then roll up to the requested grouping
+        grain = list(dict.fromkeys(columns + ["currency", "month"]))
+        rows = (await db.execute(summary_query(
+            grain,
+            owner_id=owner_id,
+            status=status_filter,
+            currency=currency.upper() if currency else None,
+            month_from=month_from,
+            month_to=month_to
+        ))).mappings().all()
+        
+        return [ExpenseSummaryRow(**row) for row in rollup_with_base(rows, columns, converter.convert)]
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch expense summary: {str(e)}"
+        )
+
+@router.get("/search", response_model=ExpensePage)
+async def search_expense_descriptions(
+    q: str = Query(..., min_length=1, max_length=200, description="Words to find in descriptions"),
+    filters: ExpenseFilters = Depends(),
+    cursor: Optional[str] = Query(None, description="Opaque cursor returned as next_cursor"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Search expense descriptions, best matches first"""
+    try:
+        # Get current user ID
+        current_user_id = principal.user_id
+        
+        # Non-admins only ever search their own expenses
+        if not principal.is_admin:
+            filters.owner_id = current_user_id
+        
+        return await search_expenses(db, q, filters, cursor, limit)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to search expenses: {str(e)}"
+        )
+
+@router.get("/{expense_id}", response_model=ExpenseResponse)
+async def get_expense(expense_id: int, request: Request, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Get a specific expense by ID"""
+    try:
+        # Get current user ID
+        current_user_id = principal.user_id
+        
+        async def load():
+            row = (await db.execute(
+                select(*EXPENSE_FIELDS.values()).where(Expense.id == expense_id)
+            )).one_or_none()
+            
+            if not row:
+                row = (await db.execute(
+                    select(*expense_columns(ExpenseArchive).values()).where(ExpenseArchive.id == expense_id)
+                )).one_or_none()
+            
+            if not row:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Expense not found"
+                )
+            
+            # Owners, admins and whoever approves it; entries are cached per user
+            if (
+                row.owner_id != current_user_id
+                and not principal.is_admin
+                and not await is_reviewer(db, current_user_id, expense_id, row.owner_id)
+            ):
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="Access denied. You can only view your own expenses or those you approve."
+                )
+            
+            return json_response(expense_items([row])[0])
+        
+        cached = await response_cache.get_or_load(
+            cache_key("expenses.get", current_user_id, expense_id=expense_id),
+            [expense_tag(expense_id)],
+            load
+        )
+        return cached.to_response(request)
         
     except HTTPException:
         raise
@@ -144,79 +451,116 @@ async def get_expense(expense_id: int, db: Session = Depends(get_db)):
         )
 
 @router.put("/{expense_id}", response_model=ExpenseResponse)
-async def update_expense(expense_id: int, expense_update: ExpenseUpdate, db: Session = Depends(get_db)):
+async def update_expense(expense_id: int, expense_update: ExpenseUpdate, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
     """Update an expense"""
     try:
-        # Get current user ID (mocked for now)
-        current_user_id = get_current_user_id()
+        # Get current user ID
+        current_user_id = principal.user_id
         
         # Find the expense
-        expense = db.query(Expense).filter(Expense.id == expense_id).first()
+        expense = (await db.execute(
+            select(Expense).where(Expense.id == expense_id)
+        )).scalar_one_or_none()
         
         if not expense:
+            await reject_if_archived(db, expense_id)
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Expense not found"
             )
         
         # Check if user owns the expense or is admin
-        if expense.owner_id != current_user_id and not is_admin(current_user_id):
+        if expense.owner_id != current_user_id and not principal.is_admin:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Access denied. You can only update your own expenses."
             )
         
-        # Update fields
         update_data = expense_update.dict(exclude_unset=True)
+        if "status" in update_data:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Status cannot be updated directly; approve or reject through /api/approvals"
+            )
+        
+        # Update fields, moving the expense between summary groups
+        delta = SummaryDelta().add_expense(expense, sign=-1)
+        before = expense_snapshot(expense)
         for field, value in update_data.items():
             setattr(expense, field, value)
+        delta.add_expense(expense)
+        await apply_summary_delta(db, delta)
+        await audit_log.record(db, [
+            audit_entry(AuditAction.UPDATED, expense.id, current_user_id, before=before, after=expense_snapshot(expense))
+        ])
+        suspects = await reindex(db, expense) if DUPLICATE_KEY_FIELDS.intersection(update_data) else None
+        events = await build_expense_events(db, EXPENSE_UPDATED, [expense])
         
-        db.commit()
-        db.refresh(expense)
+        await db.commit()
+        await response_cache.invalidate(change_tags(events))
+        await bus.publish(events)
+        await db.refresh(expense)
         
+        attach_base_amounts([expense])
+        if suspects is not None:
+            expense.suspected_duplicates = suspects.get(expense.id, [])
         return expense
         
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to update expense: {str(e)}"
         )
 
 @router.delete("/{expense_id}")
-async def delete_expense(expense_id: int, db: Session = Depends(get_db)):
+async def delete_expense(expense_id: int, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
     """Delete an expense"""
     try:
-        # Get current user ID (mocked for now)
-        current_user_id = get_current_user_id()
+        # Get current user ID
+        current_user_id = principal.user_id
         
         # Find the expense
-        expense = db.query(Expense).filter(Expense.id == expense_id).first()
+        expense = (await db.execute(
+            select(Expense).where(Expense.id == expense_id)
+        )).scalar_one_or_none()
         
         if not expense:
+            await reject_if_archived(db, expense_id)
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Expense not found"
             )
         
         # Check if user owns the expense or is admin
-        if expense.owner_id != current_user_id and not is_admin(current_user_id):
+        if expense.owner_id != current_user_id and not principal.is_admin:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Access denied. You can only delete your own expenses."
             )
         
-        db.delete(expense)
-        db.commit()
+        # Build the event while the steps still name the approvers to notify
+        events = await build_expense_events(db, EXPENSE_DELETED, [expense])
+        await db.execute(delete(ApprovalStep).where(ApprovalStep.expense_id == expense_id))
+        await db.execute(delete(Receipt).where(Receipt.expense_id == expense_id))
+        await forget(db, [expense_id])
+        await db.delete(expense)
+        await apply_summary_delta(db, SummaryDelta().add_expense(expense, sign=-1))
+        await audit_log.record(db, [
+            audit_entry(AuditAction.DELETED, expense_id, current_user_id, before=expense_snapshot(expense))
+        ])
+        await db.commit()
+        await response_cache.invalidate(change_tags(events))
+        await bus.publish(events)
         
         return {"message": "Expense deleted successfully"}
         
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to delete expense: {str(e)}"
@@ -0,0 +1,257 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from datetime import datetime
+import os
+from auth import Principal, get_current_principal
+from archive import reject_if_archived
+from database import get_async_db
+from models import Expense, ExpenseArchive, OcrResult, OcrStatus, Receipt
+from receipts import blob_path, blob_response, receive_upload, schedule_thumbnail, thumbnail_path
+from ocr import ocr_queue
+from workflow import is_reviewer
+from pydantic import BaseModel
+
+router = APIRouter()
+
+# Pydantic models for request/response
+class ReceiptResponse(BaseModel):
+    id: int
+    expense_id: int
+    sha256: str
+    filename: str
+    content_type: str
+    size: int
+    created_at: datetime
+    deduplicated: bool = False  # The same file was already stored
+    
+    class Config:
+        from_attributes = True
+
+class OcrPrefill(BaseModel):
+    amount: Optional[float] = None
+    currency: Optional[str] = None
+    date: Optional[datetime] = None
+    description: Optional[str] = None  # Vendor name
+
+class ReceiptOcrStatus(BaseModel):
+    receipt_id: int
+    sha256: str
+    status: Optional[OcrStatus] = None  # None when the receipt was never queued
+    attempts: int = 0
+    duration_ms: Optional[int] = None
+    error: Optional[str] = None
+    prefill: Optional[OcrPrefill] = None
+
+class ExpenseOcrResponse(BaseModel):
+    receipts: List[ReceiptOcrStatus]
+    prefill: Optional[OcrPrefill] = None  # From the newest receipt with extracted fields
+
+async def get_accessible_expense(db: AsyncSession, expense_id: int, principal: Principal, writable: bool = False):
+    """
+    The Expense, or for reads its ExpenseArchive row; archived expenses take
+    no new or deleted receipts. Reads are also open to the expense's
+    reviewers (workflow approvers and the owner's manager).
+    """
+    expense = (await db.execute(
+        select(Expense).where(Expense.id == expense_id)
+    )).scalar_one_or_none()
+    
+    if not expense:
+        if writable:
+            await reject_if_archived(db, expense_id)
+        else:
+            expense = await db.get(ExpenseArchive, expense_id)
+    
+    if not expense:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Expense not found"
+        )
+    
+    # Owners and admins may change receipts; whoever approves the expense may read them
+    current_user_id = principal.user_id
+    if expense.owner_id != current_user_id and not principal.is_admin and (
+        writable or not await is_reviewer(db, current_user_id, expense_id, expense.owner_id)
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access denied. You can only access receipts of your own expenses or those you approve."
+        )
+    return expense
+
+async def get_receipt(db: AsyncSession, expense_id: int, receipt_id: int, principal: Principal, writable: bool = False) -> Receipt:
+    await get_accessible_expense(db, expense_id, principal, writable)
+    receipt = (await db.execute(
+        select(Receipt).where(Receipt.id == receipt_id, Receipt.expense_id == expense_id)
+    )).scalar_one_or_none()
+    
+    if not receipt:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Receipt not found"
+        )
+    return receipt
+
+@router.post("/{expense_id}/receipts", response_model=ReceiptResponse)
+async def upload_receipt(expense_id: int, request: Request, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Attach a receipt (multipart field 'receipt', or a raw body with ?filename=)"""
+    await get_accessible_expense(db, expense_id, principal, writable=True)
+    # Release the connection while the upload streams in
+    await db.commit()
+    
+    writer, filename = await receive_upload(request)
+    try:
+        sha256, created = await writer.store()
+    except Exception:
+        await writer.discard()
+        raise
+    
+    try:
+        receipt = Receipt(
+            expense_id=expense_id,
+            sha256=sha256,
+            filename=filename,
+            content_type=writer.content_type,
+            size=writer.size
+        )
+        db.add(receipt)
+        await db.commit()
+        await db.refresh(receipt)
+        
+        schedule_thumbnail(sha256, receipt.content_type)
+        await ocr_queue.submit(db, sha256)
+        response = ReceiptResponse.model_validate(receipt)
+        response.deduplicated = not created
+        return response
+        
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to save receipt: {str(e)}"
+        )
+
+@router.get("/{expense_id}/receipts", response_model=List[ReceiptResponse])
+async def get_receipts(expense_id: int, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """List the receipts attached to an expense"""
+    await get_accessible_expense(db, expense_id, principal)
+    return (await db.execute(
+        select(Receipt).where(Receipt.expense_id == expense_id).order_by(Receipt.id)
+    )).scalars().all()
+
+@router.get("/{expense_id}/receipts/{receipt_id}")
+async def download_receipt(expense_id: int, receipt_id: int, request: Request, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Download a receipt; supports Range and If-None-Match"""
+    receipt = await get_receipt(db, expense_id, receipt_id, principal)
+    return blob_response(
+        request,
+        blob_path(receipt.sha256),
+        receipt.size,
+        receipt.content_type,
+        receipt.filename,
+        etag=f'"{receipt.sha256}"'
+    )
+
+@router.get("/{expense_id}/receipts/{receipt_id}/thumbnail")
+async def download_receipt_thumbnail(expense_id: int, receipt_id: int, request: Request, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """JPEG preview of an image receipt, once it has been rendered"""
+    receipt = await get_receipt(db, expense_id, receipt_id, principal)
+    path = thumbnail_path(receipt.sha256)
+    if not os.path.exists(path):
+        # Older uploads, or a render lost to a restart, are queued again
+        schedule_thumbnail(receipt.sha256, receipt.content_type)
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Thumbnail not available"
+        )
+    return blob_response(
+        request,
+        path,
+        os.path.getsize(path),
+        "image/jpeg",
+        f"{os.path.splitext(receipt.filename)[0]}.jpg",
+        etag=f'"{receipt.sha256}-thumbnail"'
+    )
+
+@router.delete("/{expense_id}/receipts/{receipt_id}")
+async def delete_receipt(expense_id: int, receipt_id: int, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Detach a receipt. The stored file is removed by `python -m receipts gc` once unreferenced."""
+    receipt = await get_receipt(db, expense_id, receipt_id, principal, writable=True)
+    try:
+        await db.delete(receipt)
+        await db.commit()
+        
+        return {"message": "Receipt deleted successfully"}
+        
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to delete receipt: {str(e)}"
+        )
+
+async def expense_ocr_status(db: AsyncSession, expense_id: int) -> ExpenseOcrResponse:
+    rows = (await db.execute(
+        select(Receipt, OcrResult)
+        .outerjoin(OcrResult, OcrResult.sha256 == Receipt.sha256)
+        .where(Receipt.expense_id == expense_id)
+        .order_by(Receipt.id)
+    )).all()
+    
+    statuses = []
+    for receipt, result in rows:
+        status_row = ReceiptOcrStatus(receipt_id=receipt.id, sha256=receipt.sha256)
+        if result is not None:
+            status_row.status = result.status
+            status_row.attempts = result.attempts
+            status_row.duration_ms = result.duration_ms
+            status_row.error = result.error
+            if result.status == OcrStatus.DONE:
+                status_row.prefill = OcrPrefill(
+                    amount=result.amount,
+                    currency=result.currency,
+                    date=result.date,
+                    description=result.vendor
+                )
+        statuses.append(status_row)
+    
+    prefill = next(
+        (row.prefill for row in reversed(statuses) if row.prefill and row.prefill.model_dump(exclude_none=True)),
+        None
+    )
+    return ExpenseOcrResponse(receipts=statuses, prefill=prefill)
+
+@router.get("/{expense_id}/ocr", response_model=ExpenseOcrResponse)
+async def get_expense_ocr(expense_id: int, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Extraction status of an expense's receipts and the fields they suggest"""
+    await get_accessible_expense(db, expense_id, principal)
+    try:
+        return await expense_ocr_status(db, expense_id)
+        
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch OCR status: {str(e)}"
+        )
+
+@router.post("/{expense_id}/ocr", response_model=ExpenseOcrResponse)
+async def rerun_expense_ocr(expense_id: int, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Queue extraction for receipts that were never processed or whose extraction failed"""
+    await get_accessible_expense(db, expense_id, principal)
+    try:
+        digests = (await db.execute(
+            select(Receipt.sha256).where(Receipt.expense_id == expense_id).distinct()
+        )).scalars().all()
+        for sha256 in digests:
+            await ocr_queue.submit(db, sha256, rerun_failed=True)
+        
+        return await expense_ocr_status(db, expense_id)
+        
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to queue OCR: {str(e)}"
+        )
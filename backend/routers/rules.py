@@ -0,0 +1,180 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import List, Optional
+from datetime import datetime
+from auth import Principal, get_current_principal
+from database import get_async_db
+from models import ApprovalRule, ApprovalRuleApprover
+from workflow import rule_index
+from pydantic import BaseModel, Field, model_validator
+
+router = APIRouter()
+
+# Pydantic models for request/response
+class ApprovalRuleCreate(BaseModel):
+    name: str
+    is_active: bool = True
+    priority: int = 100
+    min_amount: float = Field(0.0, ge=0)
+    max_amount: Optional[float] = None
+    is_sequential: bool = True
+    approval_percentage: Optional[int] = Field(None, ge=1, le=100)
+    specific_approver_id: Optional[int] = None
+    approver_ids: List[int] = []
+
+    @model_validator(mode="after")
+    def check_rule(self):
+        if self.max_amount is not None and self.max_amount <= self.min_amount:
+            raise ValueError("max_amount must be greater than min_amount")
+        if not self.approver_ids and self.specific_approver_id is None:
+            raise ValueError("A rule needs at least one approver or a specific approver")
+        return self
+
+class ApprovalRuleResponse(BaseModel):
+    id: int
+    name: str
+    is_active: bool
+    priority: int
+    min_amount: float
+    max_amount: Optional[float] = None
+    is_sequential: bool
+    approval_percentage: Optional[int] = None
+    specific_approver_id: Optional[int] = None
+    approver_ids: List[int]
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+    @classmethod
+    def from_rule(cls, rule: ApprovalRule) -> "ApprovalRuleResponse":
+        return cls(
+            id=rule.id,
+            name=rule.name,
+            is_active=rule.is_active,
+            priority=rule.priority,
+            min_amount=rule.min_amount,
+            max_amount=rule.max_amount,
+            is_sequential=rule.is_sequential,
+            approval_percentage=rule.approval_percentage,
+            specific_approver_id=rule.specific_approver_id,
+            approver_ids=[approver.approver_id for approver in rule.approvers],
+            created_at=rule.created_at,
+            updated_at=rule.updated_at,
+        )
+
+def require_admin(principal: Principal):
+    if not principal.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access denied. Admin privileges required."
+        )
+
+async def load_rule(db: AsyncSession, rule_id: int) -> ApprovalRule:
+    rule = (await db.execute(
+        select(ApprovalRule)
+        .where(ApprovalRule.id == rule_id)
+        .options(selectinload(ApprovalRule.approvers))
+        .execution_options(populate_existing=True)
+    )).scalar_one_or_none()
+    if not rule:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Approval rule not found"
+        )
+    return rule
+
+async def apply_rule_fields(db: AsyncSession, rule: ApprovalRule, data: ApprovalRuleCreate):
+    for field, value in data.model_dump(exclude={"approver_ids"}).items():
+        setattr(rule, field, value)
+    if rule.id is not None:
+        # Remove the old chain first so re-used sequence numbers do not collide
+        rule.approvers.clear()
+        await db.flush()
+    rule.approvers = [
+        ApprovalRuleApprover(sequence=sequence, approver_id=approver_id)
+        for sequence, approver_id in enumerate(data.approver_ids, start=1)
+    ]
+
+@router.get("/", response_model=List[ApprovalRuleResponse])
+async def get_approval_rules(db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Get all approval rules ordered by priority"""
+    try:
+        rules = (await db.execute(
+            select(ApprovalRule)
+            .options(selectinload(ApprovalRule.approvers))
+            .order_by(ApprovalRule.priority, ApprovalRule.id)
+        )).scalars().all()
+        
+        return [ApprovalRuleResponse.from_rule(rule) for rule in rules]
+        
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch approval rules: {str(e)}"
+        )
+
+@router.post("/", response_model=ApprovalRuleResponse)
+async def create_approval_rule(rule_data: ApprovalRuleCreate, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Create an approval rule (Admin only)"""
+    require_admin(principal)
+    try:
+        rule = ApprovalRule(approvers=[])
+        await apply_rule_fields(db, rule, rule_data)
+        db.add(rule)
+        await rule_index.bump(db)
+        await db.commit()
+        rule_index.invalidate()
+        
+        return ApprovalRuleResponse.from_rule(await load_rule(db, rule.id))
+        
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to create approval rule: {str(e)}"
+        )
+
+@router.put("/{rule_id}", response_model=ApprovalRuleResponse)
+async def update_approval_rule(rule_id: int, rule_data: ApprovalRuleCreate, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Replace an approval rule (Admin only). Expenses already routed keep their steps."""
+    require_admin(principal)
+    try:
+        rule = await load_rule(db, rule_id)
+        await apply_rule_fields(db, rule, rule_data)
+        await rule_index.bump(db)
+        await db.commit()
+        rule_index.invalidate()
+        
+        return ApprovalRuleResponse.from_rule(await load_rule(db, rule_id))
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to update approval rule: {str(e)}"
+        )
+
+@router.delete("/{rule_id}")
+async def delete_approval_rule(rule_id: int, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Delete an approval rule (Admin only)"""
+    require_admin(principal)
+    try:
+        rule = await load_rule(db, rule_id)
+        await db.delete(rule)
+        await rule_index.bump(db)
+        await db.commit()
+        rule_index.invalidate()
+        
+        return {"message": "Approval rule deleted successfully"}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to delete approval rule: {str(e)}"
+        )
@@ -1,63 +1,441 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from database import get_db
-from models import User
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Any, Dict, List, Optional, Set
+from datetime import datetime
+from auth import Principal, get_current_principal, hash_password, invalidate_user
+from cache import pending_tag, response_cache
+from database import get_async_db
+from hierarchy import add_user, has_reportees, is_below, move_user, remove_user, reportees_filter
+from models import Expense, ExpenseArchive, User, UserHierarchy, UserRole
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_id_cursor, encode_id_cursor
 from pydantic import BaseModel
 
 router = APIRouter()
 
 # Pydantic models for request/response
 class UserCreate(BaseModel):
+    name: str
     email: str
-    username: str
-    full_name: str
-    password: str
+    password: Optional[str] = None  # Users without a password cannot log in
+    role: UserRole = UserRole.EMPLOYEE
+    manager_id: Optional[int] = None
 
 class UserResponse(BaseModel):
     id: int
+    name: str
     email: str
-    username: str
-    full_name: str
-    is_active: bool
-    is_admin: bool
-    created_at: str
+    role: UserRole
+    manager_id: Optional[int] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
     
     class Config:
         from_attributes = True
 
+class UserPage(BaseModel):
+    items: List[UserResponse]
+    next_cursor: Optional[str] = None
+    limit: int
+
 class UserUpdate(BaseModel):
-    email: str = None
-    username: str = None
-    full_name: str = None
-    is_active: bool = None
+    name: Optional[str] = None
+    email: Optional[str] = None
+    password: Optional[str] = None
+    role: Optional[UserRole] = None
+    manager_id: Optional[int] = None  # Sent as null to take the user off their manager
+
+class RoleUpdate(BaseModel):
+    role: UserRole
+    updated_by: Optional[int] = None  # Sent by the admin screen; the token decides who is acting
+
+class UserChange(BaseModel):
+    user_id: int
+    role: Optional[UserRole] = None
+    manager_id: Optional[int] = None  # Sent as null to take the user off their manager
+
+class BatchUserRequest(BaseModel):
+    changes: List[UserChange]
+
+class BatchUserResponse(BaseModel):
+    updated: List[int]
+
+def require_admin(principal: Principal):
+    if not principal.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access denied. Admin privileges required."
+        )
+
+async def require_visible(db: AsyncSession, principal: Principal, user_id: int):
+    """Admins see everyone, other users themselves and the people below them"""
+    if principal.is_admin or principal.user_id == user_id:
+        return
+    if not await is_below(db, principal.user_id, user_id):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access denied. You can only view yourself and your reportees."
+        )
+
+async def load_user(db: AsyncSession, user_id: int) -> User:
+    user = await db.get(User, user_id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    return user
 
-@router.post("/", response_model=UserResponse)
-async def create_user(user: UserCreate, db: Session = Depends(get_db)):
+async def apply_changes(db: AsyncSession, user: User, changes: Dict[str, Any], managers: Set[int]) -> bool:
+    """
+    Apply role and manager changes to `user` in the current transaction.
+    Adds the approvers whose queues change to `managers` and returns whether
+    the role changed.
+    """
+    if "manager_id" in changes and changes["manager_id"] != user.manager_id:
+        manager_id = changes["manager_id"]
+        if manager_id is not None and await db.get(User, manager_id) is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Manager {manager_id} not found"
+            )
+        try:
+            await move_user(db, user.id, manager_id)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
+        # The user's unrouted pending expenses leave one queue for the other
+        managers.update(m for m in (user.manager_id, manager_id) if m is not None)
+        user.manager_id = manager_id
+    
+    if changes.get("role") is not None and changes["role"] != user.role:
+        user.role = changes["role"]
+        return True
+    return False
+
+async def finish_changes(managers: Set[int], role_changed: Set[int]):
+    """Invalidate what the committed changes made stale"""
+    await response_cache.invalidate(pending_tag(manager_id) for manager_id in managers)
+    for user_id in role_changed:
+        invalidate_user(user_id)
+
+async def password_hash(password: str) -> str:
+    try:
+        return await run_in_threadpool(hash_password, password)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+def email_taken():
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="A user with this email already exists"
+    )
+
+@router.post("/", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
     """Create a new user"""
-    # TODO: Implement user creation logic
-    pass
+    try:
+        require_admin(principal)
+        
+        if user.manager_id is not None and await db.get(User, user.manager_id) is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Manager {user.manager_id} not found"
+            )
+        
+        db_user = User(
+            name=user.name,
+            email=user.email,
+            role=user.role,
+            manager_id=user.manager_id,
+            password_hash=await password_hash(user.password) if user.password else None
+        )
+        db.add(db_user)
+        await db.flush()
+        await add_user(db, db_user.id, user.manager_id)
+        await db.commit()
+        await db.refresh(db_user)
+        
+        return db_user
+        
+    except HTTPException:
+        await db.rollback()
+        raise
+    except IntegrityError:
+        await db.rollback()
+        raise email_taken()
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to create user: {str(e)}"
+        )
+
+@router.get("/", response_model=UserPage)
+async def get_users(
+    cursor: Optional[str] = Query(None, description="Opaque cursor returned as next_cursor"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    role: Optional[UserRole] = Query(None, description="Filter by role"),
+    manager_id: Optional[int] = Query(None, description="Filter by direct manager"),
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Get a page of users in id order"""
+    try:
+        require_admin(principal)
+        
+        query = select(User)
+        if role is not None:
+            query = query.where(User.role == role)
+        if manager_id is not None:
+            query = query.where(User.manager_id == manager_id)
+        if cursor:
+            query = query.where(User.id > decode_id_cursor(cursor))
+        
+        # Fetch one extra row to know whether another page exists
+        users = (await db.execute(query.order_by(User.id).limit(limit + 1))).scalars().all()
+        has_more = len(users) > limit
+        users = users[:limit]
+        
+        return UserPage(
+            items=users,
+            next_cursor=encode_id_cursor(users[-1].id) if has_more else None,
+            limit=limit
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch users: {str(e)}"
+        )
 
-@router.get("/", response_model=List[UserResponse])
-async def get_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    """Get all users"""
-    # TODO: Implement get users logic
-    pass
+@router.post("/batch", response_model=BatchUserResponse)
+async def update_users_batch(
+    batch_request: BatchUserRequest,
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Change the roles and managers of many users in a single transaction"""
+    try:
+        require_admin(principal)
+        
+        seen = set()
+        for change in batch_request.changes:
+            if change.user_id in seen:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"User {change.user_id} appears more than once in the batch"
+                )
+            seen.add(change.user_id)
+        
+        # One query loads every user the batch names; the rest come from the identity map
+        referenced = seen | {change.manager_id for change in batch_request.changes if change.manager_id is not None}
+        users = {
+            user.id: user
+            for user in (await db.execute(select(User).where(User.id.in_(referenced)))).scalars()
+        }
+        missing = sorted(referenced - users.keys())
+        if missing:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Users not found: {missing}"
+            )
+        
+        # Applied in order, so a change may rely on a move earlier in the batch
+        managers: Set[int] = set()
+        role_changed: Set[int] = set()
+        for change in batch_request.changes:
+            if await apply_changes(db, users[change.user_id], change.model_dump(exclude_unset=True), managers):
+                role_changed.add(change.user_id)
+        
+        await db.commit()
+        await finish_changes(managers, role_changed)
+        
+        return BatchUserResponse(updated=[change.user_id for change in batch_request.changes])
+        
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to update users: {str(e)}"
+        )
 
 @router.get("/{user_id}", response_model=UserResponse)
-async def get_user(user_id: int, db: Session = Depends(get_db)):
+async def get_user(user_id: int, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
     """Get a specific user by ID"""
-    # TODO: Implement get user logic
-    pass
+    try:
+        await require_visible(db, principal, user_id)
+        return await load_user(db, user_id)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch user: {str(e)}"
+        )
+
+@router.get("/{user_id}/reportees", response_model=UserPage)
+async def get_reportees(
+    user_id: int,
+    recursive: bool = Query(False, description="Everyone below the user rather than their direct reports"),
+    cursor: Optional[str] = Query(None, description="Opaque cursor returned as next_cursor"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+    principal: Principal = Depends(get_current_principal)
+):
+    """Get a page of the users reporting to a user, in id order"""
+    try:
+        await require_visible(db, principal, user_id)
+        
+        # A range scan of the hierarchy's (ancestor_id, descendant_id) key at any depth
+        query = (
+            select(User)
+            .join(UserHierarchy, UserHierarchy.descendant_id == User.id)
+            .where(reportees_filter(user_id, recursive))
+        )
+        if cursor:
+            query = query.where(UserHierarchy.descendant_id > decode_id_cursor(cursor))
+        
+        users = (await db.execute(query.order_by(UserHierarchy.descendant_id).limit(limit + 1))).scalars().all()
+        has_more = len(users) > limit
+        users = users[:limit]
+        
+        return UserPage(
+            items=users,
+            next_cursor=encode_id_cursor(users[-1].id) if has_more else None,
+            limit=limit
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch reportees: {str(e)}"
+        )
 
 @router.put("/{user_id}", response_model=UserResponse)
-async def update_user(user_id: int, user_update: UserUpdate, db: Session = Depends(get_db)):
+async def update_user(user_id: int, user_update: UserUpdate, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
     """Update a user"""
-    # TODO: Implement update user logic
-    pass
+    try:
+        require_admin(principal)
+        db_user = await load_user(db, user_id)
+        
+        changes = user_update.model_dump(exclude_unset=True)
+        if changes.get("name") is not None:
+            db_user.name = changes["name"]
+        if changes.get("email") is not None:
+            db_user.email = changes["email"]
+        if changes.get("password"):
+            db_user.password_hash = await password_hash(changes["password"])
+        
+        managers: Set[int] = set()
+        role_changed = await apply_changes(db, db_user, changes, managers)
+        
+        await db.commit()
+        await db.refresh(db_user)
+        await finish_changes(managers, {user_id} if role_changed else set())
+        
+        return db_user
+        
+    except HTTPException:
+        await db.rollback()
+        raise
+    except IntegrityError:
+        await db.rollback()
+        raise email_taken()
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to update user: {str(e)}"
+        )
+
+@router.patch("/{user_id}/role", response_model=UserResponse)
+async def update_user_role(user_id: int, role_update: RoleUpdate, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Change a user's role"""
+    try:
+        require_admin(principal)
+        db_user = await load_user(db, user_id)
+        
+        managers: Set[int] = set()
+        role_changed = await apply_changes(db, db_user, {"role": role_update.role}, managers)
+        
+        await db.commit()
+        await db.refresh(db_user)
+        await finish_changes(managers, {user_id} if role_changed else set())
+        
+        return db_user
+        
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to update user role: {str(e)}"
+        )
 
 @router.delete("/{user_id}")
-async def delete_user(user_id: int, db: Session = Depends(get_db)):
-    """Delete a user"""
-    # TODO: Implement delete user logic
-    pass
+async def delete_user(user_id: int, db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(get_current_principal)):
+    """Delete a user without reportees or expenses"""
+    try:
+        require_admin(principal)
+        if user_id == principal.user_id:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="You cannot delete your own account"
+            )
+        await load_user(db, user_id)
+        
+        if await has_reportees(db, user_id):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="User has reportees; assign them another manager first"
+            )
+        # Deleting the user would cascade to their expenses and leave the summaries behind
+        owns_expenses = select(Expense.id).where(Expense.owner_id == user_id).limit(1)
+        owns_archived = select(ExpenseArchive.id).where(ExpenseArchive.owner_id == user_id).limit(1)
+        if (await db.execute(owns_expenses)).first() is not None or (await db.execute(owns_archived)).first() is not None:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="User has expenses and cannot be deleted"
+            )
+        
+        # A Core delete: the ORM cascade would load the (empty) expenses collection first
+        await remove_user(db, user_id)
+        await db.execute(delete(User).where(User.id == user_id))
+        await db.commit()
+        invalidate_user(user_id)
+        
+        return {"message": "User deleted successfully"}
+        
+    except HTTPException:
+        await db.rollback()
+        raise
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="User is still referenced by approval rules or steps"
+        )
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to delete user: {str(e)}"
+        )
@@ -0,0 +1,30 @@
+"""Response models shared by several routers."""
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+class DuplicateSuspect(BaseModel):
+    expense_id: int  # The earlier expense this one may duplicate
+    reason: str  # "Exact" or "Similar"
+    similarity: float  # Share of description shingles in common
+
+class ExpenseResponse(BaseModel):
+    id: int
+    amount: float
+    currency: str
+    date: datetime
+    description: str
+    status: str
+    owner_id: int
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    amount_base: Optional[float] = None  # Amount in the base currency, when a rate is known
+    suspected_duplicates: Optional[List[DuplicateSuspect]] = None  # Set on create and edit, and in the approval queues
+    
+    class Config:
+        from_attributes = True
+
+class FlaggedExpense(BaseModel):
+    expense_id: int
+    suspected_duplicates: List[DuplicateSuspect]
@@ -0,0 +1,244 @@
+"""
+Full-text search over expense descriptions.
+
+SQLite: an external-content FTS5 table (expenses_fts) indexes
+expenses.description and is kept in sync by triggers, so Core bulk inserts
+and updates are covered as well as ORM writes. Postgres: a generated
+tsvector column with a GIN index, which the database maintains itself.
+expenses_archive gets the same index (expenses_archive_fts), searched
+alongside the hot one.
+
+install_search_index() runs with create_tables() and is idempotent; when it
+creates the FTS table on an existing database it backfills it.
+
+User input is never passed through as query syntax: every term is quoted
+and the terms are ANDed, with the last one matched as a prefix so results
+keep up with typing.
+
+Finding matches is cheap; scoring them is not, since every match has to be
+scored before the best can be returned. Queries matching more than
+SEARCH_RANK_LIMIT expenses (say "taxi") are therefore listed newest first,
+which the index can answer by walking its doclist backwards and stopping
+after one page. The first page decides the order and the cursor keeps it.
+"""
+import hashlib
+import re
+from typing import List, NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import ColumnElement, Connection, FromClause, and_, column, func, literal_column, or_, select, table, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from archive import reaches_archive
+from models import Expense, ExpenseArchive
+from pagination import ExpenseFilters, ExpensePage, dump_cursor, expense_columns, expense_items, load_cursor
+
+# Tables with a description index: the hot table and its archive (archive.py)
+SEARCHABLE_TABLES = ("expenses", "expenses_archive")
+
+def sqlite_ddl(name: str) -> List[str]:
+    """External-content FTS5 table `{name}_fts` and the triggers keeping it in sync with `name`"""
+    return [
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {name}_fts USING fts5(
+            description,
+            content='{name}',
+            content_rowid='id',
+            tokenize='porter unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_fts_insert AFTER INSERT ON {name} BEGIN
+            INSERT INTO {name}_fts(rowid, description) VALUES (new.id, new.description);
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_fts_delete AFTER DELETE ON {name} BEGIN
+            INSERT INTO {name}_fts({name}_fts, rowid, description) VALUES ('delete', old.id, old.description);
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_fts_update AFTER UPDATE OF description ON {name} BEGIN
+            INSERT INTO {name}_fts({name}_fts, rowid, description) VALUES ('delete', old.id, old.description);
+            INSERT INTO {name}_fts(rowid, description) VALUES (new.id, new.description);
+        END
+        """,
+    ]
+
+def postgres_ddl(name: str) -> List[str]:
+    return [
+        f"""
+        ALTER TABLE {name} ADD COLUMN IF NOT EXISTS description_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('simple', coalesce(description, ''))) STORED
+        """,
+        f"CREATE INDEX IF NOT EXISTS ix_{name}_description_tsv ON {name} USING gin (description_tsv)",
+    ]
+
+MAX_TERMS = 16
+TERM = re.compile(r"\w+", re.UNICODE)
+
+def install_search_index(connection: Connection):
+    """Create the dialect's search index and sync machinery if missing"""
+    dialect = connection.dialect.name
+    for name in SEARCHABLE_TABLES:
+        if dialect == "sqlite":
+            existed = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {"name": f"{name}_fts"}
+            ).first() is not None
+            for statement in sqlite_ddl(name):
+                connection.execute(text(statement))
+            if not existed:
+                connection.execute(text(f"INSERT INTO {name}_fts({name}_fts) VALUES ('rebuild')"))
+        elif dialect == "postgresql":
+            for statement in postgres_ddl(name):
+                connection.execute(text(statement))
+
+def search_terms(q: str) -> List[str]:
+    terms = TERM.findall(q.lower())[:MAX_TERMS]
+    if not terms:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Search query must contain at least one word"
+        )
+    return terms
+
+def fts5_query(terms: List[str]) -> str:
+    """Quoted terms ANDed together, the last one as a prefix"""
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+def tsquery(terms: List[str]) -> str:
+    return " & ".join(terms[:-1] + [f"{terms[-1]}:*"])
+
+RANKED = "rank"
+NEWEST = "newest"
+
+def encode_search_cursor(q_hash: str, order: str, rank: float, expense_id: int) -> str:
+    return dump_cursor({"s": "search", "q": q_hash, "o": order, "v": rank, "id": expense_id})
+
+def decode_search_cursor(cursor: str, q_hash: str) -> Tuple[str, float, int]:
+    try:
+        payload = load_cursor(cursor)
+        if payload["s"] != "search" or payload["q"] != q_hash:
+            raise ValueError("cursor was issued for a different search")
+        if payload["o"] not in (RANKED, NEWEST):
+            raise ValueError("unknown order")
+        return payload["o"], float(payload["v"]), int(payload["id"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid cursor: {str(e)}"
+        )
+
+class Matcher(NamedTuple):
+    model: type  # Expense or ExpenseArchive
+    index: Optional[FromClause]  # Joined to the model's table; None when the index is one of its columns
+    expense_id: ColumnElement
+    rank: ColumnElement  # Lower is a better match
+    condition: ColumnElement
+
+def _matcher(dialect: str, terms: List[str], model=Expense) -> Matcher:
+    name = model.__tablename__
+    if dialect == "sqlite":
+        fts = table(f"{name}_fts", column("rowid"), column("rank"))
+        condition = text(f"{name}_fts MATCH :fts_query").bindparams(fts_query=fts5_query(terms))
+        return Matcher(model, fts, fts.c.rowid, fts.c.rank, condition)
+    if dialect == "postgresql":
+        query = func.to_tsquery("simple", tsquery(terms))
+        vector = literal_column(f"{name}.description_tsv")
+        return Matcher(model, None, model.id, -func.ts_rank_cd(vector, query), vector.op("@@")(query))
+    raise HTTPException(
+        status_code=status.HTTP_501_NOT_IMPLEMENTED,
+        detail=f"Search is not available on the '{dialect}' database"
+    )
+
+async def _count_matches(db: AsyncSession, matcher: Matcher, cap: int) -> int:
+    """Number of matches, counting no further than cap"""
+    capped = (
+        select(matcher.expense_id)
+        .select_from(matcher.index if matcher.index is not None else matcher.model)
+        .where(matcher.condition)
+        .limit(cap)
+        .subquery()
+    )
+    return (await db.execute(select(func.count()).select_from(capped))).scalar_one()
+
+def _page_query(matcher: Matcher, filters: ExpenseFilters, ranked: bool, last_rank: Optional[float], last_id: Optional[int], limit: int):
+    model = matcher.model
+    query = select(*expense_columns(model).values(), *([matcher.rank.label("rank")] if ranked else []))
+    if matcher.index is not None:
+        query = query.join(matcher.index, matcher.expense_id == model.id)
+    query = filters.apply(query.where(matcher.condition), model)
+
+    if ranked:
+        if last_id is not None:
+            query = query.filter(or_(
+                matcher.rank > last_rank,
+                and_(matcher.rank == last_rank, model.id > last_id)
+            ))
+        query = query.order_by(matcher.rank, model.id)
+    else:
+        # Ordering on the index's own id lets SQLite walk the doclist and stop early
+        if last_id is not None:
+            query = query.filter(matcher.expense_id < last_id)
+        query = query.order_by(matcher.expense_id.desc())
+    # Fetch one extra row to know whether another page exists
+    return query.limit(limit + 1)
+
+async def search_expenses(
+    db: AsyncSession,
+    q: str,
+    filters: ExpenseFilters,
+    cursor: Optional[str],
+    limit: int,
+) -> ExpensePage:
+    """
+    One page of expenses whose description matches `q`, narrowed by the
+    usual listing filters. Best match first (ties by id) on a keyset over
+    (rank, id), or newest first on id for very broad queries; each item
+    carries its score, which is null in the newest-first order. Cursors are
+    bound to the query text. Archived expenses are searched too when the
+    filters can reach them; their scores come from the archive's own index.
+    """
+    terms = search_terms(q)
+    q_hash = hashlib.blake2b(" ".join(terms).encode(), digest_size=8).hexdigest()
+    dialect = db.bind.dialect.name
+    matchers = [_matcher(dialect, terms)]
+    if await reaches_archive(db, filters):
+        matchers.append(_matcher(dialect, terms, ExpenseArchive))
+
+    if cursor:
+        order, last_rank, last_id = decode_search_cursor(cursor, q_hash)
+    else:
+        order, last_rank, last_id = RANKED, None, None
+        matches = 0
+        for matcher in matchers:
+            matches += await _count_matches(db, matcher, config.SEARCH_RANK_LIMIT + 1 - matches)
+            if matches > config.SEARCH_RANK_LIMIT:
+                order = NEWEST
+                break
+
+    ranked = order == RANKED
+    rows = []
+    for matcher in matchers:
+        rows.extend((await db.execute(_page_query(matcher, filters, ranked, last_rank, last_id, limit))).all())
+    if len(matchers) > 1:
+        if ranked:
+            rows.sort(key=lambda row: (row.rank, row.id))
+        else:
+            rows.sort(key=lambda row: row.id, reverse=True)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    items = expense_items(rows)
+    for item, row in zip(items, rows):
+        item["score"] = round(-row.rank, 6) if ranked else None
+    next_cursor = None
+    if has_more and rows:
+        next_cursor = encode_search_cursor(q_hash, order, rows[-1].rank if ranked else 0, rows[-1].id)
+
+    return ExpensePage.model_construct(items=items, next_cursor=next_cursor, limit=limit)
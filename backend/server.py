@@ -0,0 +1,114 @@
+"""
+Production entry point: several uvicorn workers behind one listening socket.
+
+    python server.py                    # WEB_WORKERS workers on WEB_HOST:WEB_PORT
+    python server.py --workers 8 --port 9000
+
+The supervisor process prepares the database once (schema, interrupted OCR
+jobs) and then starts the workers with INIT_ON_STARTUP turned off, so they
+neither race each other creating tables nor requeue a job another worker
+is running. Each worker warms its connection pool and rate table in the
+app's lifespan before serving. uvloop and httptools are used when installed.
+
+On SIGTERM the workers stop accepting, give in-flight requests
+WEB_GRACEFUL_TIMEOUT seconds and then run the lifespan shutdown. Approval
+event streams never finish on their own, so they are the ones cut at the
+timeout; clients reconnect with Last-Event-ID.
+
+State that lives in one process is not shared between workers:
+- the response cache, unless REDIS_URL is set; without it the cache is
+  turned off so no worker serves entries another worker invalidated
+- the approval change feed (events.bus), unless REDIS_URL is set; without
+  it the streams answer 503, since a subscriber would only see the writes
+  its own worker handled
+- rate limit buckets, unless REDIS_URL is set; without it a client gets
+  each budget once per worker. Admission caps are per worker by design.
+- the compiled approval rules (workflow.rule_index); each worker checks
+  the approval_rules_version row on every routing and recompiles once
+  another worker has edited a rule
+- /metrics, which reports the worker that answered the scrape
+"""
+import argparse
+import asyncio
+import importlib.util
+import logging
+import os
+
+import uvicorn
+
+import config
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger("server")
+
+def _available(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+def prepare_database():
+    """Run the one-time startup work in the supervisor, before any worker exists"""
+    from database import async_engine, engine
+    from main import initialize_database
+
+    async def run():
+        try:
+            await initialize_database()
+        finally:
+            await async_engine.dispose()
+
+    asyncio.run(run())
+    engine.dispose()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=config.WEB_HOST)
+    parser.add_argument("--port", type=int, default=config.WEB_PORT)
+    parser.add_argument("--workers", type=int, default=config.WEB_WORKERS)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s:     %(message)s")
+    logger.setLevel(args.log_level.upper())
+
+    if not config.JWT_SECRET:
+        parser.error("JWT_SECRET must be set: every worker would otherwise sign tokens with its own random key")
+    if config.AUTH_DEV_USER_ID:
+        logger.warning("AUTH_DEV_USER_ID is set: requests without a token act as user %d", config.AUTH_DEV_USER_ID)
+
+    prepare_database()
+    # Read by the workers, which import config afresh
+    os.environ["INIT_ON_STARTUP"] = "0"
+    if args.workers > 1:
+        if not config.REDIS_URL:
+            if config.RESPONSE_CACHE_TTL:
+                logger.warning("REDIS_URL is not set: response cache disabled for %d workers", args.workers)
+                os.environ["RESPONSE_CACHE_TTL"] = "0"
+            if config.RATE_LIMIT_ENABLED:
+                logger.warning("REDIS_URL is not set: each worker keeps its own rate limit buckets")
+            if config.EVENT_STREAMS:
+                logger.warning("REDIS_URL is not set: approval event streams disabled for %d workers", args.workers)
+                os.environ["EVENT_STREAMS"] = "0"
+
+    loop = "uvloop" if _available("uvloop") else "asyncio"
+    http = "httptools" if _available("httptools") else "h11"
+    logger.info("Starting %d worker(s) on %s:%d (%s, %s)", args.workers, args.host, args.port, loop, http)
+    uvicorn.run(
+        "main:app",
+        app_dir=BACKEND_DIR,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=loop,
+        http=http,
+        lifespan="on",
+        backlog=config.WEB_BACKLOG,
+        timeout_keep_alive=config.WEB_KEEPALIVE,
+        timeout_graceful_shutdown=config.WEB_GRACEFUL_TIMEOUT,
+        limit_concurrency=config.WEB_LIMIT_CONCURRENCY or None,
+        log_level=args.log_level,
+        # Per-request logging is left to a proxy in front; /metrics counts requests
+        access_log=False,
+        proxy_headers=True,
+    )
+
+if __name__ == "__main__":
+    main()
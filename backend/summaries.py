@@ -0,0 +1,211 @@
+"""
+Incrementally maintained expense aggregates.
+
+Every expense write records the change it makes to the (owner, status,
+currency, month) groups in the same transaction, so totals can be read from
+expense_summaries in O(groups) instead of scanning expenses.
+
+Archived expenses keep their totals here: archive.py moves rows without
+touching the summaries, and a rebuild counts both tables.
+
+Rebuild and reconcile drift from the command line:
+
+    python -m summaries rebuild
+"""
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, func, select, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import Expense, ExpenseArchive, ExpenseStatus, ExpenseSummary
+
+SummaryKey = Tuple[int, ExpenseStatus, str, str]
+
+def summary_month(date: datetime) -> str:
+    return date.strftime("%Y-%m")
+
+def summary_key(owner_id: int, status, currency: str, date: datetime) -> SummaryKey:
+    """Group key for one expense"""
+    return owner_id, ExpenseStatus(status), currency, summary_month(date)
+
+class SummaryDelta:
+    """Accumulates count/amount changes per group before they are written"""
+
+    def __init__(self):
+        self.changes: Dict[SummaryKey, list] = defaultdict(lambda: [0, 0.0])
+
+    def add(self, owner_id: int, status, currency: str, date: datetime, amount: float, sign: int = 1):
+        change = self.changes[summary_key(owner_id, status, currency, date)]
+        change[0] += sign
+        change[1] += sign * amount
+        return self
+
+    def remove(self, owner_id: int, status, currency: str, date: datetime, amount: float):
+        return self.add(owner_id, status, currency, date, amount, sign=-1)
+
+    def add_expense(self, expense, sign: int = 1):
+        return self.add(expense.owner_id, expense.status, expense.currency, expense.date, expense.amount, sign)
+
+    def __bool__(self):
+        return any(count or amount for count, amount in self.changes.values())
+
+def _upsert(dialect_name: str):
+    if dialect_name == "postgresql":
+        return pg_insert
+    if dialect_name == "sqlite":
+        return sqlite_insert
+    raise ValueError(f"Expense summaries do not support the '{dialect_name}' dialect")
+
+def _upsert_statement(dialect_name: str, delta: SummaryDelta):
+    rows = [
+        {
+            "owner_id": owner_id,
+            "status": status,
+            "currency": currency,
+            "month": month,
+            "expense_count": count,
+            "total_amount": amount,
+        }
+        for (owner_id, status, currency, month), (count, amount) in delta.changes.items()
+        if count or amount
+    ]
+    stmt = _upsert(dialect_name)(ExpenseSummary).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=["owner_id", "status", "currency", "month"],
+        set_={
+            "expense_count": ExpenseSummary.expense_count + stmt.excluded.expense_count,
+            "total_amount": ExpenseSummary.total_amount + stmt.excluded.total_amount,
+        },
+    )
+
+async def apply_summary_delta(db: AsyncSession, delta: SummaryDelta):
+    """Apply accumulated changes with a single upsert; caller commits."""
+    if not delta:
+        return
+    await db.execute(_upsert_statement(db.bind.dialect.name, delta))
+
+def _month_expression(dialect_name: str, date_column=Expense.date):
+    if dialect_name == "postgresql":
+        return func.to_char(date_column, "YYYY-MM")
+    return func.strftime("%Y-%m", date_column)
+
+def summary_query(
+    group_by: Iterable[str],
+    owner_id: Optional[int] = None,
+    status: Optional[ExpenseStatus] = None,
+    currency: Optional[str] = None,
+    month_from: Optional[str] = None,
+    month_to: Optional[str] = None,
+):
+    """Roll summary rows up to the requested grouping columns"""
+    columns = [getattr(ExpenseSummary, name) for name in group_by]
+    stmt = select(
+        *columns,
+        func.sum(ExpenseSummary.expense_count).label("count"),
+        func.sum(ExpenseSummary.total_amount).label("total"),
+    ).where(ExpenseSummary.expense_count > 0)
+    if owner_id is not None:
+        stmt = stmt.where(ExpenseSummary.owner_id == owner_id)
+    if status is not None:
+        stmt = stmt.where(ExpenseSummary.status == status)
+    if currency is not None:
+        stmt = stmt.where(ExpenseSummary.currency == currency)
+    if month_from is not None:
+        stmt = stmt.where(ExpenseSummary.month >= month_from)
+    if month_to is not None:
+        stmt = stmt.where(ExpenseSummary.month <= month_to)
+    return stmt.group_by(*columns).order_by(*columns)
+
+def rollup_with_base(
+    rows: Iterable[dict],
+    group_by: List[str],
+    convert: Callable[[float, str, datetime], Optional[float]],
+) -> List[dict]:
+    """
+    Roll rows grouped at least by currency and month up to `group_by`, adding
+    total_base. Each (currency, month) total is converted at the rate effective
+    on the first day of that month; total_base is None if any rate is missing.
+    """
+    groups: Dict[tuple, dict] = {}
+    for row in rows:
+        key = tuple(row[name] for name in group_by)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {**{name: row[name] for name in group_by}, "count": 0, "total": 0.0, "total_base": 0.0}
+        group["count"] += row["count"]
+        group["total"] += row["total"]
+        month_start = datetime.strptime(row["month"], "%Y-%m")
+        converted = convert(row["total"], row["currency"], month_start)
+        if converted is None or group["total_base"] is None:
+            group["total_base"] = None
+        else:
+            group["total_base"] += converted
+    for group in groups.values():
+        if group["total_base"] is not None:
+            group["total_base"] = round(group["total_base"], 2)
+    return [groups[key] for key in sorted(groups)]
+
+def rebuild_summaries(db: Session) -> dict:
+    """
+    Recompute every group from the hot and archived expenses and fix rows
+    that drifted. Runs in one transaction; returns how many groups were
+    inserted, updated or deleted.
+    """
+    dialect_name = db.bind.dialect.name
+    expenses = union_all(*(
+        select(table.id, table.owner_id, table.status, table.currency, table.date, table.amount)
+        for table in (Expense, ExpenseArchive)
+    )).subquery()
+    month = _month_expression(dialect_name, expenses.c.date)
+    actual = {
+        (owner_id, ExpenseStatus(status), currency, month_value): (count, total)
+        for owner_id, status, currency, month_value, count, total in db.execute(
+            select(
+                expenses.c.owner_id, expenses.c.status, expenses.c.currency, month,
+                func.count(expenses.c.id), func.sum(expenses.c.amount),
+            ).group_by(expenses.c.owner_id, expenses.c.status, expenses.c.currency, month)
+        )
+    }
+    stored = {
+        (row.owner_id, row.status, row.currency, row.month): (row.id, row.expense_count, row.total_amount)
+        for row in db.execute(select(ExpenseSummary)).scalars()
+    }
+
+    delta = SummaryDelta()
+    stale_ids = []
+    for key, (row_id, count, total) in stored.items():
+        if key not in actual:
+            stale_ids.append(row_id)
+    for key, (count, total) in actual.items():
+        stored_count, stored_total = stored.get(key, (None, 0, 0.0))[1:]
+        if stored_count != count or abs(stored_total - total) > 1e-6:
+            delta.changes[key] = [count - stored_count, total - stored_total]
+
+    if stale_ids:
+        db.execute(delete(ExpenseSummary).where(ExpenseSummary.id.in_(stale_ids)))
+    if delta.changes:
+        db.execute(_upsert_statement(dialect_name, delta))
+    db.commit()
+
+    return {
+        "groups": len(actual),
+        "inserted": sum(1 for key in delta.changes if key not in stored),
+        "updated": sum(1 for key in delta.changes if key in stored),
+        "deleted": len(stale_ids),
+    }
+
+if __name__ == "__main__":
+    import sys
+    from database import SessionLocal, create_tables
+
+    if sys.argv[1:] != ["rebuild"]:
+        print(__doc__)
+        sys.exit(2)
+    create_tables()
+    with SessionLocal() as session:
+        print(rebuild_summaries(session))
@@ -0,0 +1,63 @@
+import os
+import tempfile
+
+# Settings are read when the app modules are first imported, so they are set before any test module imports them
+_workdir = tempfile.mkdtemp(prefix="expenses-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_workdir}/expenses.db")
+os.environ.setdefault("RECEIPTS_DIR", os.path.join(_workdir, "receipts"))
+os.environ.setdefault("JWT_SECRET", "test-secret")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+# Ids repeat across tests once the tables are recreated
+os.environ.setdefault("RESPONSE_CACHE_TTL", "0")
+os.environ.setdefault("OCR_ENGINE", "stub")
+
+import pytest
+
+# Ids of the users every app test starts with
+ADMIN, MANAGER, EMPLOYEE, OTHER_MANAGER, OTHER_EMPLOYEE = 1, 2, 3, 4, 5
+
+@pytest.fixture
+def anyio_backend():
+    # Async tests run on asyncio only, the loop the app runs on
+    return "asyncio"
+
+@pytest.fixture(scope="session")
+def app_client():
+    """One running app for the session; the background tasks it starts belong to one event loop"""
+    from fastapi.testclient import TestClient
+
+    from database import create_tables, drop_tables
+    from main import app
+
+    drop_tables()
+    create_tables()
+    with TestClient(app) as client:
+        yield client
+
+@pytest.fixture
+def client(app_client):
+    """The app over emptied tables: an admin, and two managers with one employee each"""
+    from database import Base, SessionLocal, engine
+    from models import User, UserRole
+    from workflow import rule_index
+
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+        connection.exec_driver_sql("DELETE FROM sqlite_sequence")
+    rule_index.invalidate()
+    with SessionLocal() as db:
+        db.add_all([
+            User(id=ADMIN, name="Admin", email="admin@example.com", role=UserRole.ADMIN),
+            User(id=MANAGER, name="Manager", email="manager@example.com", role=UserRole.MANAGER),
+            User(id=EMPLOYEE, name="Employee", email="employee@example.com", role=UserRole.EMPLOYEE, manager_id=MANAGER),
+            User(id=OTHER_MANAGER, name="Other manager", email="other.manager@example.com", role=UserRole.MANAGER),
+            User(id=OTHER_EMPLOYEE, name="Other employee", email="other@example.com", role=UserRole.EMPLOYEE, manager_id=OTHER_MANAGER),
+        ])
+        db.commit()
+    return app_client
+
+def auth(user_id: int) -> dict:
+    """Headers authenticating as `user_id`"""
+    from auth import create_access_token
+    return {"Authorization": f"Bearer {create_access_token(user_id)}"}
@@ -0,0 +1,58 @@
+import pytest
+
+from conftest import ADMIN, EMPLOYEE, MANAGER, OTHER_MANAGER, auth
+from test_expenses import create_expense
+
+def decide(client, expense_id: int, approver_id: int, decision: str = "Approved"):
+    return client.post(f"/api/approvals/{expense_id}", json={"status": decision}, headers=auth(approver_id))
+
+def expense_status(client, expense_id: int) -> str:
+    return client.get(f"/api/expenses/{expense_id}", headers=auth(ADMIN)).json()["status"]
+
+@pytest.mark.parametrize("approver_id", [MANAGER, ADMIN])
+def test_owners_manager_or_admin_decides(client, approver_id):
+    expense_id = create_expense(client)
+
+    response = decide(client, expense_id, approver_id)
+
+    assert response.status_code == 200
+    assert expense_status(client, expense_id) == "Approved"
+
+def test_other_teams_manager_cannot_decide(client):
+    expense_id = create_expense(client)
+
+    assert decide(client, expense_id, OTHER_MANAGER).status_code == 403
+    assert expense_status(client, expense_id) == "Pending"
+
+def test_manager_cannot_decide_own_expense(client):
+    expense_id = create_expense(client, owner_id=MANAGER)
+
+    assert decide(client, expense_id, MANAGER).status_code == 403
+    assert decide(client, expense_id, ADMIN).status_code == 200
+
+def test_batch_applies_only_decidable_expenses(client):
+    reportees = create_expense(client)
+    own = create_expense(client, owner_id=MANAGER)
+    decided = create_expense(client)
+    assert decide(client, decided, ADMIN, "Rejected").status_code == 200
+
+    response = client.post("/api/approvals/batch", json={"decisions": [
+        {"expense_id": expense_id, "status": "Approved"} for expense_id in (reportees, own, decided, 999)
+    ]}, headers=auth(MANAGER))
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "applied": [reportees], "already_decided": [decided], "not_found": [999], "not_assigned": [own],
+    }
+    assert expense_status(client, own) == "Pending"
+
+def test_batch_from_other_team_is_not_assigned(client):
+    expense_id = create_expense(client)
+
+    response = client.post(
+        "/api/approvals/batch", json={"decisions": [{"expense_id": expense_id, "status": "Approved"}]},
+        headers=auth(OTHER_MANAGER),
+    )
+
+    assert response.json()["not_assigned"] == [expense_id]
+    assert expense_status(client, expense_id) == "Pending"
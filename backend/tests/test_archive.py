@@ -0,0 +1,66 @@
+from conftest import EMPLOYEE, MANAGER, auth
+
+def archive_old_expense(client) -> int:
+    """An approved expense from 2020, moved to the archive"""
+    from archive import archive_expenses
+
+    response = client.post(
+        "/api/expenses/",
+        json={"amount": 42.0, "currency": "USD", "date": "2020-01-15T00:00:00", "description": "Conference hotel"},
+        headers=auth(EMPLOYEE),
+    )
+    expense_id = response.json()["id"]
+    assert client.post(f"/api/approvals/{expense_id}", json={"status": "Approved"}, headers=auth(MANAGER)).status_code == 200
+    # On the app's event loop, which owns the async engine's connections
+    assert client.portal.call(archive_expenses, 0).archived == 1
+    return expense_id
+
+def test_rebuild_keeps_archived_totals(client):
+    from database import SessionLocal
+    from summaries import rebuild_summaries
+
+    archive_old_expense(client)
+
+    with SessionLocal() as db:
+        result = rebuild_summaries(db)
+
+    # Only the emptied Pending group goes
+    assert result == {"groups": 1, "inserted": 0, "updated": 0, "deleted": 1}
+    summary = client.get("/api/expenses/summary?group_by=month", headers=auth(EMPLOYEE)).json()
+    assert [(row["month"], row["count"], row["total"]) for row in summary] == [("2020-01", 1, 42.0)]
+
+def test_legacy_expenses_table_rebuilt_with_autoincrement(tmp_path):
+    from sqlalchemy import create_engine, inspect
+
+    from database import Base, _rebuild_expenses_with_autoincrement
+    from models import Expense
+
+    engine = create_engine(f"sqlite:///{tmp_path}/legacy.db")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        schema = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'expenses'").scalar()
+        connection.exec_driver_sql("DROP TABLE expenses")
+        connection.exec_driver_sql(schema.replace(" AUTOINCREMENT", ""))
+        row = "'USD', '2020-01-15 00:00:00.000000', 'Taxi', 'APPROVED', 3"
+        for expense_id in (1, 2, 3):
+            connection.exec_driver_sql(
+                f"INSERT INTO expenses (id, amount, currency, date, description, status, owner_id) VALUES ({expense_id}, 10.0, {row})"
+            )
+        connection.exec_driver_sql(
+            f"INSERT INTO expenses_archive (id, amount, currency, date, description, status, owner_id, archived_at) "
+            f"VALUES (7, 10.0, {row}, '2021-01-01 00:00:00.000000')"
+        )
+        # Without AUTOINCREMENT the next expense would get id 3 again
+        connection.exec_driver_sql("DELETE FROM expenses WHERE id = 3")
+
+    with engine.begin() as connection:
+        _rebuild_expenses_with_autoincrement(connection)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"INSERT INTO expenses (amount, currency, date, description, status, owner_id) VALUES (10.0, {row})")
+        ids = [expense_id for expense_id, in connection.exec_driver_sql("SELECT id FROM expenses ORDER BY id")]
+        schema = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'expenses'").scalar()
+
+    assert ids == [1, 2, 8]
+    assert "AUTOINCREMENT" in schema
+    assert {index["name"] for index in inspect(engine).get_indexes("expenses")} == {index.name for index in Expense.__table__.indexes}
+    engine.dispose()
@@ -0,0 +1,30 @@
+from conftest import ADMIN, EMPLOYEE, MANAGER, auth
+
+def test_role_change_applies_to_cached_token(client):
+    headers = auth(EMPLOYEE)
+    assert client.get("/api/users/", headers=headers).status_code == 403
+
+    promoted = client.patch(f"/api/users/{EMPLOYEE}/role", json={"role": "Admin"}, headers=auth(ADMIN))
+
+    assert promoted.status_code == 200
+    assert client.get("/api/users/", headers=headers).status_code == 200
+
+def test_invalidations_stay_bounded(client, monkeypatch):
+    import auth as auth_module
+    from cache import TTLCache
+
+    invalidated = TTLCache(maxsize=2, ttl=60)
+    monkeypatch.setattr(auth_module, "_invalidated", invalidated)
+    headers = auth(MANAGER)
+    token = headers["Authorization"].removeprefix("Bearer ")
+    assert client.get("/api/auth/me", headers=headers).status_code == 200
+    auth_module.invalidate_user(100)
+    auth_module.invalidate_user(101)
+    assert auth_module.cached_principal(token) is not None
+
+    # A third change cannot be recorded without forgetting one, so every cached principal goes
+    auth_module.invalidate_user(102)
+
+    assert len(invalidated) == 2
+    assert auth_module.cached_principal(token) is None
+    assert client.get("/api/auth/me", headers=headers).status_code == 200
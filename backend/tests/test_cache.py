@@ -0,0 +1,63 @@
+import pytest
+
+from cache import CacheBackend, FakeSharedClient, ResponseCache, SharedCacheBackend, json_response, owner_tag
+
+pytestmark = pytest.mark.anyio
+
+KEY = "v1:/api/expenses/mine:1:params"
+
+class Loader:
+    """Counts loads and returns a new body each time"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        return json_response({"load": self.calls})
+
+def workers(count: int = 2) -> list:
+    """Response caches of several workers sharing one store"""
+    client = FakeSharedClient()
+    return [ResponseCache(SharedCacheBackend(client), ttl=60) for _ in range(count)]
+
+async def test_entry_loaded_by_one_worker_is_a_hit_for_another():
+    first, second = workers()
+    loader = Loader()
+
+    loaded = await first.get_or_load(KEY, [owner_tag(1)], loader)
+    cached = await second.get_or_load(KEY, [owner_tag(1)], loader)
+
+    assert loader.calls == 1
+    assert cached == loaded
+    assert second.counters["hits"] == 1
+
+async def test_invalidation_in_one_worker_reaches_the_other():
+    first, second = workers()
+    loader = Loader()
+    await first.get_or_load(KEY, [owner_tag(1)], loader)
+
+    await second.invalidate({owner_tag(1)})
+    reloaded = await first.get_or_load(KEY, [owner_tag(1)], loader)
+
+    assert loader.calls == 2
+    assert reloaded.body == b'{"load":2}'
+    assert first.counters["stale"] == 1
+
+async def test_invalidating_another_tag_keeps_the_entry():
+    first, second = workers()
+    loader = Loader()
+    await first.get_or_load(KEY, [owner_tag(1)], loader)
+
+    await second.invalidate({owner_tag(2)})
+    await second.get_or_load(KEY, [owner_tag(1)], loader)
+
+    assert loader.calls == 1
+
+def test_incomplete_backend_cannot_be_created():
+    class ReadOnly(CacheBackend):
+        async def get_many(self, keys):
+            return [None] * len(keys)
+
+    with pytest.raises(TypeError):
+        ReadOnly()
@@ -0,0 +1,119 @@
+import asyncio
+from contextlib import aclosing
+
+import pytest
+
+from events import RESET, EventBackend, EventBus, FakeSharedEventClient, MemoryBackend, PendingEvent, SharedBackend
+
+pytestmark = pytest.mark.anyio
+
+APPROVER = 7
+
+def pending(expense_id: int, audience=(APPROVER,)) -> PendingEvent:
+    return PendingEvent("expense.updated", frozenset(audience), {"id": expense_id})
+
+async def take(bus: EventBus, count: int, since=None) -> list:
+    """The first `count` events (None for a heartbeat) streamed to APPROVER"""
+    received = []
+    async with aclosing(bus.stream(APPROVER, since, heartbeat=0.05)) as events:
+        async for event in events:
+            received.append(event)
+            if len(received) == count:
+                return received
+
+async def test_resume_after_reconnect_replays_missed_events():
+    bus = EventBus(MemoryBackend())
+    first = await bus.publish([pending(1)])
+    # Disconnected while these happen; the second is someone else's queue
+    await bus.publish([pending(2), pending(3, audience=(8,)), pending(4)])
+
+    events = await take(bus, 3, since=first[0].seq)
+
+    assert [(event.seq, event.data["id"]) for event in events[:2]] == [(2, 2), (4, 4)]
+    assert events[2] is None
+
+async def test_resume_from_current_sequence_waits_for_new_events():
+    bus = EventBus(MemoryBackend())
+    published = await bus.publish([pending(1)])
+
+    assert await take(bus, 1, since=published[-1].seq) == [None]
+
+async def test_resume_past_retained_history_resets():
+    bus = EventBus(MemoryBackend(history_size=2))
+    await bus.publish([pending(expense_id) for expense_id in range(1, 5)])
+
+    events = await take(bus, 1, since=1)
+
+    assert events[0].type == RESET
+    assert events[0].seq == 4
+
+async def test_sequence_from_before_a_restart_resets():
+    bus = EventBus(MemoryBackend())
+    await bus.publish([pending(1)])
+
+    events = await take(bus, 1, since=50)
+
+    assert events[0].type == RESET
+
+async def test_shared_backend_resumes_events_published_by_another_worker():
+    client = FakeSharedEventClient()
+    publisher, subscriber = EventBus(SharedBackend(client)), EventBus(SharedBackend(client))
+    await subscriber.start()
+    try:
+        first = await publisher.publish([pending(1)])
+        await publisher.publish([pending(2)])
+
+        events = await take(subscriber, 1, since=first[0].seq)
+
+        assert [(event.seq, event.data["id"]) for event in events] == [(2, 2)]
+    finally:
+        await subscriber.stop()
+
+class RemoteClient:
+    """A shared client whose replies arrive `latency` event-loop turns after it acted, as over a network"""
+
+    def __init__(self, client, latency: int):
+        self._client = client
+        self._latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        if not asyncio.iscoroutinefunction(method):
+            return method
+
+        async def call(*args, **kwargs):
+            result = await method(*args, **kwargs)
+            for _ in range(self._latency):
+                await asyncio.sleep(0)
+            return result
+        return call
+
+async def test_concurrent_publishers_deliver_in_sequence_order():
+    client = FakeSharedEventClient()
+    slow, fast = SharedBackend(RemoteClient(client, 5)), SharedBackend(RemoteClient(client, 0))
+    subscriber = EventBus(SharedBackend(client))
+    await subscriber.start()
+    try:
+        live = asyncio.create_task(take(subscriber, 4))
+        await asyncio.sleep(0.01)
+        # The slow worker gets its number first but hears back last
+        await asyncio.gather(*(
+            backend.publish([pending(expense_id)])
+            for expense_id, backend in enumerate([slow, fast, slow, fast], start=1)
+        ))
+
+        received = await live
+        resumed = await take(subscriber, 3, since=1)
+
+        assert [event.seq for event in received] == [1, 2, 3, 4]
+        assert [event.seq for event in resumed] == [2, 3, 4]
+    finally:
+        await subscriber.stop()
+
+def test_incomplete_backend_cannot_be_created():
+    class PublishOnly(EventBackend):
+        async def publish(self, events):
+            return []
+
+    with pytest.raises(TypeError):
+        PublishOnly()
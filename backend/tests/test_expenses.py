@@ -0,0 +1,51 @@
+import pytest
+
+from conftest import ADMIN, EMPLOYEE, MANAGER, OTHER_EMPLOYEE, OTHER_MANAGER, auth
+
+def create_expense(client, owner_id: int = EMPLOYEE, amount: float = 42.0) -> int:
+    response = client.post(
+        "/api/expenses/",
+        json={"amount": amount, "currency": "USD", "description": "Taxi to the airport"},
+        headers=auth(owner_id),
+    )
+    assert response.status_code == 200
+    return response.json()["id"]
+
+def test_owner_cannot_set_status_directly(client):
+    expense_id = create_expense(client)
+
+    response = client.put(f"/api/expenses/{expense_id}", json={"status": "Approved"}, headers=auth(EMPLOYEE))
+
+    assert response.status_code == 400
+    assert "/api/approvals" in response.json()["detail"]
+    assert client.get(f"/api/expenses/{expense_id}", headers=auth(EMPLOYEE)).json()["status"] == "Pending"
+
+def test_owner_can_update_other_fields(client):
+    expense_id = create_expense(client)
+
+    response = client.put(f"/api/expenses/{expense_id}", json={"amount": 50.0}, headers=auth(EMPLOYEE))
+
+    assert response.status_code == 200
+    assert response.json()["amount"] == 50.0
+
+@pytest.mark.parametrize("reader, expected", [
+    (EMPLOYEE, 200),
+    (ADMIN, 200),
+    (MANAGER, 200),
+    (OTHER_EMPLOYEE, 403),
+    (OTHER_MANAGER, 403),
+])
+def test_expense_readable_by_owner_admin_and_owners_manager(client, reader, expected):
+    expense_id = create_expense(client)
+
+    assert client.get(f"/api/expenses/{expense_id}", headers=auth(reader)).status_code == expected
+
+def test_expense_readable_by_workflow_approver(client):
+    rule = client.post(
+        "/api/approval-rules/", json={"name": "Finance", "approver_ids": [OTHER_MANAGER]}, headers=auth(ADMIN)
+    )
+    assert rule.status_code == 200
+    expense_id = create_expense(client)
+
+    assert client.get(f"/api/expenses/{expense_id}", headers=auth(OTHER_MANAGER)).status_code == 200
+    assert client.get(f"/api/expenses/{expense_id}", headers=auth(OTHER_EMPLOYEE)).status_code == 403
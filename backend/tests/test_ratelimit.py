@@ -0,0 +1,70 @@
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import config
+import ratelimit
+from auth import Principal
+from models import UserRole
+from ratelimit import (
+    WRITE, Budget, FakeSharedRateLimitClient, RateLimiter, RateLimitBackend, RateLimitMiddleware, SharedRateLimitBackend,
+)
+
+VERIFIED = {"verified-token": Principal(5, UserRole.EMPLOYEE)}
+
+async def ok(request):
+    return PlainTextResponse("ok")
+
+@pytest.fixture
+def client(monkeypatch):
+    """An app behind RateLimitMiddleware allowing 2 writes back to back, then one every 10 seconds"""
+    monkeypatch.setattr(config, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setitem(ratelimit.BUDGETS, WRITE, Budget(per_minute=6, burst=2))
+    monkeypatch.setattr(ratelimit, "rate_limiter", RateLimiter(SharedRateLimitBackend(FakeSharedRateLimitClient())))
+    # Stands in for the auth cache, which holds tokens once a route has verified them
+    monkeypatch.setattr(ratelimit, "cached_principal", VERIFIED.get)
+    app = Starlette(routes=[Route("/api/expenses", ok, methods=["POST"])])
+    return TestClient(RateLimitMiddleware(app))
+
+def test_burst_then_429_with_retry_after(client):
+    assert [client.post("/api/expenses").status_code for _ in range(2)] == [200, 200]
+
+    refused = client.post("/api/expenses")
+
+    assert refused.status_code == 429
+    assert refused.headers["Retry-After"] == "10"
+
+def test_made_up_credentials_share_the_address_bucket(client):
+    for attempt in range(2):
+        assert client.post("/api/expenses", headers={"Authorization": f"Bearer fake-{attempt}"}).status_code == 200
+
+    assert client.post("/api/expenses", headers={"Authorization": "Bearer fake-2"}).status_code == 429
+    assert client.post("/api/expenses", headers={"X-API-Key": "anything"}).status_code == 429
+
+def test_verified_user_has_own_bucket(client):
+    for _ in range(2):
+        client.post("/api/expenses")
+
+    verified = {"Authorization": "Bearer verified-token"}
+    assert [client.post("/api/expenses", headers=verified).status_code for _ in range(3)] == [200, 200, 429]
+
+@pytest.mark.anyio
+async def test_workers_draw_from_one_shared_bucket():
+    shared = FakeSharedRateLimitClient()
+    first, second = SharedRateLimitBackend(shared), SharedRateLimitBackend(shared)
+    budget = Budget(per_minute=6, burst=2)
+
+    waits = [await backend.take("write:ip:10.0.0.1", budget) for backend in (first, second, first)]
+
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == pytest.approx(10, abs=0.1)
+
+def test_incomplete_backend_cannot_be_created():
+    class Unlimited(RateLimitBackend):
+        def stats(self):
+            return {}
+
+    with pytest.raises(TypeError):
+        Unlimited()
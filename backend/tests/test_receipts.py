@@ -0,0 +1,55 @@
+import pytest
+
+from conftest import ADMIN, EMPLOYEE, MANAGER, OTHER_EMPLOYEE, OTHER_MANAGER, auth
+from test_expenses import create_expense
+
+PDF = b"%PDF-1.4 receipt for a taxi ride"
+
+def upload_receipt(client, expense_id: int) -> int:
+    response = client.post(
+        f"/api/expenses/{expense_id}/receipts?filename=taxi.pdf", content=PDF, headers=auth(EMPLOYEE)
+    )
+    assert response.status_code == 200
+    return response.json()["id"]
+
+@pytest.mark.parametrize("reader, expected", [
+    (EMPLOYEE, 200),
+    (ADMIN, 200),
+    (MANAGER, 200),
+    (OTHER_MANAGER, 403),
+    (OTHER_EMPLOYEE, 403),
+])
+def test_receipt_readable_by_owner_admin_and_owners_manager(client, reader, expected):
+    expense_id = create_expense(client)
+    receipt_id = upload_receipt(client, expense_id)
+
+    listing = client.get(f"/api/expenses/{expense_id}/receipts", headers=auth(reader))
+    download = client.get(f"/api/expenses/{expense_id}/receipts/{receipt_id}", headers=auth(reader))
+
+    assert (listing.status_code, download.status_code) == (expected, expected)
+    if expected == 200:
+        assert download.content == PDF
+
+def test_receipt_readable_by_workflow_approver(client):
+    rule = client.post(
+        "/api/approval-rules/", json={"name": "Finance", "approver_ids": [OTHER_MANAGER]}, headers=auth(ADMIN)
+    )
+    assert rule.status_code == 200
+    expense_id = create_expense(client)
+    receipt_id = upload_receipt(client, expense_id)
+
+    response = client.get(f"/api/expenses/{expense_id}/receipts/{receipt_id}", headers=auth(OTHER_MANAGER))
+
+    assert response.status_code == 200
+    assert response.content == PDF
+
+def test_reviewer_cannot_change_receipts(client):
+    expense_id = create_expense(client)
+    receipt_id = upload_receipt(client, expense_id)
+
+    deleted = client.delete(f"/api/expenses/{expense_id}/receipts/{receipt_id}", headers=auth(MANAGER))
+    uploaded = client.post(
+        f"/api/expenses/{expense_id}/receipts?filename=other.pdf", content=PDF, headers=auth(MANAGER)
+    )
+
+    assert (deleted.status_code, uploaded.status_code) == (403, 403)
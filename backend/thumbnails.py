@@ -0,0 +1,26 @@
+"""
+Thumbnail rendering, run in worker processes by receipts.schedule_thumbnail.
+
+Kept free of application imports so spawned workers start quickly. Pillow
+is optional: without it no thumbnails are produced and downloads still work.
+"""
+import os
+
+def render_thumbnail(source: str, destination: str, size: int) -> bool:
+    """Write a JPEG no larger than size x size; False if the file is not a readable image"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return False
+    temporary = f"{destination}.{os.getpid()}.tmp"
+    try:
+        with Image.open(source) as image:
+            image.thumbnail((size, size))
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            image.convert("RGB").save(temporary, "JPEG", quality=80, optimize=True)
+        os.replace(temporary, destination)
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError):
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        return False
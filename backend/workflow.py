@@ -0,0 +1,260 @@
+"""
+Multi-step approval workflows.
+
+Active approval rules are compiled into a RuleIndex: the amount axis is cut
+at every rule boundary and each interval stores the winning rule, so routing
+an expense is a bisection instead of a scan over all rules. The compiled
+index is cached per process and rebuilt after any rule is edited, in this
+worker or another one (see RuleIndex).
+
+Routing creates one approval_steps row per approver. Sequential rules open
+one step at a time; parallel rules open every step and approve once the
+configured percentage of approvers agrees. A rule's specific approver gets
+an extra step that approves (or rejects) the expense outright.
+"""
+import asyncio
+import bisect
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from currency import converter
+from models import (
+    ApprovalRule, ApprovalRulesVersion, ApprovalStep, ApprovalStepArchive, Expense, ExpenseStatus, StepStatus, User,
+)
+
+# Steps that can still receive a decision
+OPEN_STEP_STATUSES = [StepStatus.WAITING, StepStatus.PENDING]
+
+class CompiledRule(NamedTuple):
+    id: int
+    name: str
+    priority: int
+    min_amount: float
+    max_amount: Optional[float]
+    is_sequential: bool
+    approval_percentage: Optional[int]
+    specific_approver_id: Optional[int]
+    approver_ids: Tuple[int, ...]
+
+    def covers(self, amount: float) -> bool:
+        return self.min_amount <= amount and (self.max_amount is None or amount < self.max_amount)
+
+class CompiledRules:
+    """Amount breakpoints with the highest-priority rule for each interval"""
+
+    def __init__(self, rules: List[CompiledRule]):
+        ordered = sorted(rules, key=lambda rule: (rule.priority, rule.id))
+        bounds = {rule.min_amount for rule in ordered}
+        bounds.update(rule.max_amount for rule in ordered if rule.max_amount is not None)
+        self._breakpoints = sorted(bounds)
+        # Every amount in [breakpoint[i], breakpoint[i + 1]) is covered by the same rules
+        self._winners = [
+            next((rule for rule in ordered if rule.covers(point)), None)
+            for point in self._breakpoints
+        ]
+
+    def match(self, amount: float) -> Optional[CompiledRule]:
+        position = bisect.bisect_right(self._breakpoints, amount) - 1
+        return self._winners[position] if position >= 0 else None
+
+class RuleIndex:
+    """
+    Process-wide cache of the compiled rules. Rule edits bump the shared
+    approval_rules_version row in their transaction; every get() reads it
+    (one primary key lookup) and recompiles when another worker moved it on.
+    """
+
+    def __init__(self):
+        self._compiled: Optional[CompiledRules] = None
+        self._version: Optional[int] = None
+        self._lock = asyncio.Lock()
+        # Bumped by every invalidate(), so a compile that raced an edit is not kept
+        self._generation = 0
+
+    def invalidate(self):
+        self._generation += 1
+        self._compiled = None
+
+    async def bump(self, db: AsyncSession):
+        """Mark the rules as changed for every worker; call in the editing transaction"""
+        result = await db.execute(
+            update(ApprovalRulesVersion)
+            .where(ApprovalRulesVersion.id == 1)
+            .values(version=ApprovalRulesVersion.version + 1)
+        )
+        if result.rowcount == 0:
+            db.add(ApprovalRulesVersion(id=1, version=1))
+
+    async def get(self, db: AsyncSession) -> CompiledRules:
+        # Read before the rules, so rules newer than the version only cause an extra compile
+        version = (await db.execute(
+            select(ApprovalRulesVersion.version).where(ApprovalRulesVersion.id == 1)
+        )).scalar_one_or_none() or 0
+        compiled = self._compiled
+        if compiled is not None and self._version == version:
+            return compiled
+        async with self._lock:
+            if self._compiled is not None and self._version == version:
+                return self._compiled
+            generation = self._generation
+            rules = (await db.execute(
+                select(ApprovalRule)
+                .where(ApprovalRule.is_active.is_(True))
+                .options(selectinload(ApprovalRule.approvers))
+            )).scalars().all()
+            compiled = CompiledRules([compile_rule(rule) for rule in rules])
+            # An edit invalidated the index mid-read: the rules may predate it, so use them once only
+            if generation == self._generation:
+                self._compiled, self._version = compiled, version
+            return compiled
+
+def compile_rule(rule: ApprovalRule) -> CompiledRule:
+    return CompiledRule(
+        id=rule.id,
+        name=rule.name,
+        priority=rule.priority,
+        min_amount=rule.min_amount or 0.0,
+        max_amount=rule.max_amount,
+        is_sequential=rule.is_sequential,
+        approval_percentage=rule.approval_percentage,
+        specific_approver_id=rule.specific_approver_id,
+        approver_ids=tuple(approver.approver_id for approver in rule.approvers),
+    )
+
+rule_index = RuleIndex()
+
+def routing_amount(amount: float, currency: str, on: datetime) -> float:
+    """Rules are defined in the base currency; fall back to the raw amount without a rate"""
+    converted = converter.convert(amount, currency, on)
+    return amount if converted is None else converted
+
+def build_steps(rule: CompiledRule, expense_id: int) -> List[dict]:
+    """Step rows for a newly routed expense"""
+    steps = [
+        {
+            "expense_id": expense_id,
+            "rule_id": rule.id,
+            "approver_id": approver_id,
+            "sequence": sequence,
+            "is_override": False,
+            "status": StepStatus.PENDING if sequence == 1 or not rule.is_sequential else StepStatus.WAITING,
+        }
+        for sequence, approver_id in enumerate(rule.approver_ids, start=1)
+    ]
+    if rule.specific_approver_id is not None:
+        # The override approver can act at any time, regardless of chain position
+        steps.append({
+            "expense_id": expense_id,
+            "rule_id": rule.id,
+            "approver_id": rule.specific_approver_id,
+            "sequence": 0,
+            "is_override": True,
+            "status": StepStatus.PENDING,
+        })
+    return steps
+
+async def route_expenses(db: AsyncSession, expenses: List[dict]) -> int:
+    """
+    Create approval steps for new expenses (dicts with id, amount, currency
+    and date). Runs in the caller's transaction; returns the number of steps.
+    """
+    compiled = await rule_index.get(db)
+    steps = []
+    for expense in expenses:
+        rule = compiled.match(routing_amount(expense["amount"], expense["currency"], expense["date"]))
+        if rule is not None:
+            steps.extend(build_steps(rule, expense["id"]))
+    if steps:
+        await db.execute(ApprovalStep.__table__.insert(), steps)
+    return len(steps)
+
+async def is_reviewer(db: AsyncSession, user_id: int, expense_id: int, owner_id: int) -> bool:
+    """
+    Whether `user_id` has a say in the expense: they hold a workflow step on
+    it (archived steps included) or manage its owner. Reviewers may read the
+    expense and its receipts.
+    """
+    holds_step = select(ApprovalStep.id).where(
+        ApprovalStep.expense_id == expense_id, ApprovalStep.approver_id == user_id
+    ).exists()
+    held_step = select(ApprovalStepArchive.id).where(
+        ApprovalStepArchive.expense_id == expense_id, ApprovalStepArchive.approver_id == user_id
+    ).exists()
+    manages_owner = select(User.id).where(User.id == owner_id, User.manager_id == user_id).exists()
+    return bool(await db.scalar(select(or_(holds_step, held_step, manages_owner))))
+
+async def has_workflow(db: AsyncSession, expense_id: int) -> bool:
+    return (await db.execute(
+        select(ApprovalStep.id).where(ApprovalStep.expense_id == expense_id).limit(1)
+    )).first() is not None
+
+async def decide_step(
+    db: AsyncSession,
+    expense: Expense,
+    approver_id: int,
+    approved: bool,
+    comments: Optional[str] = None,
+) -> Optional[ExpenseStatus]:
+    """
+    Record an approver's decision on their open step. Returns the final
+    expense status once the workflow is complete, otherwise None. The caller
+    updates the expense and commits.
+    """
+    steps = (await db.execute(
+        select(ApprovalStep)
+        .where(ApprovalStep.expense_id == expense.id)
+        .order_by(ApprovalStep.sequence)
+        .with_for_update()
+    )).scalars().all()
+
+    step = next(
+        (s for s in steps if s.approver_id == approver_id and s.status == StepStatus.PENDING),
+        None
+    )
+    if step is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="No approval step is currently assigned to you for this expense."
+        )
+
+    step.status = StepStatus.APPROVED if approved else StepStatus.REJECTED
+    step.comments = comments
+    step.decided_at = datetime.utcnow()
+
+    chain = [s for s in steps if not s.is_override]
+    rule = await db.get(ApprovalRule, step.rule_id) if step.rule_id is not None else None
+    # Steps of a deleted rule keep their order and behave sequentially
+    sequential = rule is None or rule.is_sequential
+    final_status = None
+
+    if step.is_override:
+        final_status = ExpenseStatus.APPROVED if approved else ExpenseStatus.REJECTED
+    elif sequential:
+        next_step = next((s for s in chain if s.status == StepStatus.WAITING), None)
+        if not approved:
+            final_status = ExpenseStatus.REJECTED
+        elif next_step is None:
+            final_status = ExpenseStatus.APPROVED
+        else:
+            next_step.status = StepStatus.PENDING
+    else:
+        percentage = rule.approval_percentage or 100
+        approvals = sum(1 for s in chain if s.status == StepStatus.APPROVED)
+        rejections = sum(1 for s in chain if s.status == StepStatus.REJECTED)
+        if approvals * 100 >= percentage * len(chain):
+            final_status = ExpenseStatus.APPROVED
+        elif (len(chain) - rejections) * 100 < percentage * len(chain):
+            # The quorum can no longer be reached
+            final_status = ExpenseStatus.REJECTED
+
+    if final_status is not None:
+        for open_step in steps:
+            if open_step.status in OPEN_STEP_STATUSES:
+                open_step.status = StepStatus.SKIPPED
+    await db.flush()
+    return final_status